@@ -0,0 +1,127 @@
+"""
+2段階検索（低次元の粗い検索 + 元の次元での再スコア）のレイテンシと再現率の計測
+
+使い方（backend ディレクトリで実行）:
+    python -m benchmarks.coarse_search --rows 100000
+    python -m benchmarks.coarse_search --from-index ./vector_db_data   # 既存のインデックスで計測
+
+合成データは先頭の次元ほど分散が大きい埋め込み（Matryoshka 型）と、
+それをランダムに回転したもの（ada-002 型。先頭の切り詰めが効かず pca が必要）を作る。
+再現率は全次元での検索結果の上位 n 件のうち、2段階検索でも取れた割合。
+"""
+import argparse
+import tempfile
+import time
+from typing import List, Optional
+
+import numpy as np
+
+from services.vector_db_service import EMPTY_SNAPSHOT, MetadataIndex, VectorDBService
+from services.shared_index import DocumentTable, SharedIndexStore
+
+
+def synthetic_embeddings(rows: int, dims: int, clusters: int, rotate: bool, seed: int = 0) -> np.ndarray:
+    """クラスタ構造と減衰するスペクトルを持つ合成の埋め込み"""
+    rng = np.random.default_rng(seed)
+    # クラスタの中心は先頭の次元に集中し、クラスタ内の違いは後ろの次元にも広がる
+    centers = rng.standard_normal((clusters, dims)) * (np.arange(dims) + 1.0) ** -0.5
+    noise = rng.standard_normal((rows, dims)) * (np.arange(dims) + 1.0) ** -0.25
+    embeddings = centers[rng.integers(0, clusters, rows)] + noise
+    if rotate:
+        rotation, _ = np.linalg.qr(rng.standard_normal((dims, dims)))
+        embeddings = embeddings @ rotation
+    return embeddings.astype(np.float32)
+
+
+def make_service(embeddings: np.ndarray, method: str, dims: int, oversample: int) -> VectorDBService:
+    """計測用に埋め込みを直接持たせたサービス"""
+    service = VectorDBService()
+    service.shared_store = SharedIndexStore(tempfile.mkdtemp())
+    documents = DocumentTable(appended=[{'id': str(i), 'content': '', 'source': 'bench'} for i in range(len(embeddings))])
+    service._snapshot = EMPTY_SNAPSHOT._replace(
+        documents=documents,
+        blocks=(service._make_block(embeddings),),
+        live=np.ones(len(documents), dtype=bool),
+        metadata_index=MetadataIndex(documents)
+    )
+    service.coarse_dims = dims
+    service.coarse_method = method
+    service.coarse_oversample = oversample
+    service.coarse_min_rows = 0
+    return service
+
+
+def run(service: VectorDBService, queries: np.ndarray, n_results: int) -> tuple:
+    """1クエリずつ検索し、(p50, p95 のミリ秒, 結果のID) を返す"""
+    timings, ids = [], []
+    for query in queries:
+        start = time.perf_counter()
+        results = service._search_vectors([query], n_results, None)[0]
+        timings.append((time.perf_counter() - start) * 1000)
+        ids.append([result['metadata']['id'] for result in results])
+    return np.percentile(timings, 50), np.percentile(timings, 95), ids
+
+
+def benchmark(name: str, embeddings: np.ndarray, queries: np.ndarray, n_results: int,
+              configs: List[tuple]) -> None:
+    print(f"\n## {name}: {embeddings.shape[0]} 行 x {embeddings.shape[1]} 次元, {len(queries)} クエリ, 上位{n_results}件")
+    exact = make_service(embeddings, "prefix", 0, 1)
+    p50, p95, truth = run(exact, queries, n_results)
+    print(f"{'方法':<8}{'次元':>6}{'候補倍率':>8}{'p50(ms)':>10}{'p95(ms)':>10}{'再現率':>8}")
+    print(f"{'exact':<8}{embeddings.shape[1]:>6}{'-':>8}{p50:>10.2f}{p95:>10.2f}{1.0:>8.3f}")
+
+    for method, dims, oversample in configs:
+        service = make_service(embeddings, method, dims, oversample)
+        service._coarse_index(service._snapshot.blocks)  # 低次元化の作成時間は計測から除く
+        p50, p95, found = run(service, queries, n_results)
+        recall = np.mean([len(set(a) & set(b)) / len(a) for a, b in zip(truth, found)])
+        print(f"{method:<8}{dims:>6}{oversample:>8}{p50:>10.2f}{p95:>10.2f}{recall:>8.3f}")
+
+
+def load_index(data_dir: str) -> Optional[np.ndarray]:
+    """既存のインデックスの最新スナップショットの埋め込み"""
+    store = SharedIndexStore(f"{data_dir}/shared")
+    generation = store.current_generation()
+    if generation == 0:
+        return None
+    _, embeddings, _, _ = store.load(generation)
+    return np.asarray(embeddings)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--rows", type=int, default=50000)
+    parser.add_argument("--dims", type=int, default=1536)
+    parser.add_argument("--queries", type=int, default=200)
+    parser.add_argument("--n-results", type=int, default=5)
+    parser.add_argument("--from-index", help="既存の vector_db_data ディレクトリの埋め込みで計測")
+    args = parser.parse_args()
+
+    rng = np.random.default_rng(1)
+    sweep = [(dims, oversample) for dims in (64, 128, 256) for oversample in (10, 40)]
+
+    if args.from_index:
+        embeddings = load_index(args.from_index)
+        if embeddings is None or not len(embeddings):
+            print("インデックスが見つかりません")
+            return
+        # 既存の行に少しノイズを加えたものをクエリにする
+        queries = embeddings[rng.integers(0, len(embeddings), args.queries)]
+        queries = queries + 0.01 * rng.standard_normal(queries.shape).astype(np.float32)
+        benchmark("既存のインデックス", embeddings, queries, args.n_results,
+                  [(method, dims, oversample) for method in ("prefix", "pca") for dims, oversample in sweep])
+        return
+
+    for name, rotate, method in (("Matryoshka 型（text-embedding-3 相当）", False, "prefix"),
+                                 ("回転あり（ada-002 相当）", True, "pca")):
+        embeddings = synthetic_embeddings(args.rows + args.queries, args.dims, clusters=max(args.rows // 50, 1), rotate=rotate)
+        queries, embeddings = embeddings[:args.queries], embeddings[args.queries:]
+        configs = [(method, dims, oversample) for dims, oversample in sweep]
+        if rotate:
+            # 先頭の切り詰めが効かないことの比較用
+            configs.insert(0, ("prefix", 256, 40))
+        benchmark(name, embeddings, queries, args.n_results, configs)
+
+
+if __name__ == "__main__":
+    main()
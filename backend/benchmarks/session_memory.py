@@ -0,0 +1,111 @@
+"""
+セッションのメッセージ保持のメモリ使用量と get_messages の速度の計測
+
+使い方（backend ディレクトリで実行）:
+    python -m benchmarks.session_memory --sessions 100000 --turns 20
+
+従来の形式（ISO文字列のタイムスタンプを持つ辞書を保存し、get_messages のたびに
+全メッセージを辞書にコピー）と、現在の SessionService を比較する。
+セッションはチャットと同じく、ユーザーのメッセージを追加 → 履歴を取得 → 応答を追加の順で作る。
+メッセージ本文の文字列は両方で共有し、構造のオーバーヘッドだけを計測する。
+"""
+import argparse
+import gc
+import time
+import tracemalloc
+from datetime import datetime
+
+from services.session_service import SessionService
+
+# 本文は共有した文字列を使う（本文そのもののメモリは形式によらないため）
+USER_TEXT = "社内規程の有給休暇の申請手順を教えてください。"
+ASSISTANT_TEXT = "有給休暇は申請システムから取得日の3営業日前までに申請してください。" * 4
+
+
+def build_legacy(sessions: int, turns: int) -> dict:
+    """従来の形式でセッションを作成"""
+    store = {}
+    for i in range(sessions):
+        session = {"id": str(i), "messages": [], "created_at": datetime.now(),
+                   "last_accessed": datetime.now(), "metadata": {}}
+        for _ in range(turns):
+            session["messages"].append({"role": "user", "content": USER_TEXT, "timestamp": datetime.now().isoformat()})
+            legacy_get_messages(session, 20)
+            session["messages"].append({"role": "assistant", "content": ASSISTANT_TEXT, "timestamp": datetime.now().isoformat()})
+        store[str(i)] = session
+    return store
+
+
+def legacy_get_messages(session: dict, limit: int) -> list:
+    """従来の get_messages（全メッセージをコピーしてから切り出す）"""
+    api_messages = [{"role": msg["role"], "content": msg["content"]} for msg in session["messages"]]
+    return api_messages[-limit:]
+
+
+def build_current(sessions: int, turns: int) -> SessionService:
+    """現在の SessionService でセッションを作成"""
+    service = SessionService(snapshot_dir="")
+    for _ in range(sessions):
+        session_id = service.create_session()
+        for _ in range(turns):
+            service.add_message(session_id, "user", USER_TEXT)
+            service.get_messages(session_id, limit=20)
+            service.add_message(session_id, "assistant", ASSISTANT_TEXT)
+    return service
+
+
+def measure(name: str, build, get_messages, messages: int, calls: int) -> None:
+    """メモリ・完全なGC 1回の時間・get_messages 1回の時間を計測して表示"""
+    gc.collect()
+    tracemalloc.start()
+    start = time.perf_counter()
+    store, session_ids = build()
+    build_seconds = time.perf_counter() - start
+    memory, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    # 1回目の GC で追跡不要なタプル・辞書が追跡対象から外れるので、2回目を定常状態とみなす
+    gc.collect()
+    tracked = len(gc.get_objects())
+    start = time.perf_counter()
+    gc.collect()
+    gc_ms = (time.perf_counter() - start) * 1000
+
+    start = time.perf_counter()
+    for i in range(calls):
+        get_messages(store, session_ids[i % len(session_ids)])
+    get_us = (time.perf_counter() - start) / calls * 1e6
+
+    print(f"{name:<8}{memory / 1024 ** 2:>12.1f}{memory / messages:>14.1f}{build_seconds:>10.1f}"
+          f"{tracked:>12}{gc_ms:>12.1f}{get_us:>16.2f}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--sessions", type=int, default=100000)
+    parser.add_argument("--turns", type=int, default=20)
+    parser.add_argument("--calls", type=int, default=100000, help="計測する get_messages(limit=20) の呼び出し回数")
+    args = parser.parse_args()
+
+    messages = args.sessions * args.turns * 2
+    # tracemalloc で計測すると作成時間は実際より長くなる
+    print(f"{args.sessions} セッション x {args.turns} ターン（{messages} メッセージ）")
+    print(f"{'形式':<8}{'メモリ(MB)':>12}{'1件あたり(B)':>14}{'作成(秒)':>10}{'GC追跡数':>12}{'GC(ms)':>12}{'get_messages(us)':>16}")
+
+    def build_legacy_store():
+        store = build_legacy(args.sessions, args.turns)
+        return store, list(store)
+
+    measure("legacy", build_legacy_store,
+            lambda store, session_id: legacy_get_messages(store[session_id], 20), messages, args.calls)
+
+    def build_current_store():
+        service = build_current(args.sessions, args.turns)
+        return service, list(service.sessions)
+
+    measure("current", build_current_store,
+            lambda service, session_id: service.get_messages(session_id, limit=20), messages, args.calls)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,57 @@
+"""
+分割検索（候補をシャードに分けてスレッドで並列にスコア計算）のレイテンシの計測
+
+使い方（backend ディレクトリで実行）:
+    python -m benchmarks.sharded_search --rows 200000 --shards 1 2 4 8
+    OPENBLAS_NUM_THREADS=1 python -m benchmarks.sharded_search   # BLAS のスレッドとの取り合いを避ける
+
+シャード数ごとに1クエリずつ検索したときの p50 / p95 と、シャード数1との結果の一致を表示する。
+"""
+import argparse
+import os
+import time
+
+import numpy as np
+
+from benchmarks.coarse_search import make_service, synthetic_embeddings
+
+
+def run(service, queries: np.ndarray, n_results: int) -> tuple:
+    """1クエリずつ検索し、(p50, p95 のミリ秒, 結果のID) を返す"""
+    timings, ids = [], []
+    for query in queries:
+        start = time.perf_counter()
+        results = service._search_vectors([query], n_results, None)[0]
+        timings.append((time.perf_counter() - start) * 1000)
+        ids.append([result['metadata']['id'] for result in results])
+    return np.percentile(timings, 50), np.percentile(timings, 95), ids
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--rows", type=int, default=200000)
+    parser.add_argument("--dims", type=int, default=1536)
+    parser.add_argument("--queries", type=int, default=100)
+    parser.add_argument("--n-results", type=int, default=5)
+    parser.add_argument("--shards", type=int, nargs="+", default=[1, 2, 4, 8])
+    args = parser.parse_args()
+
+    embeddings = synthetic_embeddings(args.rows + args.queries, args.dims, clusters=max(args.rows // 50, 1), rotate=False)
+    queries, embeddings = embeddings[:args.queries], embeddings[args.queries:]
+    service = make_service(embeddings, "prefix", 0, 1)
+    service.shard_min_rows = 0
+
+    print(f"## {args.rows} 行 x {args.dims} 次元, {args.queries} クエリ, 上位{args.n_results}件, CPU {os.cpu_count()}")
+    print(f"{'シャード':<8}{'p50(ms)':>10}{'p95(ms)':>10}{'一致':>6}")
+    baseline = None
+    for shards in args.shards:
+        service.search_shards = shards
+        service._shard_executor = None
+        service._search_vectors([queries[0]], args.n_results, None)  # スレッドの起動は計測から除く
+        p50, p95, ids = run(service, queries, args.n_results)
+        baseline = baseline or ids
+        print(f"{shards:<8}{p50:>10.2f}{p95:>10.2f}{str(ids == baseline):>6}")
+
+
+if __name__ == "__main__":
+    main()
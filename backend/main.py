@@ -1,21 +1,42 @@
 from fastapi import FastAPI, Request, Form, HTTPException
-from fastapi.responses import HTMLResponse
+from fastapi.responses import HTMLResponse, JSONResponse
 from fastapi.staticfiles import StaticFiles
 from fastapi.templating import Jinja2Templates
 from fastapi.middleware.cors import CORSMiddleware
 from starlette.middleware.sessions import SessionMiddleware
+from contextlib import asynccontextmanager
 import uvicorn
+import asyncio
 import os
 from dotenv import load_dotenv
 
 from routes.chat import router as chat_router
 from routes.documents import router as documents_router
+from routes.ws_chat import router as ws_chat_router
+from routes.profiling import router as profiling_router
+from services.session_service import session_service
+from services.vector_db_service import vector_db_service
+from services.deployment_router import chat_deployments, embedding_deployments
+from services.admission import chat_admission, chat_stream_admission
+from services.profiler import ProfilingMiddleware, request_profiler
 
 # 環境変数の読み込み
 load_dotenv()
 
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    """起動・終了時の処理"""
+    # プロファイラが有効なら、タスクとスレッドプールの処理をリクエストに振り分けられるようにする
+    request_profiler.install(asyncio.get_running_loop())
+    # セッションのクリーンアップを開始
+    session_service.start()
+    # ベクトルインデックスはバックグラウンドで読み込み、その間もRAGなしで応答する
+    vector_db_service.start_background_load()
+    yield
+    await session_service.stop()
+
 # FastAPIアプリケーションの初期化
-app = FastAPI(title="Azure AI Chat Tool")
+app = FastAPI(title="Azure AI Chat Tool", lifespan=lifespan)
 
 # ミドルウェアの設定
 app.add_middleware(
@@ -31,6 +52,10 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
+# 処理段階ごとの所要時間の記録とスタックの採取（PROFILER_ENABLED=true のときのみ）
+if request_profiler.enabled:
+    app.add_middleware(ProfilingMiddleware)
+
 # 静的ファイルの設定
 import os
 from pathlib import Path
@@ -48,6 +73,9 @@ templates = Jinja2Templates(directory=str(template_dir))
 
 # ルーターの登録
 app.include_router(chat_router)
+app.include_router(ws_chat_router)
+if request_profiler.enabled:
+    app.include_router(profiling_router)
 app.include_router(documents_router, prefix="/api/documents")
 
 # ルートエンドポイント
@@ -60,6 +88,33 @@ async def root(request: Request):
 async def health_check():
     return {"status": "healthy", "service": "Azure AI Chat Tool"}
 
+# レディネスチェックエンドポイント（ベクトルインデックスの読み込み状況）
+@app.get("/ready")
+async def readiness_check():
+    index_status = vector_db_service.get_load_status()
+    ready = index_status["state"] == "ready"
+    return JSONResponse(
+        status_code=200 if ready else 503,
+        content={"status": "ready" if ready else "loading", "vector_index": index_status}
+    )
+
+# デプロイメントの振り分け状況（レイテンシ・処理中の数・サーキットブレーカーの状態）
+@app.get("/deployments")
+async def deployment_status():
+    return {
+        "chat": chat_deployments.status(),
+        "embedding": embedding_deployments.status(),
+        "hedged_requests": chat_deployments.hedged_requests + embedding_deployments.hedged_requests
+    }
+
+# チャットの受付制御の状態（実行中・待ち行列の深さ・遮断数）
+@app.get("/admission")
+async def admission_status():
+    return {
+        "chat": chat_admission.status(),
+        "chat_stream": chat_stream_admission.status()
+    }
+
 if __name__ == "__main__":
     uvicorn.run(
         "main:app",
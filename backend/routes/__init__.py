@@ -1,5 +1,6 @@
 # Routes package initialization
 from .chat import router as chat_router
 from .documents import router as documents_router
+from .ws_chat import router as ws_chat_router
 
-__all__ = ['chat_router', 'documents_router']
\ No newline at end of file
+__all__ = ['chat_router', 'documents_router', 'ws_chat_router']
\ No newline at end of file
@@ -0,0 +1,14 @@
+"""
+管理用エンドポイントの共通の依存関係
+"""
+from fastapi import HTTPException, Request
+
+from services.admin_auth import admin_auth
+
+
+async def require_admin(request: Request):
+    """管理用トークンを確認（未設定なら403、一致しなければ401）"""
+    if not admin_auth.enabled:
+        raise HTTPException(status_code=403, detail="ADMIN_TOKEN が設定されていないため、管理用の操作は使えません")
+    if not admin_auth.verify(request.headers.get(admin_auth.header)):
+        raise HTTPException(status_code=401, detail=f"{admin_auth.header} ヘッダーに管理用トークンを指定してください")
@@ -1,13 +1,17 @@
 from fastapi import APIRouter, Request, Form, HTTPException
 from fastapi.responses import HTMLResponse, StreamingResponse
-from typing import Optional
+from starlette.background import BackgroundTask
+from typing import List, Optional, Tuple
 import logging
-import json
 import markdown
 
-from services.openai_service import AzureOpenAIService
+from services.openai_service import openai_service
 from services.session_service import session_service
-from services.vector_db_service import vector_db_service
+from services.vector_db_service import MetadataIndex
+from services.retrieval_prefetch import retrieval_prefetcher, search_context
+from services.profiler import phase
+from services.admission import AdmissionController, AdmissionRejected, AdmissionSlot, chat_admission, chat_stream_admission
+from .sse import DeltaCoalescer, sse_event, gzip_stream, gzip_enabled
 
 # ロガーの設定
 logger = logging.getLogger(__name__)
@@ -15,12 +19,46 @@ logger = logging.getLogger(__name__)
 # ルーターの初期化
 router = APIRouter()
 
-# Azure OpenAI サービスのインスタンス
-openai_service = AzureOpenAIService()
-
 # Markdownパーサーの設定
 md = markdown.Markdown(extensions=['fenced_code', 'tables'])
 
+async def retrieve_context(session_id: str, message: str) -> Tuple[str, List[str]]:
+    """
+    RAG検索を実行してプロンプト用のコンテキストを組み立てる
+    
+    入力中に先読みした下書きが送信されたメッセージと十分に近ければ、その検索結果を使う。
+    
+    Args:
+        session_id: セッションID（絞り込み条件の取得に使用）
+        message: ユーザーからのメッセージ
+        
+    Returns:
+        (コンテキスト文字列, 参考資料のソースのリスト)
+    """
+    # セッションに絞り込み条件があれば適用し、候補は多めに取得する
+    search_filters = session_service.get_search_filters(session_id)
+    prefetched = await retrieval_prefetcher.take(session_id, message, search_filters)
+    if prefetched is not None:
+        return prefetched
+    return await search_context(message, search_filters)
+
+async def admit(controller: AdmissionController, session_id: Optional[str], message: str) -> AdmissionSlot:
+    """
+    実行枠を取得（混雑時は会話の途中・短いプロンプトを優先して待たせる）
+    
+    Raises:
+        HTTPException: 見込み待ち時間が SLO を超える場合は Retry-After 付きの503
+    """
+    session = session_service.get_session(session_id) if session_id else None
+    try:
+        return await controller.acquire(
+            session_id if session else None,
+            in_progress=bool(session and session["messages"]),
+            prompt_chars=len(message)
+        )
+    except AdmissionRejected as e:
+        raise HTTPException(status_code=503, detail=str(e), headers={"Retry-After": str(e.retry_after)})
+
 @router.post("/chat", response_class=HTMLResponse)
 async def chat(
     request: Request,
@@ -38,6 +76,9 @@ async def chat(
     Returns:
         HTMXで更新されるHTMLフラグメント
     """
+    # 混雑時は優先度順に待ち、待ちきれない場合は503で断る
+    with phase("admission"):
+        slot = await admit(chat_admission, session_id, message)
     try:
         # セッションの取得または作成
         if not session_id or not session_service.get_session(session_id):
@@ -50,29 +91,20 @@ async def chat(
         # 会話履歴を取得（最新の10メッセージ）
         messages = session_service.get_messages(session_id, limit=20)
         
-        # RAG検索を実行
-        search_results = await vector_db_service.search(message, n_results=3)
-        context = ""
-        sources = []
-        
-        if search_results:
-            # 検索結果からコンテキストを構築
-            context_parts = []
-            for result in search_results:
-                context_parts.append(result['content'])
-                source = result['metadata'].get('source', 'Unknown')
-                if source not in sources:
-                    sources.append(source)
-            context = "\n\n".join(context_parts)
+        # RAG検索を実行し、トークン予算内のコンテキストを構築
+        with phase("retrieval"):
+            context, sources = await retrieve_context(session_id, message)
         
         # Azure OpenAI APIを呼び出し（コンテキスト付き）
-        ai_response = await openai_service.get_chat_response(messages, context=context)
+        with phase("llm"):
+            ai_response = await openai_service.get_chat_response(messages, context=context)
         
         # AIの応答をセッションに追加
         session_service.add_message(session_id, "assistant", ai_response)
         
         # Markdown形式のレスポンスをHTMLに変換
-        html_content = md.convert(ai_response)
+        with phase("render"):
+            html_content = md.convert(ai_response)
         
         # HTMXレスポンスを生成
         response_html = f"""
@@ -105,6 +137,8 @@ async def chat(
         </div>
         """
         return error_html
+    finally:
+        slot.release()
 
 @router.post("/chat/stream")
 async def chat_stream(
@@ -123,6 +157,9 @@ async def chat_stream(
     Returns:
         Server-Sent Events形式のストリーミングレスポンス
     """
+    # 実行枠はストリームを送り終えるまで保持する
+    with phase("admission"):
+        slot = await admit(chat_stream_admission, session_id, message)
     try:
         # セッションの取得または作成
         if not session_id or not session_service.get_session(session_id):
@@ -134,62 +171,89 @@ async def chat_stream(
         # 会話履歴を取得
         messages = session_service.get_messages(session_id, limit=20)
         
-        # RAG検索を実行
-        search_results = await vector_db_service.search(message, n_results=3)
-        context = ""
-        sources = []
-        
-        if search_results:
-            # 検索結果からコンテキストを構築
-            context_parts = []
-            for result in search_results:
-                context_parts.append(result['content'])
-                source = result['metadata'].get('source', 'Unknown')
-                if source not in sources:
-                    sources.append(source)
-            context = "\n\n".join(context_parts)
+        # RAG検索を実行し、トークン予算内のコンテキストを構築
+        with phase("retrieval"):
+            context, sources = await retrieve_context(session_id, message)
         
         async def generate():
-            """SSE形式でレスポンスを生成"""
-            full_response = ""
+            """SSE形式でレスポンスを生成（差分はまとめて送信）"""
+            coalescer = DeltaCoalescer()
             
             try:
                 # 初期イベント：セッションIDを送信
-                yield f"data: {json.dumps({'type': 'session', 'session_id': session_id})}\n\n"
+                yield sse_event({'type': 'session', 'session_id': session_id})
                 
                 # ソース情報を送信
                 if sources:
-                    yield f"data: {json.dumps({'type': 'sources', 'sources': sources})}\n\n"
+                    yield sse_event({'type': 'sources', 'sources': sources})
                 
-                # ストリーミングレスポンスを取得（コンテキスト付き）
-                async for chunk in openai_service.get_streaming_response(messages, context=context):
-                    full_response += chunk
-                    # チャンクをSSE形式で送信
-                    yield f"data: {json.dumps({'type': 'chunk', 'content': chunk})}\n\n"
+                # ストリーミングレスポンスを取得（コンテキスト付き）し、サイズ・時間の窓でまとめて送信
+                with phase("llm"):
+                    deltas = openai_service.get_streaming_response(messages, context=context)
+                    async for event in coalescer.events(deltas):
+                        yield event
                 
                 # 完了イベント
-                yield f"data: {json.dumps({'type': 'done'})}\n\n"
+                yield sse_event({'type': 'done'})
                 
                 # 完全なレスポンスをセッションに保存
-                session_service.add_message(session_id, "assistant", full_response)
+                session_service.add_message(session_id, "assistant", coalescer.text)
                 
             except Exception as e:
                 logger.error(f"ストリーミング中にエラー: {str(e)}")
-                yield f"data: {json.dumps({'type': 'error', 'message': str(e)})}\n\n"
+                yield sse_event({'type': 'error', 'message': str(e)})
+            finally:
+                slot.release()
+        
+        headers = {
+            "Cache-Control": "no-cache",
+            "Connection": "keep-alive",
+            # リバースプロキシにバッファリングさせない
+            "X-Accel-Buffering": "no"
+        }
+        body = generate()
+        if gzip_enabled(request.headers.get("accept-encoding", "")):
+            body = gzip_stream(body)
+            headers["Content-Encoding"] = "gzip"
+            headers["Vary"] = "Accept-Encoding"
         
+        # ストリームが始まる前に切断された場合も枠を返す
         return StreamingResponse(
-            generate(),
-            media_type="text/event-stream",
-            headers={
-                "Cache-Control": "no-cache",
-                "Connection": "keep-alive"
-            }
+            body, media_type="text/event-stream", headers=headers, background=BackgroundTask(slot.release)
         )
         
     except Exception as e:
+        slot.release()
         logger.error(f"ストリーミングチャット処理中にエラー: {str(e)}")
         raise HTTPException(status_code=500, detail=str(e))
 
+@router.post("/chat/prefetch")
+async def chat_prefetch(
+    message: str = Form(...),
+    session_id: Optional[str] = Form(None)
+):
+    """
+    入力中の下書きでRAG検索を先に実行（送信時に /chat・/chat/stream が結果を再利用する）
+    
+    Args:
+        message: 入力中の下書き
+        session_id: セッションID（オプション）
+        
+    Returns:
+        セッションIDと、先読みを開始したかどうか
+    """
+    # 先読みは入力のたびに呼ばれるので、セッションを作らない（会話が始まる前は先読みしない）
+    if not session_id or not session_service.get_session(session_id):
+        return {"session_id": None, "prefetching": False}
+    
+    # 混雑して待ち行列ができている間は、本番のリクエストに埋め込みAPIを譲る
+    if chat_admission.queue_depth or chat_stream_admission.queue_depth:
+        return {"session_id": session_id, "prefetching": False}
+    
+    search_filters = session_service.get_search_filters(session_id)
+    prefetching = retrieval_prefetcher.prefetch(session_id, message, search_filters)
+    return {"session_id": session_id, "prefetching": prefetching}
+
 @router.get("/session/{session_id}")
 async def get_session_info(session_id: str):
     """
@@ -207,6 +271,29 @@ async def get_session_info(session_id: str):
     
     return session_info
 
+@router.put("/session/{session_id}/filters")
+async def update_session_filters(session_id: str, filters: dict):
+    """
+    セッションのRAG検索の絞り込み条件を設定
+    
+    Args:
+        session_id: セッションID
+        filters: メタデータの絞り込み条件（例: {"source": ["manual.pdf"], "file_type": ".pdf"}）
+        
+    Returns:
+        更新結果
+    """
+    try:
+        filters = MetadataIndex.validate_filters(filters)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    
+    success = session_service.update_metadata(session_id, {"search_filters": filters})
+    if not success:
+        raise HTTPException(status_code=404, detail="セッションが見つかりません")
+    
+    return {"message": "検索条件を更新しました", "session_id": session_id, "filters": filters}
+
 @router.delete("/session/{session_id}")
 async def delete_session(session_id: str):
     """
@@ -1,33 +1,74 @@
 """
 文書管理のAPIエンドポイント
 """
-from fastapi import APIRouter, UploadFile, File, HTTPException
+from fastapi import APIRouter, Depends, Request, HTTPException
 from fastapi.responses import JSONResponse
-from typing import List
+from typing import List, Optional
+from datetime import datetime
+import asyncio
 import os
 
 from services.document_service import document_service
-from services.vector_db_service import vector_db_service
+from services.vector_db_service import IndexNotReady, MetadataIndex, vector_db_service
+from services.index_export import SnapshotError, list_bundles
+from services.profiler import phase
+from .admin import require_admin
 
 router = APIRouter()
 
+# multipart のヘッダーや境界文字列の分として許容する余裕
+UPLOAD_OVERHEAD_BYTES = 64 * 1024
+
+
+def index_not_ready(e: IndexNotReady) -> HTTPException:
+    """インデックスの読み込みが完了していない場合の503"""
+    return HTTPException(status_code=503, detail=str(e), headers={"Retry-After": "5"})
+
 
 @router.post("/upload")
-async def upload_document(file: UploadFile = File(...)):
-    """文書をアップロードしてベクトルDBに保存"""
+async def upload_document(
+    request: Request,
+    dedup: Optional[bool] = None,
+    dedup_threshold: Optional[float] = None
+):
+    """
+    文書をアップロードしてベクトルDBに保存（本文はチャンク単位で受信）
+    
+    クエリパラメータ dedup / dedup_threshold で準重複チャンクの検出を指定できる
+    """
     try:
-        # ファイルの検証
-        validation = document_service.validate_file(file.filename, file.size)
-        if not validation['valid']:
-            raise HTTPException(status_code=400, detail=validation['error'])
+        # インデックスの読み込み中は本文を受信する前に断る
+        try:
+            vector_db_service.ensure_loaded()
+        except IndexNotReady as e:
+            raise index_not_ready(e)
+        
+        # Content-Length で上限を明らかに超える場合は本文を読まずに拒否
+        content_length = request.headers.get("content-length")
+        if content_length:
+            try:
+                declared_length = int(content_length)
+            except ValueError:
+                raise HTTPException(status_code=400, detail="Content-Length ヘッダーの値が正しくありません")
+            if declared_length > document_service.max_file_size + UPLOAD_OVERHEAD_BYTES:
+                raise HTTPException(status_code=413, detail=document_service.file_too_large_message())
         
-        # ファイルを一時保存
-        file_content = await file.read()
-        temp_file_path = await document_service.save_uploaded_file(file_content, file.filename)
+        # ファイルを受信しながら一時保存（サイズ確認とハッシュ計算を同時に行う）
+        with phase("receive"):
+            upload = await document_service.spool_upload(request.headers.get("content-type", ""), request.stream())
+        if not upload['valid']:
+            raise HTTPException(status_code=upload['status_code'], detail=upload['error'])
         
         try:
+            # 同じ内容の文書は抽出・埋め込みの前に拒否
+            duplicate = vector_db_service.find_by_content_hash(upload['content_hash'])
+            if duplicate:
+                raise HTTPException(status_code=409, detail=f"同じ内容の文書「{duplicate}」が既に登録されています")
+            
             # 文書を処理してテキストを抽出
-            result = await document_service.process_document(temp_file_path, file.filename)
+            result = await document_service.process_upload(
+                upload['file'], upload['filename'], upload['size'], upload['content_hash']
+            )
             
             if result['status'] == 'error':
                 raise HTTPException(status_code=400, detail=result['error'])
@@ -35,21 +76,25 @@ async def upload_document(file: UploadFile = File(...)):
             # ベクトルDBに保存
             db_result = await vector_db_service.add_document(
                 content=result['text'],
-                metadata=result['metadata']
+                metadata=result['metadata'],
+                dedup=dedup,
+                dedup_threshold=dedup_threshold
             )
             
             if db_result['status'] == 'error':
-                raise HTTPException(status_code=500, detail=db_result['message'])
+                raise HTTPException(status_code=db_result.get('status_code', 500), detail=db_result['message'])
             
             return JSONResponse(content={
                 "status": "success",
-                "message": f"文書「{file.filename}」をアップロードしました",
-                "chunks": db_result['chunks_added']
+                "message": f"文書「{upload['filename']}」をアップロードしました",
+                "chunks": db_result['chunks_added'],
+                "duplicates_skipped": db_result['duplicates_skipped'],
+                "duplicate_sources": db_result['duplicate_sources']
             })
             
         finally:
-            # 一時ファイルをクリーンアップ
-            document_service.cleanup_temp_file(temp_file_path)
+            # 一時領域をクリーンアップ
+            upload['file'].close()
             
     except HTTPException:
         raise
@@ -70,11 +115,12 @@ async def list_documents():
         raise HTTPException(status_code=500, detail=f"一覧取得エラー: {str(e)}")
 
 
-@router.delete("/{document_name}")
+@router.delete("/{document_name:path}")
 async def delete_document(document_name: str):
-    """文書を削除"""
+    """文書を削除（一括取り込みした文書の sub/a.pdf のような / を含む名前も指定できる）"""
     try:
-        success = vector_db_service.delete_document(document_name)
+        # 削除のログ追記（とコンパクション）はスレッドで実行
+        success = await asyncio.to_thread(vector_db_service.delete_document, document_name)
         if success:
             return JSONResponse(content={
                 "status": "success",
@@ -84,6 +130,8 @@ async def delete_document(document_name: str):
             raise HTTPException(status_code=404, detail="文書が見つかりません")
     except HTTPException:
         raise
+    except IndexNotReady as e:
+        raise index_not_ready(e)
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"削除エラー: {str(e)}")
 
@@ -97,8 +145,12 @@ async def search_documents(query: dict):
         
         if not search_query:
             raise HTTPException(status_code=400, detail="検索クエリが必要です")
+        try:
+            filters = MetadataIndex.validate_filters(query.get("filters"))
+        except ValueError as e:
+            raise HTTPException(status_code=400, detail=str(e))
         
-        results = await vector_db_service.search(search_query, n_results)
+        results = await vector_db_service.search(search_query, n_results, filters=filters)
         
         return JSONResponse(content={
             "status": "success",
@@ -110,6 +162,35 @@ async def search_documents(query: dict):
         raise HTTPException(status_code=500, detail=f"検索エラー: {str(e)}")
 
 
+@router.post("/search/batch")
+async def search_documents_batch(query: dict):
+    """複数のクエリをまとめて検索"""
+    try:
+        queries = query.get("queries", [])
+        n_results = query.get("n_results", 5)
+        
+        if not isinstance(queries, list) or not queries or not all(isinstance(q, str) and q for q in queries):
+            raise HTTPException(status_code=400, detail="検索クエリのリストが必要です")
+        try:
+            filters = MetadataIndex.validate_filters(query.get("filters"))
+        except ValueError as e:
+            raise HTTPException(status_code=400, detail=str(e))
+        
+        results = await vector_db_service.search_many(queries, n_results, filters=filters)
+        
+        return JSONResponse(content={
+            "status": "success",
+            "results": [
+                {"query": search_query, "results": query_results}
+                for search_query, query_results in zip(queries, results)
+            ]
+        })
+    except HTTPException:
+        raise
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"検索エラー: {str(e)}")
+
+
 @router.post("/reset")
 async def reset_database():
     """データベースをリセット（開発用）"""
@@ -128,5 +209,81 @@ async def reset_database():
             raise HTTPException(status_code=500, detail="リセットに失敗しました")
     except HTTPException:
         raise
+    except IndexNotReady as e:
+        raise index_not_ready(e)
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"リセットエラー: {str(e)}")
+
+
+def snapshot_path(name: str) -> str:
+    """スナップショット名から置き場所のパスを作る（ディレクトリの外は、シンボリックリンク経由でも指定できない）"""
+    if not isinstance(name, str) or not name or os.path.basename(name) != name or name.startswith("."):
+        raise HTTPException(status_code=400, detail="スナップショット名が正しくありません")
+    snapshot_dir = os.path.realpath(vector_db_service.snapshot_export_dir)
+    path = os.path.realpath(os.path.join(snapshot_dir, name))
+    if os.path.dirname(path) != snapshot_dir:
+        raise HTTPException(status_code=400, detail="スナップショットの置き場所の外は指定できません")
+    return path
+
+
+# スナップショットの一覧・書き出し・取り込みは管理用トークンが必要
+@router.get("/snapshot/list", dependencies=[Depends(require_admin)])
+async def list_snapshots():
+    """書き出し済みのインデックスのスナップショットの一覧を取得"""
+    return JSONResponse(content={
+        "status": "success",
+        "snapshots": list_bundles(vector_db_service.snapshot_export_dir)
+    })
+
+
+@router.post("/snapshot/export", dependencies=[Depends(require_admin)])
+async def export_snapshot(body: Optional[dict] = None):
+    """
+    インデックスを他のノードに複製するためのスナップショットとして書き出す
+    
+    本文の name で名前を指定できる（省略時は世代と日時から作る）。
+    書き出したディレクトリを他のノードの VECTOR_DB_SNAPSHOT_DIR に配置して取り込む
+    """
+    try:
+        name = (body or {}).get("name") or f"gen{vector_db_service.generation:08d}-{datetime.now():%Y%m%d-%H%M%S}"
+        path = snapshot_path(name)
+        manifest = await asyncio.to_thread(vector_db_service.export_snapshot, path)
+        manifest.pop('files', None)
+        return JSONResponse(content={
+            "status": "success",
+            "message": f"スナップショット「{name}」を書き出しました",
+            "snapshot": dict(manifest, name=name)
+        })
+    except HTTPException:
+        raise
+    except SnapshotError as e:
+        raise HTTPException(status_code=409, detail=str(e))
+    except IndexNotReady as e:
+        raise index_not_ready(e)
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"書き出しエラー: {str(e)}")
+
+
+@router.post("/snapshot/import", dependencies=[Depends(require_admin)])
+async def import_snapshot(body: dict):
+    """
+    書き出されたスナップショットを取り込んで現在のインデックスを置き換える
+    
+    チェックサムと、埋め込みのデプロイメント・次元がこのノードと一致することを確認する
+    """
+    try:
+        path = snapshot_path(body.get("name", ""))
+        manifest = await asyncio.to_thread(vector_db_service.import_snapshot, path)
+        return JSONResponse(content={
+            "status": "success",
+            "message": f"{manifest['count']}件のチャンクを取り込みました",
+            "snapshot": manifest
+        })
+    except HTTPException:
+        raise
+    except SnapshotError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    except IndexNotReady as e:
+        raise index_not_ready(e)
     except Exception as e:
-        raise HTTPException(status_code=500, detail=f"リセットエラー: {str(e)}")
\ No newline at end of file
+        raise HTTPException(status_code=500, detail=f"取り込みエラー: {str(e)}")
@@ -0,0 +1,43 @@
+"""
+プロファイラの結果を返す管理用エンドポイント（プロファイラが有効な場合のみ登録し、管理用トークンが必要）
+"""
+from fastapi import APIRouter, Depends, HTTPException
+from fastapi.responses import PlainTextResponse
+from typing import Optional
+
+from services.profiler import request_profiler
+from .admin import require_admin
+
+router = APIRouter(dependencies=[Depends(require_admin)])
+
+
+@router.get("/profiles")
+async def list_profiles():
+    """プロファイラの設定と、スタックを採取した直近のリクエスト・最も遅かったリクエストの一覧"""
+    return {
+        "profiler": request_profiler.status(),
+        "recent": request_profiler.recent(),
+        "slowest": request_profiler.slowest()
+    }
+
+
+@router.get("/profiles/slowest")
+async def slowest_requests(n: Optional[int] = None):
+    """直近の期間（PROFILER_WINDOW_SECONDS）で最も遅かった n 件のリクエストと段階別の内訳"""
+    return {"slowest": request_profiler.slowest(n)}
+
+
+@router.get("/profiles/{profile_id}")
+async def get_profile(profile_id: str, format: str = "folded"):
+    """
+    採取したスタックを取得
+    
+    format=folded（既定）は flamegraph.pl や speedscope でそのまま読める形式、json は内訳とスタックの辞書
+    """
+    profile = request_profiler.get(profile_id)
+    if profile is None:
+        raise HTTPException(status_code=404, detail="プロファイルが見つかりません（古いものは破棄されます）")
+    
+    if format == "json":
+        return dict(profile.summary(), stacks=dict(profile.stacks))
+    return PlainTextResponse(profile.folded())
@@ -0,0 +1,141 @@
+"""
+ストリーミング応答の送信ヘルパー（Server-Sent Events / WebSocket 共通）
+
+モデルの差分（日本語では1文字ずつのことも多い）をそのまま1イベントずつ送ると、
+内容よりもJSONの枠組みとシステムコールの方が重くなる。ここでは差分を
+サイズまたは時間の窓でまとめて送り、無通信の間はハートビートを送る。
+"""
+import os
+import json
+import zlib
+import asyncio
+from typing import AsyncIterator, Dict, List, Optional
+
+
+def sse_event(payload: Dict) -> str:
+    """ペイロードをSSEのイベントに変換"""
+    return f"data: {json.dumps(payload, ensure_ascii=False)}\n\n"
+
+
+class DeltaCoalescer:
+    """モデルの差分をまとめてSSEのchunkイベントにする"""
+
+    def __init__(
+        self,
+        flush_chars: Optional[int] = None,
+        flush_interval: Optional[float] = None,
+        heartbeat_interval: Optional[float] = None
+    ):
+        """
+        Args:
+            flush_chars: この文字数たまったら送る
+            flush_interval: 最初の差分からこの秒数たったら送る
+            heartbeat_interval: この秒数何も送らなければハートビートのコメントを送る
+        """
+        # 0 を明示した場合（差分ごとに送るなど）も指定として扱う
+        self.flush_chars = flush_chars if flush_chars is not None else int(os.getenv("SSE_FLUSH_CHARS", "64"))
+        self.flush_interval = (
+            flush_interval if flush_interval is not None else int(os.getenv("SSE_FLUSH_INTERVAL_MS", "30")) / 1000
+        )
+        self.heartbeat_interval = (
+            heartbeat_interval if heartbeat_interval is not None else float(os.getenv("SSE_HEARTBEAT_SECONDS", "15"))
+        )
+
+        self._parts: List[str] = []
+
+    @property
+    def text(self) -> str:
+        """ここまでに受け取った応答の全文"""
+        return "".join(self._parts)
+
+    async def batches(self, deltas: AsyncIterator[str]) -> AsyncIterator[Optional[str]]:
+        """
+        差分のストリームをまとめたテキストのストリームに変換
+
+        Yields:
+            まとめた差分のテキスト。heartbeat_interval の間何も無ければNone
+        """
+        loop = asyncio.get_running_loop()
+        iterator = deltas.__aiter__()
+        pending: List[str] = []
+        pending_chars = 0
+        first_pending_at: Optional[float] = None
+        last_sent = loop.time()
+        next_delta: Optional[asyncio.Future] = None
+
+        try:
+            while True:
+                if next_delta is None:
+                    next_delta = asyncio.ensure_future(iterator.__anext__())
+
+                # 次の送信期限（まとめ送りの窓、またはハートビート）まで差分を待つ
+                deadline = first_pending_at + self.flush_interval if pending else last_sent + self.heartbeat_interval
+                done, _ = await asyncio.wait({next_delta}, timeout=max(0.0, deadline - loop.time()))
+
+                if next_delta in done:
+                    task, next_delta = next_delta, None
+                    try:
+                        delta = task.result()
+                    except StopAsyncIteration:
+                        break
+                    if not delta:
+                        continue
+
+                    self._parts.append(delta)
+                    pending.append(delta)
+                    pending_chars += len(delta)
+                    if first_pending_at is None:
+                        first_pending_at = loop.time()
+                    if pending_chars < self.flush_chars and loop.time() - first_pending_at < self.flush_interval:
+                        continue
+
+                if pending:
+                    yield "".join(pending)
+                    pending.clear()
+                    pending_chars = 0
+                    first_pending_at = None
+                else:
+                    yield None
+                last_sent = loop.time()
+
+            if pending:
+                yield "".join(pending)
+        finally:
+            # 読み出し中の差分を取り消し、元のストリームが後始末を終えるまで待つ
+            if next_delta is not None:
+                next_delta.cancel()
+                try:
+                    await next_delta
+                except (asyncio.CancelledError, StopAsyncIteration, Exception):
+                    pass
+
+    async def events(self, deltas: AsyncIterator[str]) -> AsyncIterator[str]:
+        """
+        差分のストリームをまとめたSSEイベントのストリームに変換
+
+        Yields:
+            chunkイベント、またはハートビートのコメント
+        """
+        batches = self.batches(deltas)
+        try:
+            async for text in batches:
+                yield ": ping\n\n" if text is None else sse_event({'type': 'chunk', 'content': text})
+        finally:
+            await batches.aclose()
+
+
+async def gzip_stream(events: AsyncIterator[str]) -> AsyncIterator[bytes]:
+    """
+    SSEのストリームをgzipで圧縮（イベントごとにフラッシュして遅延を増やさない）
+    """
+    compressor = zlib.compressobj(wbits=31)
+    async for event in events:
+        yield compressor.compress(event.encode('utf-8')) + compressor.flush(zlib.Z_SYNC_FLUSH)
+    yield compressor.flush()
+
+
+def gzip_enabled(accept_encoding: str) -> bool:
+    """このストリームをgzipで送るか（SSE_GZIP が有効かつクライアントが対応している場合）"""
+    if os.getenv("SSE_GZIP", "false").lower() != "true":
+        return False
+    return "gzip" in accept_encoding.lower()
@@ -0,0 +1,228 @@
+"""
+WebSocket によるチャット（1接続で複数の会話をセッションIDで多重化）
+
+クライアント → サーバー（JSONテキスト）:
+    {"type": "chat", "session_id": "...", "message": "...", "ref": "..."}
+        session_id を省略（または無効なIDを指定）すると新しいセッションを作成する。
+        ref は任意の値で、session イベントにそのまま返す。
+    {"type": "cancel", "session_id": "..."}
+        生成中の応答を打ち切る（それまでの応答は履歴に保存する）。
+
+サーバー → クライアント:
+    JSONテキスト: session / sources / done / cancelled / error
+        session イベントで会話ごとのチャンネル番号を通知する。
+        混雑で受け付けなかった場合の error イベントには retry_after（秒）を付ける。
+    バイナリ: 先頭2バイトがチャンネル番号（ビッグエンディアン）、残りがUTF-8の応答テキスト
+"""
+import os
+import json
+import struct
+import asyncio
+import logging
+from typing import Dict, Optional, Union
+
+from fastapi import APIRouter, WebSocket, WebSocketDisconnect
+
+from services.admission import AdmissionRejected, chat_stream_admission
+from services.openai_service import openai_service
+from services.profiler import phase
+from services.session_service import session_service
+from .chat import retrieve_context
+from .sse import DeltaCoalescer
+
+# ロガーの設定
+logger = logging.getLogger(__name__)
+
+# ルーターの初期化
+router = APIRouter()
+
+# 応答テキストのバイナリフレームの先頭に付けるチャンネル番号
+CHANNEL_HEADER = struct.Struct(">H")
+MAX_CHANNEL = 0xFFFF
+
+
+class ChatConnection:
+    """1つのWebSocket接続上の会話を管理する"""
+
+    def __init__(self, websocket: WebSocket, send_buffer_frames: Optional[int] = None, max_streams: Optional[int] = None):
+        """
+        Args:
+            websocket: 受け付け済みのWebSocket
+            send_buffer_frames: 送信待ちにできる応答テキストのフレーム数（超えると生成側を待たせる）
+            max_streams: この接続で同時に生成できる応答の数
+        """
+        self.websocket = websocket
+        self.max_streams = max_streams or int(os.getenv("WS_MAX_STREAMS", "4"))
+
+        # 送信は1つのタスクにまとめる。応答テキストは送信枠（バックプレッシャー）を取ってから積み、
+        # 制御イベントは枠を使わないので、送信が詰まっていても cancel などの応答は遅れない
+        self._outgoing: asyncio.Queue = asyncio.Queue()
+        self._send_credits = asyncio.Semaphore(send_buffer_frames or int(os.getenv("WS_SEND_BUFFER_FRAMES", "32")))
+
+        self._channels: Dict[str, int] = {}  # セッションID -> チャンネル番号
+        self._next_channel = 1
+        self._generations: Dict[str, asyncio.Task] = {}  # セッションID -> 生成中のタスク
+
+    def _send_event(self, payload: Dict) -> None:
+        """制御イベントを送信キューに積む"""
+        self._outgoing.put_nowait(payload)
+
+    async def _send_text(self, channel: int, text: str) -> None:
+        """応答テキストを送信キューに積む（送信が追いつくまで待つ）"""
+        await self._send_credits.acquire()
+        self._outgoing.put_nowait(CHANNEL_HEADER.pack(channel) + text.encode('utf-8'))
+
+    async def _writer(self) -> None:
+        """送信キューのフレームを順に送る"""
+        while True:
+            frame: Union[bytes, Dict] = await self._outgoing.get()
+            if isinstance(frame, bytes):
+                await self.websocket.send_bytes(frame)
+                self._send_credits.release()
+            else:
+                await self.websocket.send_text(json.dumps(frame, ensure_ascii=False))
+
+    async def run(self) -> None:
+        """接続が閉じるまでメッセージを処理"""
+        writer = asyncio.create_task(self._writer())
+        try:
+            while True:
+                try:
+                    data = await self.websocket.receive_json()
+                except WebSocketDisconnect:
+                    break
+                except (ValueError, KeyError):
+                    self._send_event({'type': 'error', 'message': 'JSONテキストのメッセージを送信してください'})
+                    continue
+
+                if not isinstance(data, dict):
+                    self._send_event({'type': 'error', 'message': 'メッセージの形式が正しくありません'})
+                elif not isinstance(data.get('session_id'), (str, type(None))):
+                    # 辞書のキーに使う前に弾く（ハッシュできない値で接続ごと落ちないように）
+                    self._send_event({'type': 'error', 'message': 'session_id は文字列で指定してください'})
+                elif data.get('type') == 'chat':
+                    self._start_chat(data)
+                elif data.get('type') == 'cancel':
+                    self._cancel(data.get('session_id'))
+                else:
+                    self._send_event({'type': 'error', 'message': f"不明なメッセージ種別です: {data.get('type')}"})
+        finally:
+            # 接続が切れたら生成中の応答を止める
+            generations = list(self._generations.values())
+            for task in generations:
+                task.cancel()
+            await asyncio.gather(*generations, return_exceptions=True)
+            writer.cancel()
+            await asyncio.gather(writer, return_exceptions=True)
+
+    def _start_chat(self, data: Dict) -> None:
+        """会話のメッセージを受け付けて応答の生成を開始"""
+        message = data.get('message')
+        if not isinstance(message, str) or not message.strip():
+            self._send_event({'type': 'error', 'session_id': data.get('session_id'), 'message': 'メッセージが空です'})
+            return
+
+        # この接続で初めての会話だけセッションを検証し、チャンネル番号を割り当てる
+        session_id = data.get('session_id')
+        if session_id not in self._channels:
+            if self._next_channel > MAX_CHANNEL:
+                self._send_event({'type': 'error', 'message': 'この接続で扱える会話数の上限に達しました'})
+                return
+            if not session_id or not session_service.get_session(session_id):
+                session_id = session_service.create_session()
+            self._channels[session_id] = self._next_channel
+            self._next_channel += 1
+            self._send_event({
+                'type': 'session',
+                'session_id': session_id,
+                'channel': self._channels[session_id],
+                'ref': data.get('ref')
+            })
+
+        if session_id in self._generations:
+            self._send_event({'type': 'error', 'session_id': session_id, 'message': 'この会話は応答を生成中です'})
+            return
+        if len(self._generations) >= self.max_streams:
+            self._send_event({'type': 'error', 'session_id': session_id, 'message': '同時に生成できる応答数の上限に達しました'})
+            return
+
+        self._generations[session_id] = asyncio.create_task(
+            self._generate(session_id, self._channels[session_id], message)
+        )
+
+    def _cancel(self, session_id: Optional[str]) -> None:
+        """生成中の応答を打ち切る"""
+        task = self._generations.get(session_id)
+        if task is None:
+            self._send_event({'type': 'error', 'session_id': session_id, 'message': '生成中の応答がありません'})
+            return
+        task.cancel()
+
+    async def _generate(self, session_id: str, channel: int, message: str) -> None:
+        """応答を生成してチャンネルに送信"""
+        coalescer = DeltaCoalescer()
+        slot = None
+        try:
+            # HTTPのストリーミングと同じ受付制御を通す（混雑時は優先度順に待ち、待ちきれなければ断る）
+            session = session_service.get_session(session_id)
+            with phase("admission"):
+                try:
+                    slot = await chat_stream_admission.acquire(
+                        session_id if session else None,
+                        in_progress=bool(session and session["messages"]),
+                        prompt_chars=len(message)
+                    )
+                except AdmissionRejected as e:
+                    self._send_event({
+                        'type': 'error', 'session_id': session_id, 'message': str(e), 'retry_after': e.retry_after
+                    })
+                    return
+
+            if not session_service.add_message(session_id, "user", message):
+                # 接続中にセッションが期限切れになった場合は、新しい会話として送り直してもらう
+                self._channels.pop(session_id, None)
+                self._send_event({'type': 'error', 'session_id': session_id, 'message': 'セッションが見つかりません'})
+                return
+
+            messages = session_service.get_messages(session_id, limit=20)
+            context, sources = await retrieve_context(session_id, message)
+            if sources:
+                self._send_event({'type': 'sources', 'session_id': session_id, 'sources': sources})
+
+            # 差分はまとめてから送り、送信が詰まればモデルからの読み出しも待たせる
+            batches = coalescer.batches(openai_service.get_streaming_response(messages, context=context))
+            try:
+                async for text in batches:
+                    if text:
+                        await self._send_text(channel, text)
+            finally:
+                await batches.aclose()
+
+            session_service.add_message(session_id, "assistant", coalescer.text)
+            self._send_event({'type': 'done', 'session_id': session_id})
+
+        except asyncio.CancelledError:
+            # 打ち切られた場合もそれまでの応答は履歴に残す
+            if coalescer.text:
+                session_service.add_message(session_id, "assistant", coalescer.text)
+            self._send_event({'type': 'cancelled', 'session_id': session_id})
+            raise
+        except Exception as e:
+            logger.error(f"WebSocketチャットの応答生成中にエラー: {str(e)}")
+            self._send_event({'type': 'error', 'session_id': session_id, 'message': str(e)})
+        finally:
+            if slot is not None:
+                slot.release()
+            self._generations.pop(session_id, None)
+
+
+@router.websocket("/ws/chat")
+async def chat_websocket(websocket: WebSocket):
+    """
+    WebSocketチャットエンドポイント（プロトコルはモジュールのdocstringを参照）
+
+    Args:
+        websocket: WebSocket接続
+    """
+    await websocket.accept()
+    await ChatConnection(websocket).run()
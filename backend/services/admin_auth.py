@@ -0,0 +1,32 @@
+"""
+管理用エンドポイント（スナップショットの書き出し・取り込み、プロファイラ）の認証
+
+ADMIN_TOKEN に設定したトークンを X-Admin-Token ヘッダー（ADMIN_TOKEN_HEADER で変更可能）で
+送ったリクエストだけを管理者として扱う。ADMIN_TOKEN が未設定なら管理用の操作は使えない。
+"""
+import hmac
+import os
+from typing import Optional
+
+
+class AdminAuth:
+    """管理用トークンの照合"""
+
+    def __init__(self):
+        self.token = os.getenv("ADMIN_TOKEN", "")
+        self.header = os.getenv("ADMIN_TOKEN_HEADER", "X-Admin-Token")
+
+    @property
+    def enabled(self) -> bool:
+        """管理用トークンが設定されているか"""
+        return bool(self.token)
+
+    def verify(self, token: Optional[str]) -> bool:
+        """送られたトークンが管理用トークンと一致するか（比較時間から推測されないよう定数時間で比較）"""
+        if not self.enabled or token is None:
+            return False
+        return hmac.compare_digest(token.encode('utf-8'), self.token.encode('utf-8'))
+
+
+# シングルトンインスタンス
+admin_auth = AdminAuth()
@@ -0,0 +1,218 @@
+"""
+チャットエンドポイントの受付制御（同時実行数の上限・優先度付きの待ち行列・負荷遮断）
+
+混雑時にすべてのリクエストを受け付けると、埋め込み・検索・LLM呼び出しが一斉に走って
+全員の応答が遅くなる。エンドポイントごとに同時実行数を制限し、超えた分は優先度順に待たせる。
+
+優先度（小さいほど先）:
+    1. そのセッションで実行中・待機中のリクエスト数（1セッションが枠を占有しないよう公平に配分）
+    2. 会話の途中か（履歴のあるセッションを新しい会話より優先）
+    3. プロンプトの長さ（短いものを優先）
+同じ優先度なら到着順。
+
+待ち行列に入れる時点で見込み待ち時間（前に並ぶ数 x 平均処理時間 / 同時実行数）が SLO を
+超える場合や、待ち行列が満杯で自分より優先度の低い待機者がいない場合は、待たせずに
+Retry-After 付きで断る。
+"""
+import asyncio
+import heapq
+import itertools
+import math
+import os
+import time
+from collections import defaultdict
+from typing import Dict, List, Optional
+
+
+class AdmissionRejected(Exception):
+    """混雑のためリクエストを受け付けなかった"""
+
+    def __init__(self, message: str, retry_after: int):
+        super().__init__(message)
+        self.retry_after = retry_after
+
+
+class AdmissionSlot:
+    """実行枠（処理が終わったら release する。複数回呼んでもよい）"""
+
+    def __init__(self, controller: 'AdmissionController', session_id: Optional[str]):
+        self.controller = controller
+        self.session_id = session_id
+        self.started_at = time.monotonic()
+        self.released = False
+
+    def release(self):
+        if not self.released:
+            self.released = True
+            self.controller._release(self)
+
+
+class AdmissionController:
+    """1つのエンドポイントの受付制御（イベントループ上でのみ使う）"""
+
+    # プロンプトの長さによる優先度の刻み（文字数）と段階数
+    PROMPT_BUCKET_CHARS = 500
+    PROMPT_BUCKETS = 8
+
+    def __init__(
+        self,
+        name: str,
+        max_concurrency: int,
+        max_queue: int = 100,
+        slo_seconds: float = 10.0,
+        initial_service_seconds: float = 2.0,
+        ewma_alpha: float = 0.2
+    ):
+        """
+        Args:
+            name: エンドポイント名（状態の表示用）
+            max_concurrency: 同時に実行するリクエスト数
+            max_queue: 待ち行列の最大長
+            slo_seconds: 待ち時間の上限の目安（見込みがこれを超えたら断る）
+            initial_service_seconds: 実測がない間に使う1リクエストの処理時間
+            ewma_alpha: 処理時間の指数移動平均の重み
+        """
+        self.name = name
+        self.max_concurrency = max(1, max_concurrency)
+        self.max_queue = max_queue
+        self.slo_seconds = slo_seconds
+        self.service_seconds = initial_service_seconds
+        self.ewma_alpha = ewma_alpha
+
+        self._active = 0
+        self._waiters: List[list] = []  # [優先度, 到着順, Future, セッションID] のヒープ
+        self._sequence = itertools.count()
+        self._session_load: Dict[str, int] = defaultdict(int)  # セッションごとの実行中 + 待機中の数
+
+        self.admitted = 0
+        self.queued = 0
+        self.shed = {'slo': 0, 'queue_full': 0, 'evicted': 0}
+
+    @property
+    def queue_depth(self) -> int:
+        """待機中のリクエスト数"""
+        return len(self._waiters)
+
+    def estimated_wait(self, ahead: int) -> float:
+        """前に ahead 件並んでいるときの見込み待ち時間（秒）"""
+        return (ahead + 1) * self.service_seconds / self.max_concurrency
+
+    def _priority(self, session_id: Optional[str], in_progress: bool, prompt_chars: int) -> tuple:
+        load = self._session_load.get(session_id, 0) if session_id else 0
+        bucket = min(prompt_chars // self.PROMPT_BUCKET_CHARS, self.PROMPT_BUCKETS - 1)
+        return (load, 0 if in_progress else 1, bucket)
+
+    def _reject(self, reason: str, wait: float) -> AdmissionRejected:
+        self.shed[reason] += 1
+        return AdmissionRejected(
+            "混雑しています。しばらくしてから再度お試しください",
+            retry_after=max(1, math.ceil(wait))
+        )
+
+    async def acquire(self, session_id: Optional[str], in_progress: bool, prompt_chars: int) -> AdmissionSlot:
+        """
+        実行枠を取得（空きがなければ優先度順に待つ）
+
+        Args:
+            session_id: セッションID（新しい会話ならNone）
+            in_progress: 履歴のある会話の続きか
+            prompt_chars: プロンプトの文字数
+
+        Raises:
+            AdmissionRejected: 見込み待ち時間が SLO を超える、または待ち行列が満杯の場合
+        """
+        if self._active < self.max_concurrency and not self._waiters:
+            return self._grant(session_id)
+
+        priority = self._priority(session_id, in_progress, prompt_chars)
+        ahead = sum(1 for waiter in self._waiters if waiter[0] <= priority)
+        wait = self.estimated_wait(ahead)
+        if wait > self.slo_seconds:
+            raise self._reject('slo', wait)
+
+        if len(self._waiters) >= self.max_queue:
+            # 自分より優先度の低い待機者がいれば、その中で最も低いものを断って入れ替える
+            lowest = max(self._waiters)
+            if lowest[0] <= priority:
+                raise self._reject('queue_full', self.estimated_wait(len(self._waiters)))
+            self._remove_waiter(lowest)
+            if not lowest[2].done():
+                lowest[2].set_exception(self._reject('evicted', self.estimated_wait(len(self._waiters))))
+
+        future = asyncio.get_running_loop().create_future()
+        waiter = [priority, next(self._sequence), future, session_id]
+        heapq.heappush(self._waiters, waiter)
+        if session_id:
+            self._session_load[session_id] += 1
+        self.queued += 1
+
+        try:
+            return await future
+        except asyncio.CancelledError:
+            # 待機中に切断された場合。枠を受け取った直後なら返す
+            if future.done() and not future.cancelled() and future.exception() is None:
+                future.result().release()
+            elif waiter in self._waiters:
+                self._remove_waiter(waiter)
+            raise
+
+    def _grant(self, session_id: Optional[str]) -> AdmissionSlot:
+        self._active += 1
+        self.admitted += 1
+        if session_id:
+            self._session_load[session_id] += 1
+        return AdmissionSlot(self, session_id)
+
+    def _remove_waiter(self, waiter: list):
+        self._waiters.remove(waiter)
+        heapq.heapify(self._waiters)
+        self._forget_session(waiter[3])
+
+    def _forget_session(self, session_id: Optional[str]):
+        if session_id:
+            self._session_load[session_id] -= 1
+            if self._session_load[session_id] <= 0:
+                del self._session_load[session_id]
+
+    def _release(self, slot: AdmissionSlot):
+        self._active -= 1
+        self._forget_session(slot.session_id)
+        elapsed = time.monotonic() - slot.started_at
+        self.service_seconds += self.ewma_alpha * (elapsed - self.service_seconds)
+
+        # 空いた枠を優先度の高い待機者に渡す
+        while self._waiters and self._active < self.max_concurrency:
+            _, _, future, session_id = heapq.heappop(self._waiters)
+            self._forget_session(session_id)
+            if future.done():
+                continue
+            future.set_result(self._grant(session_id))
+
+    def status(self) -> Dict:
+        """キューの深さ・遮断数などの状態"""
+        return {
+            'active': self._active,
+            'max_concurrency': self.max_concurrency,
+            'queue_depth': self.queue_depth,
+            'max_queue': self.max_queue,
+            'estimated_wait_seconds': round(self.estimated_wait(len(self._waiters)), 3) if self._waiters else 0.0,
+            'slo_seconds': self.slo_seconds,
+            'service_seconds_ewma': round(self.service_seconds, 3),
+            'admitted': self.admitted,
+            'queued': self.queued,
+            'shed': dict(self.shed)
+        }
+
+
+def _from_env(name: str, concurrency_env: str, default_concurrency: int) -> AdmissionController:
+    return AdmissionController(
+        name,
+        max_concurrency=int(os.getenv(concurrency_env, str(default_concurrency))),
+        max_queue=int(os.getenv("ADMISSION_MAX_QUEUE", "100")),
+        slo_seconds=float(os.getenv("ADMISSION_SLO_SECONDS", "10"))
+    )
+
+
+# シングルトンインスタンス（エンドポイントごと）
+chat_admission = _from_env("chat", "CHAT_MAX_CONCURRENCY", 16)
+chat_stream_admission = _from_env("chat_stream", "CHAT_STREAM_MAX_CONCURRENCY", 32)
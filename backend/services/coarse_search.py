@@ -0,0 +1,108 @@
+"""
+次元を落とした埋め込みによる粗い検索（2段階検索の1段目）
+
+全行を低次元のベクトルで粗くスコア付けして候補を絞り、候補だけを元の次元で
+正確にスコア付けし直す。低次元化の方法は2つ:
+
+- prefix: 先頭の次元だけを使う。text-embedding-3-* は Matryoshka 学習により
+  先頭の次元に情報が集まっているため、切り詰めても順位がほぼ保たれる。
+- pca: 主成分への射影。先頭を切り詰められない text-embedding-ada-002 向け。
+  内積を保つよう平均を引かずに（原点まわりで）主成分を求める。
+"""
+from typing import List, Optional
+
+import numpy as np
+
+
+def _normalize(vectors: np.ndarray) -> np.ndarray:
+    """行ごとにL2正規化（長さ0の行は0のまま）"""
+    vectors = np.asarray(vectors, dtype=np.float32)
+    norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+    norms[norms == 0] = 1.0
+    return vectors / norms
+
+
+class PrefixReducer:
+    """先頭 dims 次元に切り詰めて正規化する（Matryoshka 埋め込み向け）"""
+
+    method = "prefix"
+
+    def __init__(self, dims: int):
+        self.dims = dims
+
+    def transform(self, embeddings: np.ndarray) -> np.ndarray:
+        """埋め込みを粗い検索用のベクトルに変換（内積がコサイン類似度の近似になる）"""
+        return _normalize(np.asarray(embeddings)[:, :self.dims])
+
+
+class PCAReducer:
+    """正規化した埋め込みを主成分に射影する"""
+
+    method = "pca"
+
+    def __init__(self, components: np.ndarray):
+        """
+        Args:
+            components: (dims, 元の次元) の主成分
+        """
+        self.components = components.astype(np.float32)
+        self.dims = len(components)
+
+    @classmethod
+    def fit(cls, samples: np.ndarray, dims: int) -> 'PCAReducer':
+        """
+        サンプルから主成分を求める
+
+        Args:
+            samples: 埋め込みのサンプル
+            dims: 残す次元数
+        """
+        normalized = _normalize(samples).astype(np.float64)
+        # 次元数×次元数の行列の固有値分解なので、サンプル数が多くても軽い
+        eigenvalues, eigenvectors = np.linalg.eigh(normalized.T @ normalized)
+        order = np.argsort(eigenvalues)[::-1][:dims]
+        return cls(eigenvectors[:, order].T)
+
+    def transform(self, embeddings: np.ndarray) -> np.ndarray:
+        """埋め込みを粗い検索用のベクトルに変換（内積がコサイン類似度の近似になる）"""
+        return _normalize(embeddings) @ self.components.T
+
+
+def build_reducer(method: str, dims: int, blocks: List[np.ndarray], sample_size: int = 8192, seed: int = 0):
+    """
+    粗い検索に使う低次元化を作成
+
+    Args:
+        method: "prefix" または "pca"
+        dims: 低次元化後の次元数
+        blocks: 埋め込み行列のリスト（pca の学習に使う）
+        sample_size: pca の学習に使う最大行数
+        seed: サンプリングの乱数シード（ワーカー間で同じ結果にするため固定）
+
+    Returns:
+        PrefixReducer / PCAReducer。次元数が足りないなど使えない場合はNone
+    """
+    blocks = [block for block in blocks if len(block)]
+    if not blocks or dims <= 0 or dims >= blocks[0].shape[1]:
+        return None
+    if method == "prefix":
+        return PrefixReducer(dims)
+
+    total = sum(len(block) for block in blocks)
+    if total < dims:
+        return None
+    rows = np.sort(np.random.default_rng(seed).choice(total, size=min(sample_size, total), replace=False))
+    samples, offset = [], 0
+    for block in blocks:
+        start, end = np.searchsorted(rows, [offset, offset + len(block)])
+        if end > start:
+            samples.append(np.asarray(block[rows[start:end] - offset]))
+        offset += len(block)
+    return PCAReducer.fit(np.concatenate(samples), dims)
+
+
+def coarse_method(method: str, embedding_deployment: Optional[str]) -> str:
+    """auto の場合はデプロイメント名から低次元化の方法を決める"""
+    if method != "auto":
+        return method
+    return "prefix" if embedding_deployment and "text-embedding-3" in embedding_deployment else "pca"
@@ -0,0 +1,207 @@
+"""
+RAGのプロンプトに入れるコンテキストの組み立て
+
+検索で多めに取得した候補から、同じ文書の隣接チャンクを結合して重なりを除き、
+MMR（関連度と多様性のバランス）で選びながらトークン予算いっぱいまで詰める。
+"""
+import os
+import math
+from typing import Dict, List, Optional, Tuple
+
+from .near_duplicate import MinHasher
+
+try:
+    import tiktoken
+except ImportError:  # tiktoken が無い場合は文字種から概算する
+    tiktoken = None
+
+
+class TokenCounter:
+    """プロンプトのトークン数を数える"""
+
+    def __init__(self, encoding_name: str = "cl100k_base"):
+        self.encoding_name = encoding_name
+        self._encoding = None
+        self._loaded = False
+
+    def _get_encoding(self):
+        """tiktoken のエンコーディング（初回利用時に読み込む。使えなければNone）"""
+        if not self._loaded:
+            self._loaded = True
+            if tiktoken is not None:
+                try:
+                    self._encoding = tiktoken.get_encoding(self.encoding_name)
+                except Exception:
+                    self._encoding = None
+        return self._encoding
+
+    def count(self, text: str) -> int:
+        """テキストのトークン数（tiktoken が無い場合は多めに見積もる）"""
+        encoding = self._get_encoding()
+        if encoding is not None:
+            return len(encoding.encode(text))
+        # 日本語などの非ASCII文字は1文字1トークン、ASCIIは4文字1トークンで概算
+        ascii_chars = sum(1 for char in text if ord(char) < 128)
+        return (len(text) - ascii_chars) + math.ceil(ascii_chars / 4)
+
+    def truncate(self, text: str, max_tokens: int) -> str:
+        """max_tokens に収まるよう末尾を切り詰める"""
+        encoding = self._get_encoding()
+        if encoding is not None:
+            return encoding.decode(encoding.encode(text)[:max_tokens])
+        # 収まる最長の先頭部分を二分探索
+        low, high = 0, len(text)
+        while low < high:
+            middle = (low + high + 1) // 2
+            if self.count(text[:middle]) <= max_tokens:
+                low = middle
+            else:
+                high = middle - 1
+        return text[:low]
+
+
+def _strip_overlap(previous: str, following: str, max_overlap: int) -> str:
+    """following の先頭のうち previous の末尾と重なる部分を取り除く"""
+    limit = min(len(previous), len(following), max_overlap)
+    for size in range(limit, 0, -1):
+        if previous.endswith(following[:size]):
+            return following[size:]
+    return following
+
+
+class ContextBuilder:
+    """検索結果からトークン予算内のコンテキストを組み立てる"""
+
+    def __init__(
+        self,
+        token_budget: Optional[int] = None,
+        candidates: Optional[int] = None,
+        diversity: float = 0.3,
+        max_overlap: int = 400,
+        min_fill_tokens: int = 64
+    ):
+        """
+        Args:
+            token_budget: コンテキストに使う最大トークン数
+            candidates: 検索で取得する候補チャンク数
+            diversity: MMRで多様性に与える重み（0なら関連度のみ）
+            max_overlap: 隣接チャンクの重なりとして探す最大文字数
+            min_fill_tokens: 予算の残りがこれ以上あれば、入りきらないパッセージを切り詰めて詰める
+        """
+        self.token_budget = token_budget or int(os.getenv("RAG_CONTEXT_TOKEN_BUDGET", "1500"))
+        self.candidates = candidates or int(os.getenv("RAG_CANDIDATES", "8"))
+        self.diversity = diversity
+        self.max_overlap = max_overlap
+        self.min_fill_tokens = min_fill_tokens
+        self.separator = "\n\n"
+
+        self.token_counter = TokenCounter()
+        self._hasher = MinHasher()
+
+    def merge_adjacent(self, results: List[Dict]) -> List[Dict]:
+        """
+        同じ文書の連続するチャンクを1つのパッセージに結合
+
+        Returns:
+            content / source / score（結合したチャンクの最大値）/ chunk_indexes を持つパッセージのリスト
+        """
+        by_source: Dict[str, List[Dict]] = {}
+        for result in results:
+            source = result['metadata'].get('source', 'Unknown')
+            by_source.setdefault(source, []).append(result)
+
+        passages = []
+        for source, chunks in by_source.items():
+            chunks.sort(key=lambda result: result['metadata'].get('chunk_index', 0))
+            current = None
+            for chunk in chunks:
+                index = chunk['metadata'].get('chunk_index')
+                if current is not None and index is not None and index == current['chunk_indexes'][-1] + 1:
+                    current['content'] += self.separator + _strip_overlap(
+                        current['content'], chunk['content'], self.max_overlap
+                    )
+                    current['chunk_indexes'].append(index)
+                    current['score'] = max(current['score'], chunk['score'])
+                    continue
+
+                if current is not None:
+                    passages.append(current)
+                current = {
+                    'content': chunk['content'],
+                    'source': source,
+                    'score': chunk['score'],
+                    'chunk_indexes': [index if index is not None else -1]
+                }
+            if current is not None:
+                passages.append(current)
+        return passages
+
+    def build(self, results: List[Dict], token_budget: Optional[int] = None) -> Tuple[str, List[str]]:
+        """
+        検索結果からコンテキストを組み立てる
+
+        Args:
+            results: search() の結果（関連度の高い順）
+            token_budget: このリクエストでのトークン予算（Noneなら既定値）
+
+        Returns:
+            (コンテキスト文字列, 参照したソースのリスト)
+        """
+        budget = token_budget or self.token_budget
+
+        # 完全に同じ内容のチャンクは関連度の高い方だけ残してから隣接チャンクを結合
+        unique: Dict[str, Dict] = {}
+        for result in results:
+            existing = unique.get(result['content'])
+            if existing is None or result['score'] > existing['score']:
+                unique[result['content']] = result
+        passages = self.merge_adjacent(list(unique.values()))
+
+        for passage in passages:
+            passage['tokens'] = self.token_counter.count(passage['content'])
+            passage['signature'] = self._hasher.signature(passage['content'])
+
+        # MMR: 関連度から、選択済みのパッセージとの類似度を差し引いて貪欲に選ぶ
+        selected: List[Dict] = []
+        used_tokens = 0
+        separator_tokens = self.token_counter.count(self.separator)
+        remaining = sorted(passages, key=lambda passage: passage['score'], reverse=True)
+        while remaining:
+            best_index, best_value = None, None
+            for i, passage in enumerate(remaining):
+                cost = passage['tokens'] + (separator_tokens if selected else 0)
+                if used_tokens + cost > budget:
+                    continue
+                redundancy = max(
+                    (self._hasher.similarity(passage['signature'], chosen['signature']) for chosen in selected),
+                    default=0.0
+                )
+                value = (1 - self.diversity) * passage['score'] - self.diversity * redundancy
+                if best_value is None or value > best_value:
+                    best_index, best_value = i, value
+            if best_index is None:
+                break
+
+            passage = remaining.pop(best_index)
+            used_tokens += passage['tokens'] + (separator_tokens if selected else 0)
+            selected.append(passage)
+
+        # 残りの予算は、入りきらなかった最も関連度の高いパッセージの先頭で埋める
+        left = budget - used_tokens - (separator_tokens if selected else 0)
+        if remaining and left >= self.min_fill_tokens:
+            passage = dict(remaining[0])
+            passage['content'] = self.token_counter.truncate(passage['content'], left)
+            if passage['content']:
+                selected.append(passage)
+
+        # 関連度順に並べてプロンプトに入れる
+        selected.sort(key=lambda passage: passage['score'], reverse=True)
+        sources = []
+        for passage in selected:
+            if passage['source'] not in sources:
+                sources.append(passage['source'])
+        return self.separator.join(passage['content'] for passage in selected), sources
+
+
+# シングルトンインスタンス
+context_builder = ContextBuilder()
@@ -0,0 +1,451 @@
+"""
+複数の Azure OpenAI デプロイメントへのリクエストの振り分け
+
+リージョンごとのデプロイメントを「バックエンド」として登録し、リクエストごとに
+応答時間の指数移動平均（EWMA）と処理中のリクエスト数から最も空いているものを選ぶ。
+失敗が続いたバックエンドはサーキットブレーカーで一定時間外し、最初の応答が遅い場合は
+これまでの p95 の時間を過ぎた時点で別のバックエンドにも同じリクエストを送る（ヘッジ）。
+"""
+import os
+import json
+import time
+import random
+import logging
+import threading
+from collections import deque
+from concurrent.futures import Future, ThreadPoolExecutor, FIRST_COMPLETED, wait
+from typing import Any, Callable, Deque, Dict, Iterator, List, Optional, Tuple
+from urllib.parse import urlparse
+
+from openai import AzureOpenAI, APIConnectionError, APIStatusError
+from dotenv import load_dotenv
+
+# ロガーの設定
+logger = logging.getLogger(__name__)
+
+# 環境変数の読み込み
+load_dotenv()
+
+# ストリームの終端を表す値
+_END = object()
+
+
+class Backend:
+    """振り分け先の1つのデプロイメント"""
+
+    def __init__(
+        self,
+        name: str,
+        endpoint: Optional[str],
+        api_key: Optional[str],
+        deployment: str,
+        api_version: str = "2024-02-01",
+        max_retries: int = 2
+    ):
+        """
+        Args:
+            name: ログや状態表示に使う名前
+            endpoint: Azure OpenAI のエンドポイント
+            api_key: APIキー
+            deployment: デプロイメント名
+            api_version: APIバージョン
+            max_retries: クライアント内での再試行回数（他のバックエンドに切り替えられる場合は0にする）
+        """
+        self.name = name
+        self.endpoint = endpoint
+        self.api_key = api_key
+        self.deployment = deployment
+        self.api_version = api_version
+        self.max_retries = max_retries
+        self._client: Optional[AzureOpenAI] = None
+
+        # 振り分けの判断に使う状態（DeploymentRouter のロック内で更新する）
+        self.ewma_latency: Optional[float] = None
+        self.outstanding = 0
+        self.consecutive_failures = 0
+        self.open_until = 0.0  # サーキットブレーカーが開いている期限（0なら閉じている）
+        self.trial_in_flight = False  # 半開状態で試行中のリクエストがあるか
+        self.requests = 0
+        self.failures = 0
+
+    @property
+    def client(self) -> AzureOpenAI:
+        """Azure OpenAI クライアント（初回アクセス時に初期化）"""
+        if self._client is None:
+            if not all([self.api_key, self.endpoint]):
+                raise ValueError("Azure OpenAI の認証情報が設定されていません。.env ファイルを確認してください。")
+
+            self._client = AzureOpenAI(
+                api_key=self.api_key,
+                api_version=self.api_version,
+                azure_endpoint=self.endpoint,
+                max_retries=self.max_retries
+            )
+        return self._client
+
+
+class RoutedStream:
+    """振り分け先のストリーミング応答（閉じるまでバックエンドの処理中として数える）"""
+
+    def __init__(self, router: 'DeploymentRouter', backend: Backend, stream: Any, iterator: Iterator, first: Any):
+        self.router = router
+        self.backend = backend
+        self._stream = stream
+        self._iterator = iterator
+        self._first = first
+        self._closed = False
+
+    def __iter__(self):
+        try:
+            if self._first is not _END:
+                yield self._first
+            for chunk in self._iterator:
+                yield chunk
+        except Exception as e:
+            # 途中で切れたストリームもバックエンドの失敗として数える（リクエストは最初のチャンクで記録済み）
+            self.router._record_failure(self.backend, e)
+            raise
+        finally:
+            self.close()
+
+    def close(self) -> None:
+        """ストリームを閉じる"""
+        if self._closed:
+            return
+        self._closed = True
+        try:
+            self._stream.close()
+        finally:
+            self.router._release(self.backend)
+
+
+class DeploymentRouter:
+    """レイテンシと負荷を見てバックエンドを選ぶ"""
+
+    def __init__(
+        self,
+        backends: List[Backend],
+        ewma_alpha: float = 0.3,
+        failure_threshold: int = 3,
+        cooldown: float = 30.0,
+        hedge: bool = False,
+        hedge_quantile: float = 0.95,
+        hedge_min_delay: float = 0.2,
+        hedge_min_samples: int = 20,
+        latency_window: int = 200
+    ):
+        """
+        Args:
+            backends: 振り分け先のバックエンド
+            ewma_alpha: 応答時間の指数移動平均の重み
+            failure_threshold: サーキットブレーカーを開く連続失敗数
+            cooldown: サーキットブレーカーを開いておく秒数（経過後に1件だけ試行する）
+            hedge: ヘッジを有効にするか
+            hedge_quantile: ヘッジを送るまでの待ち時間に使う分位点
+            hedge_min_delay: ヘッジを送るまでの最短の待ち時間（秒）
+            hedge_min_samples: ヘッジを始めるのに必要な応答時間の記録数
+            latency_window: 分位点の計算に使う直近の記録数
+        """
+        if not backends:
+            raise ValueError("バックエンドが1つも設定されていません")
+        self.backends = backends
+        self.ewma_alpha = ewma_alpha
+        self.failure_threshold = failure_threshold
+        self.cooldown = cooldown
+        self.hedge = hedge
+        self.hedge_quantile = hedge_quantile
+        self.hedge_min_delay = hedge_min_delay
+        self.hedge_min_samples = hedge_min_samples
+        self.latency_window = latency_window
+
+        self._lock = threading.Lock()
+        self._latencies: Dict[str, Deque[float]] = {}  # 操作の種類ごとの直近の応答時間
+        self._executor: Optional[ThreadPoolExecutor] = None
+        self.hedged_requests = 0
+
+    @classmethod
+    def from_env(cls, kind: str) -> 'DeploymentRouter':
+        """
+        環境変数からルーターを作成
+
+        AZURE_OPENAI_CHAT_BACKENDS / AZURE_OPENAI_EMBEDDING_BACKENDS に
+        [{"name": ..., "endpoint": ..., "api_key": ..., "deployment": ..., "api_version": ...}] 形式のJSONを指定する。
+        省略した項目と、JSON自体が無い場合は従来の単一エンドポイントの設定を使う。
+
+        Args:
+            kind: "chat" または "embedding"
+        """
+        api_key = os.getenv("AZURE_OPENAI_API_KEY")
+        endpoint = os.getenv("AZURE_OPENAI_ENDPOINT")
+        api_version = os.getenv("AZURE_OPENAI_API_VERSION", "2024-02-01")
+        if kind == "chat":
+            deployment = os.getenv("AZURE_OPENAI_DEPLOYMENT_NAME", "gpt-35-turbo")
+            configs = json.loads(os.getenv("AZURE_OPENAI_CHAT_BACKENDS") or "[]")
+        else:
+            deployment = os.getenv("AZURE_OPENAI_EMBEDDING_DEPLOYMENT_NAME", "text-embedding-ada-002")
+            configs = json.loads(os.getenv("AZURE_OPENAI_EMBEDDING_BACKENDS") or "[]")
+        configs = configs or [{}]
+
+        backends = []
+        for config in configs:
+            backend_endpoint = config.get("endpoint", endpoint)
+            backends.append(Backend(
+                name=config.get("name") or urlparse(backend_endpoint or "").netloc or f"{kind}-{len(backends)}",
+                endpoint=backend_endpoint,
+                api_key=config.get("api_key", api_key),
+                deployment=config.get("deployment", deployment),
+                api_version=config.get("api_version", api_version),
+                # 切り替え先がある場合はクライアント内で再試行せず、すぐに別のバックエンドへ回す
+                max_retries=0 if len(configs) > 1 else 2
+            ))
+
+        return cls(
+            backends,
+            failure_threshold=int(os.getenv("AZURE_OPENAI_BREAKER_FAILURES", "3")),
+            cooldown=float(os.getenv("AZURE_OPENAI_BREAKER_COOLDOWN_SECONDS", "30")),
+            hedge=os.getenv("AZURE_OPENAI_HEDGE", "false").lower() == "true",
+            hedge_min_delay=int(os.getenv("AZURE_OPENAI_HEDGE_MIN_MS", "200")) / 1000
+        )
+
+    # ---- バックエンドの選択と状態の更新 ----
+
+    def _select(self, exclude: List[Backend], allow_open: bool = True) -> Optional[Backend]:
+        """
+        最も空いているバックエンドを選び、処理中として数える
+
+        Args:
+            exclude: 選ばないバックエンド（この要求で試行済みのもの）
+            allow_open: 使えるものが無い場合にサーキットブレーカーが開いているものも選ぶか
+        """
+        now = time.monotonic()
+        with self._lock:
+            remaining = [backend for backend in self.backends if backend not in exclude]
+            # 閉じているもの、または冷却期間が過ぎて試行中のリクエストが無いもの（半開）
+            candidates = [
+                backend for backend in remaining
+                if backend.open_until <= now and not (backend.open_until and backend.trial_in_flight)
+            ]
+            if not candidates:
+                if not allow_open or not remaining:
+                    return None
+                # すべて外れている場合は、最も早く復帰するものに送ってみる
+                candidates = [min(remaining, key=lambda backend: backend.open_until)]
+
+            backend = min(
+                candidates,
+                key=lambda backend: ((backend.ewma_latency or 0.0) + 0.001) * (backend.outstanding + 1) + random.random() * 1e-6
+            )
+            backend.outstanding += 1
+            if backend.open_until:
+                backend.trial_in_flight = True
+            return backend
+
+    @staticmethod
+    def _is_backend_failure(error: Exception) -> bool:
+        """バックエンド側の障害か（リクエスト自体の誤りは他に送っても失敗するので数えない）"""
+        if isinstance(error, APIConnectionError):
+            return True
+        if isinstance(error, APIStatusError):
+            return error.status_code == 429 or error.status_code >= 500
+        return False
+
+    def _record(self, backend: Backend, latency: Optional[float], error: Optional[Exception], label: str = "default") -> None:
+        """リクエストの結果を記録"""
+        with self._lock:
+            backend.requests += 1
+            backend.trial_in_flight = False
+            if error is None or not self._is_backend_failure(error):
+                backend.consecutive_failures = 0
+                backend.open_until = 0.0
+                if latency is not None:
+                    if backend.ewma_latency is None:
+                        backend.ewma_latency = latency
+                    else:
+                        backend.ewma_latency += self.ewma_alpha * (latency - backend.ewma_latency)
+                    self._latencies.setdefault(label, deque(maxlen=self.latency_window)).append(latency)
+                return
+            self._count_failure(backend, error)
+
+    def _record_failure(self, backend: Backend, error: Exception) -> None:
+        """記録済みのリクエストが後から失敗したことを記録（リクエスト数と応答時間は変えない）"""
+        with self._lock:
+            self._count_failure(backend, error)
+
+    def _count_failure(self, backend: Backend, error: Exception) -> None:
+        """失敗を数え、連続失敗が閾値に達するか半開での試行が失敗したら外す（ロック内で呼ぶ）"""
+        backend.failures += 1
+        backend.consecutive_failures += 1
+        if backend.open_until or backend.consecutive_failures >= self.failure_threshold:
+            backend.open_until = time.monotonic() + self.cooldown
+            logger.warning(f"バックエンド {backend.name} を {self.cooldown:.0f} 秒間外します: {error}")
+
+    def _release(self, backend: Backend) -> None:
+        """処理中のリクエスト数を減らす"""
+        with self._lock:
+            backend.outstanding -= 1
+
+    def hedge_delay(self, label: str = "default") -> Optional[float]:
+        """ヘッジを送るまでの待ち時間（記録が足りない間はNone）"""
+        with self._lock:
+            latencies = sorted(self._latencies.get(label, ()))
+        if len(latencies) < self.hedge_min_samples:
+            return None
+        return max(self.hedge_min_delay, latencies[int(self.hedge_quantile * (len(latencies) - 1))])
+
+    # ---- リクエストの実行 ----
+
+    def _get_executor(self) -> ThreadPoolExecutor:
+        with self._lock:
+            if self._executor is None:
+                self._executor = ThreadPoolExecutor(max_workers=32, thread_name_prefix="deployment-router")
+            return self._executor
+
+    def _run(self, backend: Backend, operation: Callable[[Backend], Any], label: str, hold: bool) -> Any:
+        """1つのバックエンドで実行（hold の場合は成功しても処理中のまま返す）"""
+        start = time.monotonic()
+        try:
+            result = operation(backend)
+        except Exception as e:
+            self._record(backend, None, e, label)
+            self._release(backend)
+            raise
+        self._record(backend, time.monotonic() - start, None, label)
+        if not hold:
+            self._release(backend)
+        return result
+
+    def _run_hedged(
+        self,
+        primary: Backend,
+        operation: Callable[[Backend], Any],
+        delay: float,
+        tried: List[Backend],
+        label: str,
+        hold: bool,
+        discard: Optional[Callable[[Any], None]]
+    ) -> Tuple[Backend, Any]:
+        """primary で実行し、delay 秒以内に応答が無ければ別のバックエンドにも送って早い方を使う"""
+        executor = self._get_executor()
+        futures: Dict[Future, Backend] = {executor.submit(self._run, primary, operation, label, hold): primary}
+        done, _ = wait(futures, timeout=delay)
+        if not done:
+            secondary = self._select(tried, allow_open=False)
+            if secondary is not None:
+                tried.append(secondary)
+                with self._lock:
+                    self.hedged_requests += 1
+                futures[executor.submit(self._run, secondary, operation, label, hold)] = secondary
+
+        def drop(backend: Backend, future: Future) -> None:
+            """使わなかった方の応答を後始末する"""
+            if future.exception() is not None:
+                return
+            if discard is not None:
+                discard(future.result())
+            if hold:
+                self._release(backend)
+
+        pending = set(futures)
+        error: Optional[Exception] = None
+        while pending:
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            winner = None
+            for future in done:
+                if future.exception() is not None:
+                    error = future.exception()
+                elif winner is None:
+                    winner = future
+                else:
+                    drop(futures[future], future)
+            if winner is not None:
+                for future in pending:
+                    future.add_done_callback(lambda future, backend=futures[future]: drop(backend, future))
+                return futures[winner], winner.result()
+        raise error
+
+    def _execute(
+        self,
+        operation: Callable[[Backend], Any],
+        hedge: Optional[bool],
+        label: str,
+        hold: bool = False,
+        discard: Optional[Callable[[Any], None]] = None
+    ) -> Tuple[Backend, Any]:
+        """バックエンドを選んで実行し、障害の場合は別のバックエンドで再試行する"""
+        hedge = self.hedge if hedge is None else hedge
+        tried: List[Backend] = []
+        last_error: Optional[Exception] = None
+        while len(tried) < len(self.backends):
+            backend = self._select(tried)
+            if backend is None:
+                break
+            tried.append(backend)
+            delay = self.hedge_delay(label) if hedge and len(self.backends) > 1 else None
+            try:
+                if delay is None:
+                    return backend, self._run(backend, operation, label, hold)
+                return self._run_hedged(backend, operation, delay, tried, label, hold, discard)
+            except Exception as e:
+                if not self._is_backend_failure(e):
+                    raise
+                last_error = e
+                logger.warning(f"バックエンド {backend.name} でエラー、別のバックエンドで再試行します: {e}")
+        raise last_error
+
+    def call(self, operation: Callable[[Backend], Any], hedge: Optional[bool] = None, label: str = "default") -> Any:
+        """
+        選んだバックエンドで operation を実行
+
+        Args:
+            operation: バックエンドを受け取ってリクエストを送る関数
+            hedge: ヘッジするか（Noneならルーターの設定に従う）
+            label: 応答時間の分位点を分けて記録する操作の種類
+        """
+        return self._execute(operation, hedge, label)[1]
+
+    def open_stream(self, operation: Callable[[Backend], Any], hedge: Optional[bool] = None, label: str = "stream") -> RoutedStream:
+        """
+        選んだバックエンドでストリーミング応答を開始
+
+        最初のチャンクが届くまでをそのバックエンドの応答時間とし、ヘッジもそこまでで判定する。
+
+        Args:
+            operation: バックエンドを受け取ってストリームを返す関数
+            hedge: ヘッジするか（Noneならルーターの設定に従う）
+            label: 応答時間の分位点を分けて記録する操作の種類
+        """
+        def start(backend: Backend) -> Tuple[Any, Iterator, Any]:
+            stream = operation(backend)
+            try:
+                iterator = iter(stream)
+                return stream, iterator, next(iterator, _END)
+            except Exception:
+                stream.close()
+                raise
+
+        backend, (stream, iterator, first) = self._execute(
+            start, hedge, label, hold=True, discard=lambda started: started[0].close()
+        )
+        return RoutedStream(self, backend, stream, iterator, first)
+
+    def status(self) -> List[Dict]:
+        """バックエンドごとの状態"""
+        now = time.monotonic()
+        with self._lock:
+            return [
+                {
+                    'name': backend.name,
+                    'deployment': backend.deployment,
+                    'state': 'closed' if not backend.open_until else ('open' if backend.open_until > now else 'half_open'),
+                    'ewma_latency_ms': None if backend.ewma_latency is None else round(backend.ewma_latency * 1000, 1),
+                    'outstanding': backend.outstanding,
+                    'requests': backend.requests,
+                    'failures': backend.failures
+                }
+                for backend in self.backends
+            ]
+
+
+# シングルトンインスタンス
+chat_deployments = DeploymentRouter.from_env("chat")
+embedding_deployments = DeploymentRouter.from_env("embedding")
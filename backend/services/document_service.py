@@ -1,18 +1,115 @@
 """
 文書処理サービス（PDF、テキストファイルの読み込みと処理）
 """
+import io
 import os
-from typing import Dict, Optional
+import asyncio
+import hashlib
+from typing import AsyncIterator, BinaryIO, Dict, Optional
 from pathlib import Path
 import pypdf
+from .profiler import phase
+from multipart.multipart import MultipartParser, parse_options_header
+from multipart.exceptions import MultipartParseError
 # LangChainは使用せず、標準ライブラリで実装
 import tempfile
 
 
+class UploadError(Exception):
+    """アップロードの受信を中断するエラー"""
+    
+    def __init__(self, message: str, status_code: int = 400):
+        super().__init__(message)
+        self.status_code = status_code
+
+
+class UploadSpool:
+    """multipart/form-data のファイルフィールドを受信しながら一時領域へ書き出す"""
+    
+    def __init__(self, service: 'DocumentService', field_name: str = 'file'):
+        self.service = service
+        self.field_name = field_name.encode('utf-8')
+        
+        self.filename: Optional[str] = None
+        self.file: Optional[tempfile.SpooledTemporaryFile] = None
+        self.size = 0
+        self.hasher = hashlib.sha256()
+        
+        self._header_field = b""
+        self._header_value = b""
+        self._disposition = b""
+        self._writing = False
+    
+    def callbacks(self) -> Dict:
+        """MultipartParser に渡すコールバック"""
+        return {
+            'on_part_begin': self.on_part_begin,
+            'on_part_data': self.on_part_data,
+            'on_part_end': self.on_part_end,
+            'on_header_field': self.on_header_field,
+            'on_header_value': self.on_header_value,
+            'on_header_end': self.on_header_end,
+            'on_headers_finished': self.on_headers_finished,
+        }
+    
+    def on_part_begin(self):
+        self._disposition = b""
+        self._writing = False
+    
+    def on_header_field(self, data: bytes, start: int, end: int):
+        self._header_field += data[start:end]
+    
+    def on_header_value(self, data: bytes, start: int, end: int):
+        self._header_value += data[start:end]
+    
+    def on_header_end(self):
+        if self._header_field.lower() == b"content-disposition":
+            self._disposition = self._header_value
+        self._header_field = b""
+        self._header_value = b""
+    
+    def on_headers_finished(self):
+        _, options = parse_options_header(self._disposition)
+        if options.get(b"name") != self.field_name or b"filename" not in options or self.file is not None:
+            return
+        
+        # 本文を受信する前にファイル名で検証する
+        filename = Path(options[b"filename"].decode('utf-8', errors='replace')).name
+        validation = self.service.validate_file(filename, 0)
+        if not validation['valid']:
+            raise UploadError(validation['error'])
+        
+        self.filename = filename
+        self.file = tempfile.SpooledTemporaryFile(max_size=self.service.spool_memory_size)
+        self._writing = True
+    
+    def on_part_data(self, data: bytes, start: int, end: int):
+        if not self._writing:
+            return
+        
+        # サイズ上限を受信中に確認し、内容のハッシュも同時に計算する
+        self.size += end - start
+        if self.size > self.service.max_file_size:
+            raise UploadError(self.service.file_too_large_message(), status_code=413)
+        
+        chunk = memoryview(data)[start:end]
+        self.hasher.update(chunk)
+        self.file.write(chunk)
+    
+    def on_part_end(self):
+        self._writing = False
+
+
 class DocumentService:
     def __init__(self):
         self.supported_extensions = {'.pdf', '.txt', '.md'}
-        self.max_file_size = 10 * 1024 * 1024  # 10MB
+        self.max_file_size = int(os.getenv("MAX_UPLOAD_SIZE_MB", "10")) * 1024 * 1024
+        # この大きさまではメモリ上で処理し、超えたらディスクに書き出す
+        self.spool_memory_size = 1024 * 1024  # 1MB
+    
+    def file_too_large_message(self) -> str:
+        """サイズ超過時のエラーメッセージ"""
+        return f"ファイルサイズが大きすぎます。最大サイズ: {self.max_file_size / 1024 / 1024}MB"
     
     def validate_file(self, filename: str, file_size: int) -> Dict:
         """ファイルの検証"""
@@ -28,58 +125,103 @@ class DocumentService:
         if file_size > self.max_file_size:
             return {
                 'valid': False,
-                'error': f"ファイルサイズが大きすぎます。最大サイズ: {self.max_file_size / 1024 / 1024}MB"
+                'error': self.file_too_large_message()
             }
         
         return {'valid': True}
     
-    async def extract_text_from_pdf(self, file_path: str) -> str:
-        """PDFからテキストを抽出"""
+    def _read_pdf(self, file: BinaryIO) -> str:
+        """PDFのファイルオブジェクトからテキストを抽出"""
         try:
-            text = ""
-            with open(file_path, 'rb') as file:
-                pdf_reader = pypdf.PdfReader(file)
-                num_pages = len(pdf_reader.pages)
-                
-                for page_num in range(num_pages):
-                    page = pdf_reader.pages[page_num]
-                    text += page.extract_text() + "\n\n"
-            
-            return text.strip()
+            pdf_reader = pypdf.PdfReader(file)
+            pages = [page.extract_text() for page in pdf_reader.pages]
+            return "\n\n".join(pages).strip()
         except Exception as e:
             raise Exception(f"PDF読み込みエラー: {str(e)}")
     
-    async def extract_text_from_txt(self, file_path: str) -> str:
-        """テキストファイルからテキストを抽出"""
+    def _decode_text(self, data: bytes) -> str:
+        """テキストファイルの内容をデコード"""
         try:
-            with open(file_path, 'r', encoding='utf-8') as file:
-                return file.read()
+            return data.decode('utf-8')
         except UnicodeDecodeError:
             # UTF-8で読めない場合は、Shift-JISで試す
             try:
-                with open(file_path, 'r', encoding='shift-jis') as file:
-                    return file.read()
+                return data.decode('shift-jis')
             except Exception as e:
                 raise Exception(f"テキストファイル読み込みエラー: {str(e)}")
     
-    async def process_document(self, file_path: str, filename: str) -> Dict:
-        """ドキュメントを処理してテキストとメタデータを返す"""
+    def _extract_text(self, file: BinaryIO, file_ext: str) -> str:
+        """ファイル形式に応じてテキストを抽出"""
+        if file_ext == '.pdf':
+            return self._read_pdf(file)
+        elif file_ext in ['.txt', '.md']:
+            return self._decode_text(file.read())
+        else:
+            raise Exception(f"サポートされていないファイル形式: {file_ext}")
+    
+    async def spool_upload(self, content_type: str, stream: AsyncIterator[bytes]) -> Dict:
+        """
+        multipart/form-data のアップロードをチャンク単位で受信して一時領域に保存
+        
+        ファイル全体をメモリに読み込まず、受信しながらサイズ上限の確認と
+        SHA-256 の計算を行う。小さいファイルはメモリ上に保持される。
+        
+        Args:
+            content_type: リクエストの Content-Type ヘッダー
+            stream: リクエスト本文のチャンク
+            
+        Returns:
+            成功時は valid / filename / file / size / content_hash、失敗時は valid / error / status_code
+        """
+        _, params = parse_options_header(content_type)
+        boundary = params.get(b"boundary")
+        if not boundary:
+            return {'valid': False, 'error': "multipart/form-data 形式で送信してください", 'status_code': 400}
+        
+        spool = UploadSpool(self)
+        parser = MultipartParser(boundary, spool.callbacks())
+        received = False
+        try:
+            async for chunk in stream:
+                parser.write(chunk)
+            parser.finalize()
+            
+            if spool.file is None:
+                return {'valid': False, 'error': "ファイルが含まれていません", 'status_code': 400}
+            
+            spool.file.seek(0)
+            received = True
+            return {
+                'valid': True,
+                'filename': spool.filename,
+                'file': spool.file,
+                'size': spool.size,
+                'content_hash': spool.hasher.hexdigest()
+            }
+        except UploadError as e:
+            return {'valid': False, 'error': str(e), 'status_code': e.status_code}
+        except MultipartParseError as e:
+            return {'valid': False, 'error': f"multipart/form-data の形式が正しくありません: {e}", 'status_code': 400}
+        finally:
+            # 受信を完了できなかった場合は一時領域を閉じて削除する（成功時は呼び出し元が閉じる）
+            if not received and spool.file is not None:
+                spool.file.close()
+    
+    async def process_upload(self, file: BinaryIO, filename: str, file_size: int, content_hash: str) -> Dict:
+        """受信済みのアップロードを処理してテキストとメタデータを返す"""
         try:
             file_ext = Path(filename).suffix.lower()
             
-            # ファイル形式に応じてテキストを抽出
-            if file_ext == '.pdf':
-                text = await self.extract_text_from_pdf(file_path)
-            elif file_ext in ['.txt', '.md']:
-                text = await self.extract_text_from_txt(file_path)
-            else:
-                raise Exception(f"サポートされていないファイル形式: {file_ext}")
+            # テキスト抽出はCPU負荷が高いのでスレッドで実行
+            file.seek(0)
+            with phase("extract"):
+                text = await asyncio.to_thread(self._extract_text, file, file_ext)
             
-            # メタデータの作成
             metadata = {
                 'source': filename,
                 'file_type': file_ext,
-                'file_size': os.path.getsize(file_path)
+                'file_size': file_size,
+                'content_hash': content_hash
             }
             
             return {
@@ -94,31 +236,38 @@ class DocumentService:
                 'error': str(e)
             }
     
-    async def save_uploaded_file(self, file_content: bytes, filename: str) -> str:
-        """アップロードされたファイルを一時的に保存"""
-        try:
-            # 一時ディレクトリにファイルを保存
-            temp_dir = tempfile.mkdtemp()
-            file_path = os.path.join(temp_dir, filename)
-            
-            with open(file_path, 'wb') as f:
-                f.write(file_content)
-            
-            return file_path
-        except Exception as e:
-            raise Exception(f"ファイル保存エラー: {str(e)}")
-    
-    def cleanup_temp_file(self, file_path: str):
-        """一時ファイルを削除"""
+    def process_local_file(self, file_path: str, source: str) -> Dict:
+        """
+        ローカルのファイルを処理してテキストとメタデータを返す（一括取り込みのワーカープロセスで実行）
+        
+        Args:
+            file_path: ファイルのパス
+            source: 文書のソース名
+        """
         try:
-            if os.path.exists(file_path):
-                os.remove(file_path)
-                # 親ディレクトリも削除
-                parent_dir = os.path.dirname(file_path)
-                if os.path.exists(parent_dir) and not os.listdir(parent_dir):
-                    os.rmdir(parent_dir)
+            file_ext = Path(file_path).suffix.lower()
+            with open(file_path, 'rb') as file:
+                data = file.read()
+            text = self._extract_text(io.BytesIO(data), file_ext)
+        
+            metadata = {
+                'source': source,
+                'file_type': file_ext,
+                'file_size': len(data),
+                'content_hash': hashlib.sha256(data).hexdigest()
+            }
+        
+            return {
+                'text': text,
+                'metadata': metadata,
+                'status': 'success'
+            }
+        
         except Exception as e:
-            print(f"一時ファイル削除エラー: {e}")
+            return {
+                'status': 'error',
+                'error': str(e)
+            }
 
 
 # シングルトンインスタンス
@@ -0,0 +1,191 @@
+"""
+他のノードへ複製するためのインデックスのスナップショット（書き出し・検証・読み込み）
+
+スナップショットは1つのディレクトリで、次のファイルからなる:
+    manifest.json   形式とバージョン、埋め込みのデプロイメントと次元、行数、各ファイルの SHA-256
+    vectors.npy     埋め込み行列（読み込み時は mmap するので再計算もメモリへの展開もしない）
+    documents.json  チャンクの本文とメタデータ、準重複として省略したチャンクの参照
+    minhash.npy     準重複検出用の MinHash 署名（あれば。取り込み側で本文から計算し直さずに済む）
+
+一時ディレクトリに書いてから rename するので、書き出し途中のスナップショットが見えることはない。
+"""
+import hashlib
+import json
+import os
+import shutil
+import tempfile
+from datetime import datetime
+from typing import Dict, List, NamedTuple, Optional
+
+import numpy as np
+
+FORMAT = "rag-index-snapshot"
+FORMAT_VERSION = 1
+
+MANIFEST_FILE = "manifest.json"
+VECTORS_FILE = "vectors.npy"
+DOCUMENTS_FILE = "documents.json"
+MINHASH_FILE = "minhash.npy"
+
+
+class SnapshotError(Exception):
+    """スナップショットを書き出せない・取り込めない（形式・チェックサム・デプロイメントの不一致など）"""
+
+
+class SnapshotBundle(NamedTuple):
+    """読み込んだスナップショット"""
+    manifest: Dict
+    documents: List[Dict]
+    references: List[Dict]
+    embeddings: np.ndarray  # 読み取り専用の mmap
+    signatures: Optional[np.ndarray]  # (行数, num_perm) の MinHash 署名
+
+
+def _sha256(path: str) -> str:
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(1024 * 1024), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def _write_file(path: str, writer) -> None:
+    with open(path, 'wb') as f:
+        writer(f)
+        f.flush()
+        os.fsync(f.fileno())
+
+
+def write_bundle(
+    target_dir: str,
+    documents: List[Dict],
+    references: List[Dict],
+    embeddings: np.ndarray,
+    signatures: Optional[np.ndarray],
+    info: Dict
+) -> Dict:
+    """
+    スナップショットを書き出す
+
+    Args:
+        target_dir: 書き出し先のディレクトリ（存在しないこと）
+        documents: 埋め込みを除いたチャンクのリスト
+        references: 準重複として省略したチャンクの参照
+        embeddings: documents と同じ順序の埋め込み行列
+        signatures: documents と同じ順序の MinHash 署名
+        info: マニフェストに記録する値（embedding_deployment など）
+
+    Returns:
+        マニフェスト
+    """
+    target_dir = os.path.abspath(target_dir)
+    if os.path.exists(target_dir):
+        raise SnapshotError(f"書き出し先が既に存在します: {target_dir}")
+    parent = os.path.dirname(target_dir)
+    os.makedirs(parent, exist_ok=True)
+
+    embeddings = np.ascontiguousarray(embeddings, dtype=np.float32)
+    temp_dir = tempfile.mkdtemp(dir=parent, prefix=".tmp-export-")
+    try:
+        _write_file(os.path.join(temp_dir, VECTORS_FILE), lambda f: np.save(f, embeddings))
+        _write_file(
+            os.path.join(temp_dir, DOCUMENTS_FILE),
+            lambda f: f.write(json.dumps({'documents': documents, 'references': references}, ensure_ascii=False).encode('utf-8'))
+        )
+        names = [VECTORS_FILE, DOCUMENTS_FILE]
+        if signatures is not None:
+            _write_file(os.path.join(temp_dir, MINHASH_FILE), lambda f: np.save(f, np.ascontiguousarray(signatures, dtype=np.uint32)))
+            names.append(MINHASH_FILE)
+
+        manifest = {
+            'format': FORMAT,
+            'version': FORMAT_VERSION,
+            'created_at': datetime.now().isoformat(),
+            'count': len(documents),
+            'dimension': int(embeddings.shape[1]) if embeddings.ndim == 2 and len(embeddings) else 0,
+            'references': len(references),
+        }
+        manifest.update(info)
+        manifest['files'] = {
+            name: {
+                'sha256': _sha256(os.path.join(temp_dir, name)),
+                'size': os.path.getsize(os.path.join(temp_dir, name))
+            }
+            for name in names
+        }
+        _write_file(
+            os.path.join(temp_dir, MANIFEST_FILE),
+            lambda f: f.write(json.dumps(manifest, ensure_ascii=False, indent=2).encode('utf-8'))
+        )
+        os.replace(temp_dir, target_dir)
+    except Exception:
+        shutil.rmtree(temp_dir, ignore_errors=True)
+        raise
+    return manifest
+
+
+def read_manifest(source_dir: str) -> Dict:
+    """マニフェストを読み込み、形式とバージョンを確認"""
+    path = os.path.join(source_dir, MANIFEST_FILE)
+    try:
+        with open(path, 'r', encoding='utf-8') as f:
+            manifest = json.load(f)
+    except FileNotFoundError:
+        raise SnapshotError(f"スナップショットが見つかりません: {source_dir}")
+    except json.JSONDecodeError as e:
+        raise SnapshotError(f"マニフェストが壊れています: {e}")
+
+    if manifest.get('format') != FORMAT:
+        raise SnapshotError("インデックスのスナップショットではありません")
+    if manifest.get('version') != FORMAT_VERSION:
+        raise SnapshotError(f"対応していない形式のバージョンです: {manifest.get('version')}（対応: {FORMAT_VERSION}）")
+    return manifest
+
+
+def load_bundle(source_dir: str, manifest: Dict) -> SnapshotBundle:
+    """
+    チェックサムを確認してスナップショットを読み込む
+
+    Raises:
+        SnapshotError: ファイルが欠けている・壊れている、または行数・次元がマニフェストと合わない場合
+    """
+    files = manifest.get('files', {})
+    for name in (VECTORS_FILE, DOCUMENTS_FILE):
+        if name not in files:
+            raise SnapshotError(f"マニフェストに {name} がありません")
+    for name, expected in files.items():
+        path = os.path.join(source_dir, name)
+        if not os.path.exists(path):
+            raise SnapshotError(f"ファイルがありません: {name}")
+        if os.path.getsize(path) != expected['size'] or _sha256(path) != expected['sha256']:
+            raise SnapshotError(f"チェックサムが一致しません: {name}")
+
+    with open(os.path.join(source_dir, DOCUMENTS_FILE), 'r', encoding='utf-8') as f:
+        data = json.load(f)
+    documents, references = data['documents'], data.get('references', [])
+    embeddings = np.load(os.path.join(source_dir, VECTORS_FILE), mmap_mode='r')
+    signatures = np.load(os.path.join(source_dir, MINHASH_FILE), mmap_mode='r') if MINHASH_FILE in files else None
+
+    count, dimension = manifest['count'], manifest['dimension']
+    if len(documents) != count or (count and embeddings.shape != (count, dimension)):
+        raise SnapshotError("行数または次元がマニフェストと一致しません")
+    if signatures is not None and len(signatures) != count:
+        signatures = None
+    return SnapshotBundle(manifest, documents, references, embeddings, signatures)
+
+
+def list_bundles(base_dir: str) -> List[Dict]:
+    """ディレクトリ内のスナップショットのマニフェスト（ファイルの一覧を除く。新しい順）"""
+    if not os.path.isdir(base_dir):
+        return []
+    bundles = []
+    for name in os.listdir(base_dir):
+        if name.startswith("."):
+            continue
+        try:
+            manifest = read_manifest(os.path.join(base_dir, name))
+        except SnapshotError:
+            continue
+        manifest.pop('files', None)
+        bundles.append(dict(manifest, name=name))
+    return sorted(bundles, key=lambda bundle: bundle['created_at'], reverse=True)
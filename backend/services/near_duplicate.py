@@ -0,0 +1,128 @@
+"""
+MinHash + LSH によるチャンクの準重複検出
+
+文字 n-gram（日本語でも分かち書き不要）のシングル集合から MinHash 署名を作り、
+バンド分割した LSH で候補を絞ってから推定 Jaccard 類似度で判定する。
+埋め込みを生成する前に重複を見つけるために使う。
+"""
+import zlib
+from collections import defaultdict
+from typing import Callable, Dict, Hashable, List, Optional, Tuple
+
+import numpy as np
+
+# ハッシュの計算に使うメルセンヌ素数と乱数シード（署名を再現可能にするため固定）
+_MERSENNE_PRIME = np.uint64((1 << 61) - 1)
+_MAX_HASH = np.uint64((1 << 32) - 1)
+_SEED = 20240101
+
+
+class MinHasher:
+    """文字 n-gram の MinHash 署名を計算する"""
+
+    def __init__(self, num_perm: int = 64, shingle_size: int = 5):
+        """
+        Args:
+            num_perm: 署名の長さ（ハッシュ関数の数）
+            shingle_size: シングルの文字数
+        """
+        self.num_perm = num_perm
+        self.shingle_size = shingle_size
+
+        rng = np.random.default_rng(_SEED)
+        # a*h + b が uint64 に収まるよう a, b は 2^31 未満にする
+        self._a = rng.integers(1, 1 << 31, size=num_perm, dtype=np.uint64)
+        self._b = rng.integers(0, 1 << 31, size=num_perm, dtype=np.uint64)
+
+    def _shingle_hashes(self, text: str) -> np.ndarray:
+        """正規化したテキストのシングルごとの32bitハッシュ"""
+        normalized = "".join(text.split())
+        size = self.shingle_size
+        if len(normalized) <= size:
+            shingles = {normalized}
+        else:
+            shingles = {normalized[i:i + size] for i in range(len(normalized) - size + 1)}
+        return np.fromiter(
+            (zlib.crc32(shingle.encode('utf-8')) for shingle in shingles),
+            dtype=np.uint64,
+            count=len(shingles)
+        )
+
+    def signature(self, text: str) -> np.ndarray:
+        """テキストの MinHash 署名"""
+        hashes = self._shingle_hashes(text)
+        permuted = (np.outer(self._a, hashes) + self._b[:, None]) % _MERSENNE_PRIME & _MAX_HASH
+        return permuted.min(axis=1).astype(np.uint32)
+
+    @staticmethod
+    def similarity(signature1: np.ndarray, signature2: np.ndarray) -> float:
+        """署名から推定した Jaccard 類似度"""
+        return float(np.mean(signature1 == signature2))
+
+
+class NearDuplicateIndex:
+    """MinHash 署名の LSH インデックス"""
+
+    def __init__(self, hasher: MinHasher, bands: int = 16):
+        """
+        Args:
+            hasher: 署名の計算に使う MinHasher（num_perm は bands で割り切れること）
+            bands: LSH のバンド数。多いほど低い類似度の候補も拾う
+        """
+        if hasher.num_perm % bands:
+            raise ValueError("num_perm は bands で割り切れる必要があります")
+        self.hasher = hasher
+        self.bands = bands
+        self.rows_per_band = hasher.num_perm // bands
+
+        self._buckets: List[Dict[bytes, List[Hashable]]] = [defaultdict(list) for _ in range(bands)]
+        self._signatures: Dict[Hashable, np.ndarray] = {}
+
+    def __len__(self) -> int:
+        return len(self._signatures)
+
+    def _band_keys(self, signature: np.ndarray) -> List[bytes]:
+        return [
+            signature[band * self.rows_per_band:(band + 1) * self.rows_per_band].tobytes()
+            for band in range(self.bands)
+        ]
+
+    def add(self, key: Hashable, signature: np.ndarray) -> None:
+        """署名を登録"""
+        self._signatures[key] = signature
+        for band, band_key in enumerate(self._band_keys(signature)):
+            self._buckets[band][band_key].append(key)
+
+    def signature(self, key: Hashable) -> Optional[np.ndarray]:
+        """登録済みの署名"""
+        return self._signatures.get(key)
+
+    def find(
+        self,
+        signature: np.ndarray,
+        threshold: float,
+        accept: Optional[Callable[[Hashable], bool]] = None
+    ) -> Optional[Tuple[Hashable, float]]:
+        """
+        threshold 以上の類似度を持つ登録済みの署名を探す
+
+        Args:
+            signature: 検索する署名
+            threshold: 準重複とみなす推定類似度
+            accept: 候補として有効なキーか判定する関数（削除済みの行を除くなど）
+
+        Returns:
+            (最も類似度の高いキー, 推定類似度)。見つからなければNone
+        """
+        candidates = set()
+        for band, band_key in enumerate(self._band_keys(signature)):
+            candidates.update(self._buckets[band].get(band_key, ()))
+
+        best: Optional[Tuple[Hashable, float]] = None
+        for key in candidates:
+            if accept is not None and not accept(key):
+                continue
+            similarity = self.hasher.similarity(signature, self._signatures[key])
+            if similarity >= threshold and (best is None or similarity > best[1]):
+                best = (key, similarity)
+        return best
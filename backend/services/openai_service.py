@@ -1,9 +1,10 @@
-import os
+import asyncio
 from typing import List, Dict, Optional
-from openai import AzureOpenAI
 from dotenv import load_dotenv
 import logging
 
+from .deployment_router import chat_deployments
+
 # ロガーの設定
 logger = logging.getLogger(__name__)
 
@@ -13,20 +14,9 @@ load_dotenv()
 class AzureOpenAIService:
     def __init__(self):
         """Azure OpenAI サービスの初期化"""
-        self.api_key = os.getenv("AZURE_OPENAI_API_KEY")
-        self.endpoint = os.getenv("AZURE_OPENAI_ENDPOINT")
-        self.deployment_name = os.getenv("AZURE_OPENAI_DEPLOYMENT_NAME", "gpt-35-turbo")
-        self.api_version = os.getenv("AZURE_OPENAI_API_VERSION", "2024-02-01")
-        
-        if not all([self.api_key, self.endpoint]):
-            raise ValueError("Azure OpenAI の認証情報が設定されていません。.env ファイルを確認してください。")
-        
-        # Azure OpenAI クライアントの初期化
-        self.client = AzureOpenAI(
-            api_key=self.api_key,
-            api_version=self.api_version,
-            azure_endpoint=self.endpoint
-        )
+        # リクエストはデプロイメントのルーター経由で送る（接続先の設定はルーターが環境変数から読み、
+        # クライアントは初回利用時に生成）
+        self.router = chat_deployments
         
         # デフォルト設定
         self.default_temperature = 0.7
@@ -79,21 +69,23 @@ class AzureOpenAIService:
                 }
                 messages = [system_message] + messages
             
-            # Azure OpenAI APIを呼び出し
-            response = self.client.chat.completions.create(
-                model=self.deployment_name,
-                messages=messages,
-                temperature=temperature,
-                max_tokens=max_tokens,
-                top_p=self.default_top_p,
-                stream=stream
-            )
+            # Azure OpenAI APIを呼び出し（空いているデプロイメントを選び、障害時は別のデプロイメントで再試行）
+            def create(backend):
+                return backend.client.chat.completions.create(
+                    model=backend.deployment,
+                    messages=messages,
+                    temperature=temperature,
+                    max_tokens=max_tokens,
+                    top_p=self.default_top_p,
+                    stream=stream
+                )
             
             if stream:
-                # ストリーミング応答の場合は、ジェネレータを返す
-                return response
+                # ストリーミング応答の場合は、最初のチャンクまで受信したストリームを返す
+                return await asyncio.to_thread(self.router.open_stream, create)
             else:
                 # 通常の応答
+                response = await asyncio.to_thread(self.router.call, create, None, "chat")
                 return response.choices[0].message.content
                 
         except Exception as e:
@@ -121,9 +113,19 @@ class AzureOpenAIService:
             context=context
         )
         
-        for chunk in stream:
-            if chunk.choices[0].delta.content is not None:
-                yield chunk.choices[0].delta.content
+        # 同期ストリームの読み出しはスレッドで行い、イベントループを止めない
+        iterator = iter(stream)
+        try:
+            while True:
+                chunk = await asyncio.to_thread(next, iterator, None)
+                if chunk is None:
+                    break
+                # Azure はコンテンツフィルターの結果だけを持つ choices が空のチャンクを送ることがある
+                if chunk.choices and chunk.choices[0].delta.content:
+                    yield chunk.choices[0].delta.content
+        finally:
+            # 途中で打ち切られた場合も接続を閉じて生成を止める
+            stream.close()
 
 
 # シングルトンインスタンス
@@ -0,0 +1,313 @@
+"""
+本番環境で遅いリクエストの原因を調べるためのプロファイラ（オプトイン）
+
+有効にすると（PROFILER_ENABLED=true）、すべてのリクエストの処理段階（受付待ち・検索・LLM呼び出し・
+Markdown変換など）ごとの所要時間を記録し、直近の一定時間で最も遅かったリクエストを段階別の内訳付きで返す。
+
+さらに一部のリクエスト（PROFILER_SAMPLE_RATE の割合、または管理用トークンと X-Profile ヘッダー付き）は、
+別スレッドから一定間隔でスタックを採取するサンプリングプロファイラで計測する。計測対象のコードには
+手を入れず、採取したスタックは folded 形式（flamegraph.pl や speedscope で表示できる）で
+リングバッファに保持する。
+
+スタックは次のスレッドから採取し、計測中のリクエストに振り分ける:
+    - イベントループのスレッド: 実行中のタスクがそのリクエスト（またはそこから作られたタスク）のとき
+    - 既定のスレッドプール（asyncio.to_thread など）: そのリクエストから投入された処理を実行している間
+"""
+import asyncio
+import heapq
+import itertools
+import os
+import random
+import sys
+import threading
+import time
+import uuid
+from collections import defaultdict, deque
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import Dict, List, Optional
+
+from .admin_auth import admin_auth
+
+# 処理中のリクエストの計測（タスクの作成や asyncio.to_thread で引き継がれる）
+_current_profile: ContextVar[Optional['RequestProfile']] = ContextVar('request_profile', default=None)
+_current_phase: ContextVar[str] = ContextVar('request_profile_phase', default='')
+
+
+class RequestProfile:
+    """1リクエストの計測結果"""
+
+    def __init__(self, method: str, path: str, sampled: bool):
+        self.id = uuid.uuid4().hex[:12]
+        self.method = method
+        self.path = path
+        self.sampled = sampled
+        self.started_at = time.time()
+        self.start = time.perf_counter()
+        self.duration: Optional[float] = None
+        self.status: Optional[int] = None
+        self.phases: Dict[str, float] = defaultdict(float)  # 段階（入れ子は / 区切り）-> 累計秒
+        self.stacks: Dict[str, int] = defaultdict(int)  # folded 形式のスタック -> 採取回数
+        self.samples = 0
+        self.token = None  # 計測中のリクエストを示すコンテキスト変数の復元用
+
+    def add_phase(self, path: str, seconds: float):
+        self.phases[path] += seconds
+
+    def add_sample(self, stack: str):
+        self.stacks[stack] += 1
+        self.samples += 1
+
+    def summary(self) -> Dict:
+        return {
+            'id': self.id,
+            'method': self.method,
+            'path': self.path,
+            'status': self.status,
+            'started_at': self.started_at,
+            'duration_ms': round(self.duration * 1000, 1) if self.duration is not None else None,
+            'phases_ms': {name: round(seconds * 1000, 1) for name, seconds in sorted(self.phases.items())},
+            'sampled': self.sampled,
+            'samples': self.samples
+        }
+
+    def folded(self) -> str:
+        """folded 形式（1行に「フレーム;フレーム;... 回数」）"""
+        return "\n".join(f"{stack} {count}" for stack, count in sorted(self.stacks.items())) + "\n"
+
+
+@contextmanager
+def phase(name: str):
+    """
+    処理段階の所要時間を計測中のリクエストに記録する（計測していなければ何もしない）
+
+    入れ子にした段階は「親/子」の名前で記録する。並列に実行された段階は合計するため、
+    内訳の合計がリクエストの所要時間を超えることがある。
+    """
+    profile = _current_profile.get()
+    if profile is None:
+        yield
+        return
+
+    parent = _current_phase.get()
+    path = f"{parent}/{name}" if parent else name
+    token = _current_phase.set(path)
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        profile.add_phase(path, time.perf_counter() - start)
+        _current_phase.reset(token)
+
+
+class _ProfiledExecutor(ThreadPoolExecutor):
+    """計測中のリクエストから投入された処理を、どのスレッドが実行しているか記録するスレッドプール"""
+
+    def __init__(self, profiler: 'RequestProfiler'):
+        super().__init__(thread_name_prefix="asyncio")
+        self.profiler = profiler
+
+    def submit(self, fn, /, *args, **kwargs):
+        profile = _current_profile.get()
+        if profile is None or not profile.sampled:
+            return super().submit(fn, *args, **kwargs)
+        return super().submit(self.profiler._run_for, profile, fn, *args, **kwargs)
+
+
+class RequestProfiler:
+    """リクエストの計測とスタックの採取"""
+
+    def __init__(self):
+        self.enabled = os.getenv("PROFILER_ENABLED", "false").lower() == "true"
+        # スタックを採取するリクエストの割合と、割合に関係なく採取させるヘッダー（管理用トークンも必要）
+        self.sample_rate = float(os.getenv("PROFILER_SAMPLE_RATE", "0.01"))
+        self.header = os.getenv("PROFILER_HEADER", "X-Profile").lower().encode('latin-1')
+        self.admin_header = admin_auth.header.lower().encode('latin-1')
+        self.interval = float(os.getenv("PROFILER_INTERVAL_MS", "5")) / 1000
+        # スタックを保持するリクエスト数と、最も遅いリクエストを探す期間・件数
+        self.ring_size = int(os.getenv("PROFILER_RING_SIZE", "50"))
+        self.window_seconds = float(os.getenv("PROFILER_WINDOW_SECONDS", "300"))
+        self.slowest_count = int(os.getenv("PROFILER_SLOWEST", "20"))
+        self.max_depth = 64
+        # 計測しないパス（この文字列で始まるもの）
+        self.excluded_paths = ("/static", "/profiles", "/health", "/ready")
+
+        self._profiles: deque = deque(maxlen=self.ring_size)  # スタックを採取したリクエスト
+        self._timings: deque = deque(maxlen=10000)  # 全リクエストの (終了時刻, 所要時間, 順序, 計測結果)
+        self._sequence = itertools.count()
+
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+        self._loop_thread: Optional[int] = None
+        self._task_profiles: Dict[asyncio.Task, RequestProfile] = {}
+        self._thread_profiles: Dict[int, RequestProfile] = {}
+        self._sampling = 0  # スタックを採取中のリクエスト数
+        self._sampling_changed = threading.Condition()
+        self._sampler: Optional[threading.Thread] = None
+        self._labels: Dict[object, str] = {}
+
+    def install(self, loop: asyncio.AbstractEventLoop):
+        """イベントループにタスクとスレッドプールの振り分けを設定（起動時に呼ぶ）"""
+        if not self.enabled:
+            return
+        self._loop = loop
+        self._loop_thread = threading.get_ident()
+        loop.set_task_factory(self._task_factory)
+        loop.set_default_executor(_ProfiledExecutor(self))
+
+    def _task_factory(self, loop: asyncio.AbstractEventLoop, coro, **kwargs) -> asyncio.Task:
+        """計測中のリクエストから作られたタスクを記録する"""
+        task = asyncio.Task(coro, loop=loop, **kwargs)
+        context = kwargs.get('context')
+        profile = context.get(_current_profile) if context is not None else _current_profile.get()
+        if profile is not None and profile.sampled:
+            self._task_profiles[task] = profile
+            task.add_done_callback(self._forget_task)
+        return task
+
+    def _forget_task(self, task: asyncio.Task):
+        self._task_profiles.pop(task, None)
+
+    def _run_for(self, profile: RequestProfile, fn, *args, **kwargs):
+        """スレッドプールで実行する処理を、実行中のスレッドとともに記録する"""
+        ident = threading.get_ident()
+        self._thread_profiles[ident] = profile
+        try:
+            return fn(*args, **kwargs)
+        finally:
+            self._thread_profiles.pop(ident, None)
+
+    def is_excluded(self, path: str) -> bool:
+        return path.startswith(self.excluded_paths)
+
+    def begin(self, method: str, path: str, headers: List) -> RequestProfile:
+        """リクエストの計測を開始（ミドルウェアから呼ぶ）"""
+        # X-Profile での強制的な採取は管理用トークン付きのリクエストだけに許す
+        forced = False
+        if any(name == self.header for name, _ in headers):
+            token = next((value.decode('latin-1') for name, value in headers if name == self.admin_header), None)
+            forced = admin_auth.verify(token)
+        profile = RequestProfile(method, path, sampled=forced or random.random() < self.sample_rate)
+        profile.token = _current_profile.set(profile)
+
+        if profile.sampled:
+            task = asyncio.current_task()
+            if task is not None:
+                self._task_profiles[task] = profile
+            with self._sampling_changed:
+                self._sampling += 1
+                self._sampling_changed.notify()
+            self._start_sampler()
+        return profile
+
+    def finish(self, profile: RequestProfile, status: Optional[int]):
+        """リクエストの計測を終了して記録する"""
+        profile.duration = time.perf_counter() - profile.start
+        profile.status = status
+        _current_profile.reset(profile.token)
+        self._timings.append((time.time(), profile.duration, next(self._sequence), profile))
+
+        if profile.sampled:
+            self._task_profiles.pop(asyncio.current_task(), None)
+            with self._sampling_changed:
+                self._sampling -= 1
+            self._profiles.append(profile)
+
+    def _start_sampler(self):
+        if self._sampler is None:
+            self._sampler = threading.Thread(target=self._sample_loop, name="request-profiler", daemon=True)
+            self._sampler.start()
+
+    def _sample_loop(self):
+        """採取中のリクエストがある間、一定間隔で全スレッドのスタックを採取する"""
+        while True:
+            with self._sampling_changed:
+                while self._sampling <= 0:
+                    self._sampling_changed.wait()
+            time.sleep(self.interval)
+
+            frames = sys._current_frames()
+            loop_task = asyncio.current_task(self._loop) if self._loop is not None else None
+            for ident, frame in frames.items():
+                if ident == self._loop_thread:
+                    profile = self._task_profiles.get(loop_task) if loop_task is not None else None
+                    thread = "event-loop"
+                else:
+                    profile = self._thread_profiles.get(ident)
+                    thread = "worker"
+                if profile is not None and profile.duration is None:
+                    profile.add_sample(self._fold(thread, frame))
+
+    def _fold(self, thread: str, frame) -> str:
+        """スタックを「スレッド;外側のフレーム;...;内側のフレーム」の形にする"""
+        labels = []
+        while frame is not None and len(labels) < self.max_depth:
+            code = frame.f_code
+            label = self._labels.get(code)
+            if label is None:
+                label = f"{os.path.basename(code.co_filename)}:{code.co_name}"
+                self._labels[code] = label
+            labels.append(label)
+            frame = frame.f_back
+        labels.append(thread)
+        return ";".join(reversed(labels))
+
+    def recent(self) -> List[Dict]:
+        """スタックを採取した直近のリクエスト（新しい順）"""
+        return [profile.summary() for profile in reversed(self._profiles)]
+
+    def get(self, profile_id: str) -> Optional[RequestProfile]:
+        for profile in self._profiles:
+            if profile.id == profile_id:
+                return profile
+        return None
+
+    def slowest(self, count: Optional[int] = None) -> List[Dict]:
+        """直近 window_seconds 秒で最も遅かったリクエスト（段階別の内訳付き）"""
+        since = time.time() - self.window_seconds
+        timings = [timing for timing in self._timings if timing[0] >= since]
+        slowest = heapq.nlargest(count or self.slowest_count, timings, key=lambda timing: timing[1])
+        return [profile.summary() for _, _, _, profile in slowest]
+
+    def status(self) -> Dict:
+        return {
+            'enabled': self.enabled,
+            'sample_rate': self.sample_rate,
+            'interval_ms': self.interval * 1000,
+            'window_seconds': self.window_seconds,
+            'sampling_now': self._sampling
+        }
+
+
+class ProfilingMiddleware:
+    """リクエストごとに計測を開始・終了するASGIミドルウェア（スタックを採取したら X-Profile-Id を返す）"""
+
+    def __init__(self, app, profiler: Optional[RequestProfiler] = None):
+        self.app = app
+        self.profiler = profiler or request_profiler
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] != 'http' or self.profiler.is_excluded(scope['path']):
+            await self.app(scope, receive, send)
+            return
+
+        profile = self.profiler.begin(scope['method'], scope['path'], scope.get('headers', []))
+        status = None
+
+        async def send_with_profile_id(message):
+            nonlocal status
+            if message['type'] == 'http.response.start':
+                status = message['status']
+                if profile.sampled:
+                    headers = list(message.get('headers', [])) + [(b"x-profile-id", profile.id.encode('ascii'))]
+                    message = dict(message, headers=headers)
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_with_profile_id)
+        finally:
+            self.profiler.finish(profile, status or 500)
+
+
+# シングルトンインスタンス
+request_profiler = RequestProfiler()
@@ -0,0 +1,132 @@
+"""
+入力中の下書きによるRAG検索の先読み
+
+ユーザーが入力している間に下書きで埋め込み生成と検索を先に済ませておき、
+送信されたメッセージが下書きと十分に近ければ、その結果をそのまま使う。
+検索が終わる前に送信された場合も、走っている検索の完了を待って使う。
+"""
+import os
+import time
+import asyncio
+import unicodedata
+from collections import OrderedDict
+from typing import Dict, List, Optional, Tuple
+
+from .vector_db_service import vector_db_service
+from .context_builder import context_builder
+from .profiler import phase
+
+
+async def search_context(message: str, filters: Optional[Dict]) -> Tuple[str, List[str]]:
+    """
+    RAG検索を実行してプロンプト用のコンテキストを組み立てる
+
+    Returns:
+        (コンテキスト文字列, 参考資料のソースのリスト)
+    """
+    search_results = await vector_db_service.search(
+        message, n_results=context_builder.candidates, filters=filters
+    )
+    if not search_results:
+        return "", []
+
+    # 隣接チャンクの結合・重複除去・MMRでトークン予算内に詰める
+    with phase("context_build"):
+        return context_builder.build(search_results)
+
+
+def _shingles(text: str) -> set:
+    """表記ゆれを揃えた文字3-gramの集合"""
+    text = " ".join(unicodedata.normalize("NFKC", text).lower().split())
+    if len(text) < 3:
+        return {text}
+    return {text[i:i + 3] for i in range(len(text) - 2)}
+
+
+def text_similarity(a: str, b: str) -> float:
+    """文字3-gramのJaccard類似度"""
+    shingles_a, shingles_b = _shingles(a), _shingles(b)
+    union = len(shingles_a | shingles_b)
+    return len(shingles_a & shingles_b) / union if union else 1.0
+
+
+class RetrievalPrefetcher:
+    """セッションごとに直近の下書きの検索結果（または実行中の検索）を1件保持する"""
+
+    def __init__(self):
+        self.enabled = os.getenv("RAG_PREFETCH", "true").lower() == "true"
+        # 送信されたメッセージと下書きの類似度がこれ以上なら先読みの結果を使う
+        self.similarity_threshold = float(os.getenv("RAG_PREFETCH_SIMILARITY", "0.6"))
+        self.ttl_seconds = float(os.getenv("RAG_PREFETCH_TTL_SECONDS", "60"))
+        self.min_chars = int(os.getenv("RAG_PREFETCH_MIN_CHARS", "8"))
+        self.max_entries = 10000
+
+        self._entries: "OrderedDict[str, Dict]" = OrderedDict()
+
+    def prefetch(self, session_id: str, draft: str, filters: Optional[Dict]) -> bool:
+        """
+        下書きで検索を開始（同じセッションの前の下書きの検索は取り消す）
+
+        Returns:
+            検索を開始した、または同じ下書きの検索が既にある場合True
+        """
+        draft = draft.strip()
+        if not self.enabled or len(draft) < self.min_chars or not vector_db_service.is_ready:
+            return False
+
+        entry = self._entries.get(session_id)
+        if entry is not None and self._reusable(entry, filters) and entry['draft'] == draft:
+            return True
+        if entry is not None:
+            entry['task'].cancel()
+
+        task = asyncio.create_task(search_context(draft, filters))
+        # 使われずに捨てられた検索の例外を回収する
+        task.add_done_callback(lambda t: t.cancelled() or t.exception())
+        self._entries[session_id] = {
+            'draft': draft,
+            'filters': filters,
+            'index_version': vector_db_service.index_version,
+            'created_at': time.monotonic(),
+            'task': task
+        }
+        self._entries.move_to_end(session_id)
+        while len(self._entries) > self.max_entries:
+            _, evicted = self._entries.popitem(last=False)
+            evicted['task'].cancel()
+        return True
+
+    def _reusable(self, entry: Dict, filters: Optional[Dict]) -> bool:
+        """期限内で、絞り込み条件とインデックスが先読みした時点から変わっていないか"""
+        return (
+            time.monotonic() - entry['created_at'] <= self.ttl_seconds
+            and entry['filters'] == filters
+            and entry['index_version'] == vector_db_service.index_version
+        )
+
+    async def take(self, session_id: str, message: str, filters: Optional[Dict]) -> Optional[Tuple[str, List[str]]]:
+        """
+        送信されたメッセージに使える先読みの結果を取り出す（1回使ったら破棄）
+
+        Returns:
+            (コンテキスト文字列, 参考資料のソースのリスト)。使えるものが無ければNone
+        """
+        entry = self._entries.pop(session_id, None)
+        if entry is None:
+            return None
+        if not self._reusable(entry, filters) or text_similarity(entry['draft'], message) < self.similarity_threshold:
+            entry['task'].cancel()
+            return None
+
+        try:
+            return await asyncio.shield(entry['task'])
+        except asyncio.CancelledError:
+            if entry['task'].cancelled():
+                return None
+            raise
+        except Exception:
+            return None
+
+
+# シングルトンインスタンス
+retrieval_prefetcher = RetrievalPrefetcher()
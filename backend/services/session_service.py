@@ -1,27 +1,86 @@
-from typing import List, Dict, Optional
+from typing import List, Dict, Optional, Tuple
 from datetime import datetime, timedelta
+import os
 import uuid
 import json
-from collections import defaultdict
+import sys
+import time
+from collections import OrderedDict, defaultdict
 import asyncio
 import logging
 
+from .session_store import SessionSnapshotStore
+
 logger = logging.getLogger(__name__)
 
+
+# メッセージは (role, content, timestamp) のタプルで保存する。role は intern した文字列、
+# timestamp は time.time() の値なので、ISO文字列のタイムスタンプを持つ辞書より1件あたりのメモリが小さい
+Message = Tuple[str, str, float]
+
+
+def _api_message(role: str, content: str) -> Dict[str, str]:
+    """APIに渡す形式のメッセージ"""
+    return {"role": role, "content": content}
+
+
 class SessionService:
-    def __init__(self, session_timeout_minutes: int = 30):
+    def __init__(self, session_timeout_minutes: int = 30, snapshot_dir: Optional[str] = None):
         """
         セッション管理サービスの初期化
         
         Args:
             session_timeout_minutes: セッションのタイムアウト時間（分）
+            snapshot_dir: スナップショットの保存先（Noneなら環境変数 SESSION_SNAPSHOT_DIR、空文字なら保存しない）
         """
         # メモリ内でセッションを管理
         self.sessions: Dict[str, Dict] = {}
         self.session_timeout = timedelta(minutes=session_timeout_minutes)
         
-        # 定期的なクリーンアップタスクを開始
-        asyncio.create_task(self._cleanup_expired_sessions())
+        # 再起動後も会話を引き継ぐため、変更のあったセッションだけを定期的にディスクへ書き出す
+        if snapshot_dir is None:
+            snapshot_dir = os.getenv("SESSION_SNAPSHOT_DIR", "./session_data")
+        self.snapshot_store = SessionSnapshotStore(snapshot_dir) if snapshot_dir else None
+        self.snapshot_interval = float(os.getenv("SESSION_SNAPSHOT_INTERVAL_SECONDS", "5"))
+        self._dirty: set = set()  # 次の書き出しで保存するセッションID
+        self._deleted: set = set()  # 次の書き出しでファイルを削除するセッションID
+        # スナップショットが無いと確認済みのセッションID -> 確認した時刻（同じIDで何度もディスクを読まない）。
+        # 終了中の旧プロセスが後から書き出すこともあるので、missing_cache_seconds 後にはもう一度確認する
+        self._missing: "OrderedDict[str, float]" = OrderedDict()
+        self.missing_cache_size = 10000
+        self.missing_cache_seconds = 60.0
+        
+        # 定期的なクリーンアップ・スナップショットのタスク（start() でイベントループ上に起動）
+        self._cleanup_task: Optional[asyncio.Task] = None
+        self._snapshot_task: Optional[asyncio.Task] = None
+    
+    def start(self):
+        """
+        バックグラウンドタスクを開始（アプリケーションの起動時に呼び出す）
+        """
+        if self._cleanup_task is None or self._cleanup_task.done():
+            self._cleanup_task = asyncio.create_task(self._cleanup_expired_sessions())
+        if self.snapshot_store is not None and (self._snapshot_task is None or self._snapshot_task.done()):
+            self._snapshot_task = asyncio.create_task(self._snapshot_loop())
+    
+    async def stop(self):
+        """
+        バックグラウンドタスクを停止し、未保存のセッションを書き出す（アプリケーションの終了時に呼び出す）
+        """
+        for task in (self._cleanup_task, self._snapshot_task):
+            if task is not None:
+                task.cancel()
+                try:
+                    await task
+                except asyncio.CancelledError:
+                    pass
+        self._cleanup_task = None
+        self._snapshot_task = None
+        
+        try:
+            await self.flush_snapshots()
+        except Exception as e:
+            logger.error(f"セッションのスナップショット保存中にエラー: {str(e)}")
     
     def create_session(self) -> str:
         """
@@ -33,11 +92,12 @@ class SessionService:
         session_id = str(uuid.uuid4())
         self.sessions[session_id] = {
             "id": session_id,
-            "messages": [],
+            "messages": [],  # Message のリスト
             "created_at": datetime.now(),
             "last_accessed": datetime.now(),
             "metadata": {}
         }
+        self._dirty.add(session_id)
         logger.info(f"新しいセッションを作成: {session_id}")
         return session_id
     
@@ -52,6 +112,9 @@ class SessionService:
             セッション情報、存在しない場合はNone
         """
         session = self.sessions.get(session_id)
+        if session is None and self.snapshot_store is not None:
+            # 再起動前のセッションは初回アクセス時にスナップショットから復元
+            session = self._restore(session_id)
         if session:
             # 最終アクセス時刻を更新
             session["last_accessed"] = datetime.now()
@@ -79,13 +142,9 @@ class SessionService:
         if not session:
             return False
         
-        message = {
-            "role": role,
-            "content": content,
-            "timestamp": datetime.now().isoformat()
-        }
-        
-        session["messages"].append(message)
+        role = sys.intern(role)
+        session["messages"].append((role, content, time.time()))
+        self._dirty.add(session_id)
         logger.debug(f"セッション {session_id} にメッセージを追加: {role}")
         return True
     
@@ -98,23 +157,15 @@ class SessionService:
             limit: 取得するメッセージ数の上限
             
         Returns:
-            メッセージのリスト
+            API形式のメッセージのリスト
         """
         session = self.get_session(session_id)
         if not session:
             return []
         
-        messages = session["messages"]
-        
-        # APIに送信する形式に変換（timestampを除外）
-        api_messages = [
-            {"role": msg["role"], "content": msg["content"]}
-            for msg in messages
-        ]
-        
-        if limit:
-            return api_messages[-limit:]
-        return api_messages
+        # 先に切り出してから、返す分だけをAPI形式に変換する
+        messages = session["messages"][-limit:] if limit else session["messages"]
+        return [_api_message(role, content) for role, content, _ in messages]
     
     def delete_session(self, session_id: str) -> bool:
         """
@@ -126,8 +177,14 @@ class SessionService:
         Returns:
             削除に成功した場合True
         """
+        if session_id not in self.sessions and self.snapshot_store is not None:
+            # まだ復元されていないセッションも削除できるよう、先に復元する
+            self._restore(session_id)
         if session_id in self.sessions:
             del self.sessions[session_id]
+            self._dirty.discard(session_id)
+            if self.snapshot_store is not None:
+                self._deleted.add(session_id)
             logger.info(f"セッションを削除: {session_id}")
             return True
         return False
@@ -148,8 +205,25 @@ class SessionService:
             return False
         
         session["metadata"].update(metadata)
+        self._dirty.add(session_id)
         return True
     
+    def get_search_filters(self, session_id: str) -> Optional[Dict]:
+        """
+        セッションに設定されたRAG検索の絞り込み条件を取得
+        
+        Args:
+            session_id: セッションID
+            
+        Returns:
+            絞り込み条件、未設定の場合はNone
+        """
+        session = self.get_session(session_id)
+        if not session:
+            return None
+        
+        return session["metadata"].get("search_filters")
+    
     def _is_session_expired(self, session: Dict) -> bool:
         """
         セッションが期限切れかチェック
@@ -163,6 +237,102 @@ class SessionService:
         last_accessed = session.get("last_accessed", session["created_at"])
         return datetime.now() - last_accessed > self.session_timeout
     
+    def _restore(self, session_id: str) -> Optional[Dict]:
+        """
+        スナップショットからセッションを復元
+        
+        Args:
+            session_id: セッションID
+            
+        Returns:
+            復元したセッション情報、保存されていないか期限切れの場合はNone
+        """
+        # 存在しないIDのたびにイベントループ上でファイルを探さないよう、形式の確認と確認済みのIDで先に弾く
+        if session_id in self._deleted or not SessionSnapshotStore.valid_session_id(session_id):
+            return None
+        checked_at = self._missing.get(session_id)
+        if checked_at is not None and time.monotonic() - checked_at < self.missing_cache_seconds:
+            return None
+        
+        data = self.snapshot_store.load(session_id)
+        if data is None:
+            self._missing[session_id] = time.monotonic()
+            self._missing.move_to_end(session_id)
+            while len(self._missing) > self.missing_cache_size:
+                self._missing.popitem(last=False)
+            return None
+        self._missing.pop(session_id, None)
+        if time.time() - data["last_accessed"] > self.session_timeout.total_seconds():
+            self._deleted.add(session_id)
+            return None
+        
+        messages = [(sys.intern(role), content, timestamp) for role, content, timestamp in data["messages"]]
+        session = {
+            "id": session_id,
+            "messages": messages,
+            "created_at": datetime.fromtimestamp(data["created_at"]),
+            "last_accessed": datetime.fromtimestamp(data["last_accessed"]),
+            "metadata": data["metadata"]
+        }
+        self.sessions[session_id] = session
+        logger.info(f"セッションをスナップショットから復元: {session_id}")
+        return session
+    
+    def _write_snapshots(self, records: List[tuple], deleted: set):
+        """スナップショットを書き出す（スレッドで実行）"""
+        for session_id, created_at, last_accessed, metadata_json, messages in records:
+            self.snapshot_store.save(
+                session_id, SessionSnapshotStore.encode(created_at, last_accessed, metadata_json, messages)
+            )
+        for session_id in deleted:
+            self.snapshot_store.delete(session_id)
+    
+    async def flush_snapshots(self) -> int:
+        """
+        変更のあったセッションのスナップショットを書き出す
+        
+        Returns:
+            書き出したセッション数
+        """
+        if self.snapshot_store is None or not (self._dirty or self._deleted):
+            return 0
+        
+        # 書き出す内容はイベントループ上で確定させ、エンコードとファイル書き込みはスレッドで行う
+        dirty, self._dirty = self._dirty, set()
+        deleted, self._deleted = self._deleted, set()
+        records = []
+        for session_id in dirty:
+            session = self.sessions.get(session_id)
+            if session is None:
+                continue
+            records.append((
+                session_id,
+                session["created_at"].timestamp(),
+                session["last_accessed"].timestamp(),
+                json.dumps(session["metadata"], ensure_ascii=False, default=str),
+                list(session["messages"])
+            ))
+        
+        try:
+            await asyncio.to_thread(self._write_snapshots, records, deleted)
+        except Exception:
+            # 書き出せなかったセッションは次回に回す
+            self._dirty.update(dirty & self.sessions.keys())
+            self._deleted.update(deleted)
+            raise
+        return len(records)
+    
+    async def _snapshot_loop(self):
+        """
+        変更のあったセッションを定期的に書き出す
+        """
+        while True:
+            await asyncio.sleep(self.snapshot_interval)
+            try:
+                await self.flush_snapshots()
+            except Exception as e:
+                logger.error(f"セッションのスナップショット保存中にエラー: {str(e)}")
+    
     async def _cleanup_expired_sessions(self):
         """
         期限切れセッションを定期的にクリーンアップ
@@ -182,6 +352,12 @@ class SessionService:
                 
                 if expired_sessions:
                     logger.info(f"{len(expired_sessions)} 個の期限切れセッションを削除")
+                
+                # 復元されないまま期限が切れたスナップショットも削除
+                if self.snapshot_store is not None:
+                    await asyncio.to_thread(
+                        self.snapshot_store.remove_expired, self.session_timeout.total_seconds()
+                    )
                     
             except Exception as e:
                 logger.error(f"セッションクリーンアップ中にエラー: {str(e)}")
@@ -0,0 +1,183 @@
+"""
+セッションのスナップショットの保存先（再起動後も会話を引き継ぐため）
+
+1セッション1ファイルのバイナリ形式で、変更のあったセッションだけを書き出す。
+読み込みは初回アクセス時にそのセッションのファイルだけを読むので、起動は待たされない。
+
+ファイル形式:
+    b"SES1" + CRC32(4バイト) + zlib圧縮したペイロード
+ペイロード:
+    作成時刻・最終アクセス時刻（float64 x 2）
+    メタデータ（長さ uint32 + JSON）
+    メッセージ数（uint32）と、各メッセージの 役割(uint8) + 時刻(float64) + 本文(長さ uint32 + UTF-8)
+    役割が定義済みの番号に無い場合は 255 の後に長さ uint8 + 役割名
+"""
+import os
+import json
+import time
+import uuid
+import zlib
+import struct
+import tempfile
+from typing import Dict, Iterable, List, Optional, Tuple
+
+MAGIC = b"SES1"
+_ROLES = ("system", "user", "assistant")
+_ROLE_CODES = {role: code for code, role in enumerate(_ROLES)}
+_OTHER_ROLE = 255
+
+_TIMES = struct.Struct(">dd")
+_LENGTH = struct.Struct(">I")
+_MESSAGE = struct.Struct(">BdI")
+
+
+class SessionSnapshotStore:
+    """セッションのスナップショットを1セッション1ファイルで保存する"""
+
+    def __init__(self, base_dir: str):
+        """
+        Args:
+            base_dir: スナップショットを保存するディレクトリ
+        """
+        self.base_dir = base_dir
+
+    @staticmethod
+    def valid_session_id(session_id: str) -> bool:
+        """ファイル名に使えるセッションID（UUID）か"""
+        try:
+            return str(uuid.UUID(session_id)) == session_id
+        except (ValueError, TypeError, AttributeError):
+            return False
+
+    def _path(self, session_id: str) -> str:
+        # 1ディレクトリのファイル数を抑えるため先頭2文字で分ける
+        return os.path.join(self.base_dir, session_id[:2], f"{session_id}.bin")
+
+    @staticmethod
+    def encode(created_at: float, last_accessed: float, metadata_json: str,
+               messages: Iterable[Tuple[str, str, float]]) -> bytes:
+        """セッションをバイナリに変換"""
+        parts = [_TIMES.pack(created_at, last_accessed)]
+        metadata = metadata_json.encode('utf-8')
+        parts.append(_LENGTH.pack(len(metadata)) + metadata)
+
+        messages = list(messages)
+        parts.append(_LENGTH.pack(len(messages)))
+        for role, content, timestamp in messages:
+            data = content.encode('utf-8')
+            code = _ROLE_CODES.get(role, _OTHER_ROLE)
+            parts.append(_MESSAGE.pack(code, timestamp, len(data)))
+            if code == _OTHER_ROLE:
+                name = role.encode('utf-8')[:255]
+                parts.append(bytes([len(name)]) + name)
+            parts.append(data)
+
+        payload = zlib.compress(b"".join(parts), 1)
+        return MAGIC + _LENGTH.pack(zlib.crc32(payload)) + payload
+
+    @staticmethod
+    def decode(data: bytes) -> Optional[Dict]:
+        """
+        バイナリからセッションを復元
+
+        Returns:
+            created_at / last_accessed（UNIX時間）/ metadata / messages（(役割, 本文, 時刻) のリスト）。
+            壊れている場合はNone
+        """
+        if data[:4] != MAGIC or len(data) < 8:
+            return None
+        payload = data[8:]
+        if zlib.crc32(payload) != _LENGTH.unpack_from(data, 4)[0]:
+            return None
+        raw = zlib.decompress(payload)
+
+        created_at, last_accessed = _TIMES.unpack_from(raw, 0)
+        offset = _TIMES.size
+        (length,) = _LENGTH.unpack_from(raw, offset)
+        offset += _LENGTH.size
+        metadata = json.loads(raw[offset:offset + length].decode('utf-8'))
+        offset += length
+
+        (count,) = _LENGTH.unpack_from(raw, offset)
+        offset += _LENGTH.size
+        messages: List[Tuple[str, str, float]] = []
+        for _ in range(count):
+            code, timestamp, length = _MESSAGE.unpack_from(raw, offset)
+            offset += _MESSAGE.size
+            if code == _OTHER_ROLE:
+                name_length = raw[offset]
+                role = raw[offset + 1:offset + 1 + name_length].decode('utf-8')
+                offset += 1 + name_length
+            else:
+                role = _ROLES[code]
+            messages.append((role, raw[offset:offset + length].decode('utf-8'), timestamp))
+            offset += length
+
+        return {
+            'created_at': created_at,
+            'last_accessed': last_accessed,
+            'metadata': metadata,
+            'messages': messages
+        }
+
+    def save(self, session_id: str, data: bytes) -> None:
+        """エンコード済みのセッションを書き込む（一時ファイル + rename で置き換え）"""
+        path = self._path(session_id)
+        directory = os.path.dirname(path)
+        os.makedirs(directory, exist_ok=True)
+        fd, temp_path = tempfile.mkstemp(dir=directory, prefix=".tmp-")
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                f.write(data)
+            os.replace(temp_path, path)
+        except BaseException:
+            try:
+                os.unlink(temp_path)
+            except FileNotFoundError:
+                pass
+            raise
+
+    def load(self, session_id: str) -> Optional[Dict]:
+        """保存済みのセッションを読み込む（無い・壊れている場合はNone）"""
+        if not self.valid_session_id(session_id):
+            return None
+        try:
+            with open(self._path(session_id), 'rb') as f:
+                data = f.read()
+        except FileNotFoundError:
+            return None
+        try:
+            return self.decode(data)
+        except (ValueError, struct.error, zlib.error, UnicodeDecodeError, IndexError):
+            return None
+
+    def delete(self, session_id: str) -> None:
+        """保存済みのセッションを削除"""
+        if not self.valid_session_id(session_id):
+            return
+        try:
+            os.unlink(self._path(session_id))
+        except FileNotFoundError:
+            pass
+
+    def remove_expired(self, max_age: float) -> int:
+        """
+        max_age 秒以上更新されていないスナップショットを削除
+
+        Returns:
+            削除したファイル数
+        """
+        removed = 0
+        deadline = time.time() - max_age
+        if not os.path.isdir(self.base_dir):
+            return 0
+        for directory, _, files in os.walk(self.base_dir):
+            for name in files:
+                path = os.path.join(directory, name)
+                try:
+                    if os.path.getmtime(path) < deadline:
+                        os.unlink(path)
+                        removed += 1
+                except FileNotFoundError:
+                    pass
+        return removed
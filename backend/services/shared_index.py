@@ -0,0 +1,214 @@
+"""
+ワーカー間で共有するベクトルインデックスのスナップショット管理
+
+埋め込みは世代ごとの .npy ファイルとして書き出し、各ワーカーは読み取り専用の
+mmap で参照する。ページキャッシュが共有されるため、uvicorn のワーカー数を
+増やしてもコーパスの埋め込みは1つ分のメモリで済む。
+
+チャンクの本文とメタデータも1行1件の JSON として書き出して mmap し、参照された行だけを
+デコードする。絞り込み用の索引などの列（任意の名前の配列）も .npy として一緒に書き出せる。
+"""
+import os
+import re
+import json
+from collections.abc import Sequence
+from contextlib import contextmanager
+from datetime import datetime
+from typing import Callable, Dict, List, Optional, Tuple
+
+import numpy as np
+
+try:
+    import fcntl
+except ImportError:  # Windows ではプロセス間ロックを行わない
+    fcntl = None
+
+
+class DocumentTable(Sequence):
+    """
+    mmap したスナップショットの行と、その後に追加された行を連結したドキュメントの列
+
+    スナップショットの行は参照されたときに1行ずつデコードするので、ワーカーのヒープには載らない。
+    """
+
+    def __init__(self, data: Optional[np.ndarray] = None, offsets: Optional[np.ndarray] = None,
+                 appended: Optional[List[Dict]] = None):
+        """
+        Args:
+            data: 1行1件の JSON を連結したバイト列（mmap）
+            offsets: 各行の開始位置（末尾に全体の長さを含む）
+            appended: スナップショットの後に追加された行
+        """
+        self._data = data
+        self._offsets = offsets
+        self._mapped = len(offsets) - 1 if offsets is not None else 0
+        self._appended = appended or []
+
+    def __len__(self) -> int:
+        return self._mapped + len(self._appended)
+
+    def __getitem__(self, row: int) -> Dict:
+        if row < 0:
+            row += len(self)
+        if row < 0 or row >= len(self):
+            raise IndexError(row)
+        if row >= self._mapped:
+            return self._appended[row - self._mapped]
+        start, end = self._offsets[row], self._offsets[row + 1]
+        return json.loads(self._data[start:end].tobytes())
+
+    def extended(self, documents: List[Dict]) -> 'DocumentTable':
+        """末尾に行を追加した列（スナップショットの行は共有する）"""
+        return DocumentTable(self._data, self._offsets, self._appended + documents)
+
+
+class SharedIndexStore:
+    """世代番号付きのインデックススナップショットストア"""
+
+    def __init__(self, base_dir: str, keep_generations: int = 2):
+        """
+        Args:
+            base_dir: スナップショットを保存するディレクトリ
+            keep_generations: 削除せずに残す世代数（読み込み中のワーカー用）
+        """
+        self.base_dir = base_dir
+        self.current_file = os.path.join(self.base_dir, "CURRENT")
+        self.lock_file = os.path.join(self.base_dir, "LOCK")
+        self.keep_generations = max(1, keep_generations)
+
+    def _paths(self, generation: int) -> Tuple[str, str]:
+        """世代のベクトルファイルとメタデータファイルのパス"""
+        prefix = os.path.join(self.base_dir, f"gen-{generation:08d}")
+        return f"{prefix}.npy", f"{prefix}.json"
+
+    def _data_path(self, generation: int, name: str) -> str:
+        """世代のドキュメント・列のファイルのパス"""
+        return os.path.join(self.base_dir, f"gen-{generation:08d}-{name}")
+
+    def wal_path(self, generation: int) -> str:
+        """世代のスナップショット以降の変更を記録するログのパス"""
+        return os.path.join(self.base_dir, f"wal-{generation:08d}.log")
+
+    def current_generation(self) -> int:
+        """公開済みの最新世代番号（未公開なら0）"""
+        try:
+            with open(self.current_file, 'r', encoding='utf-8') as f:
+                return int(f.read().strip() or 0)
+        except (FileNotFoundError, ValueError):
+            return 0
+
+    @contextmanager
+    def writer_lock(self):
+        """書き込みプロセス間の排他ロック"""
+        os.makedirs(self.base_dir, exist_ok=True)
+        with open(self.lock_file, 'a+') as f:
+            if fcntl:
+                fcntl.flock(f.fileno(), fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                if fcntl:
+                    fcntl.flock(f.fileno(), fcntl.LOCK_UN)
+
+    def _write_atomic(self, path: str, writer: Callable) -> None:
+        """一時ファイルに書いてから rename で置き換える"""
+        temp_path = f"{path}.tmp{os.getpid()}"
+        with open(temp_path, 'wb') as f:
+            writer(f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(temp_path, path)
+
+    def publish(
+        self,
+        documents: List[Dict],
+        embeddings: np.ndarray,
+        extra: Optional[Dict] = None,
+        columns: Optional[Dict[str, np.ndarray]] = None
+    ) -> int:
+        """
+        新しい世代を書き出して公開する（writer_lock の内側で呼ぶこと）
+
+        Args:
+            documents: 埋め込みを除いたチャンクのリスト
+            embeddings: documents と同じ順序の埋め込み行列
+            extra: メタデータに追加で記録する値
+            columns: 一緒に書き出す配列（名前 -> 配列）
+
+        Returns:
+            公開した世代番号
+        """
+        generation = self.current_generation() + 1
+        vectors_path, meta_path = self._paths(generation)
+        embeddings = np.ascontiguousarray(embeddings, dtype=np.float32)
+        columns = dict(columns or {})
+
+        # ドキュメントは1行1件の JSON と各行の開始位置にする
+        lines = [json.dumps(doc, ensure_ascii=False).encode('utf-8') for doc in documents]
+        columns['offsets'] = np.cumsum([0] + [len(line) for line in lines], dtype=np.int64)
+
+        meta = {
+            'generation': generation,
+            'count': len(documents),
+            'dimension': int(embeddings.shape[1]) if embeddings.ndim == 2 else 0,
+            'created_at': datetime.now().isoformat(),
+            'columns': sorted(columns),
+        }
+        meta.update(extra or {})
+
+        self._write_atomic(vectors_path, lambda f: np.save(f, embeddings))
+        self._write_atomic(self._data_path(generation, "documents.jsonl"), lambda f: f.write(b"".join(lines)))
+        for name, column in columns.items():
+            self._write_atomic(self._data_path(generation, f"{name}.npy"), lambda f: np.save(f, column))
+        self._write_atomic(meta_path, lambda f: f.write(json.dumps(meta, ensure_ascii=False).encode('utf-8')))
+        # CURRENT の置き換えが公開の瞬間になる
+        self._write_atomic(self.current_file, lambda f: f.write(str(generation).encode('utf-8')))
+
+        self._remove_old_generations(generation)
+        return generation
+
+    def load(self, generation: int) -> Tuple[Dict, np.ndarray, DocumentTable, Dict[str, np.ndarray]]:
+        """
+        指定世代を読み込む（ドキュメントと列も mmap するだけで、中身は読み込まない）
+
+        Returns:
+            (メタデータ, 読み取り専用でmmapした埋め込み行列, ドキュメント, 列)
+        """
+        vectors_path, meta_path = self._paths(generation)
+        with open(meta_path, 'r', encoding='utf-8') as f:
+            meta = json.load(f)
+        embeddings = np.load(vectors_path, mmap_mode='r')
+
+        if 'documents' in meta:
+            # ドキュメントをメタデータに含めていた以前の形式（次のコンパクションで書き直す）
+            return meta, embeddings, DocumentTable(appended=meta.pop('documents')), {}
+
+        # 列は小さなスライスを多数作るので、memmap ではなく通常の配列のビューとして扱う
+        columns = {
+            name: np.load(self._data_path(generation, f"{name}.npy"), mmap_mode='r').view(np.ndarray)
+            for name in meta['columns']
+        }
+        offsets = columns.pop('offsets')
+        data = (
+            np.memmap(self._data_path(generation, "documents.jsonl"), dtype=np.uint8, mode='r')
+            if offsets[-1] else np.zeros(0, dtype=np.uint8)
+        )
+        return meta, embeddings, DocumentTable(data, offsets), columns
+
+    def is_mapped(self, generation: int) -> bool:
+        """ドキュメントを mmap できる形式で書き出した世代か"""
+        return os.path.exists(self._data_path(generation, "documents.jsonl"))
+
+    def _remove_old_generations(self, generation: int) -> None:
+        """古い世代のファイルとログを削除（mmap中のワーカーはPOSIXでは影響を受けない）"""
+        oldest_kept = generation - self.keep_generations + 1
+        for name in os.listdir(self.base_dir):
+            # 書き込み途中の一時ファイル（.tmp<pid>）は対象外
+            match = re.fullmatch(r"(?:gen|wal)-(\d{8})(?:-[\w.-]+)?\.(?:npy|json|jsonl|log)", name)
+            if match is None:
+                continue
+            if int(match.group(1)) < oldest_kept:
+                try:
+                    os.remove(os.path.join(self.base_dir, name))
+                except OSError:
+                    pass
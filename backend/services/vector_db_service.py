@@ -4,11 +4,28 @@
 import os
 import json
 import math
-from typing import List, Dict, Optional
-from openai import AzureOpenAI
+import time
+import asyncio
+import threading
+from typing import Any, Callable, List, Dict, NamedTuple, Optional, Sequence, Tuple, Union
+from collections import defaultdict
+import base64
 import hashlib
+import heapq
+import itertools
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
 
+import numpy as np
+
+from .shared_index import DocumentTable, SharedIndexStore
+from .wal import WriteAheadLog
+from .near_duplicate import MinHasher, NearDuplicateIndex
+from .deployment_router import embedding_deployments
+from .coarse_search import build_reducer, coarse_method
+from .profiler import phase
+from .index_export import SnapshotBundle, SnapshotError, load_bundle, read_manifest, write_bundle
+
 
 class SimpleTextSplitter:
     """シンプルなテキスト分割器"""
@@ -67,163 +84,1508 @@ def cosine_similarity(vec1: List[float], vec2: List[float]) -> float:
         return 0.0
 
 
+class MetadataIndex:
+    """
+    メタデータによる絞り込み用インデックス（フィールド値ごとの行IDセット）
+    
+    スナップショットの行の分は公開時に作った列（値ごとの行ID、作成日時の並び順）を mmap で参照し、
+    ワーカーではその後ログで追加された行の分だけを作る。
+    """
+    
+    # 絞り込みに使えるフィールド（値ごとの行IDセットを事前に構築する）
+    PRECOMPUTED_FIELDS = ('source', 'file_type', 'content_hash')
+    # 範囲指定フィルタ: フィルタ名 -> (対象フィールド, searchsortedのside)
+    RANGE_FILTERS = {
+        'created_after': ('created_at', 'left'),
+        'created_before': ('created_at', 'left'),
+    }
+    RANGE_FIELDS = ('created_at',)
+    
+    def __init__(self, documents: Sequence = ()):
+        self.size = 0
+        self._id_sets: Dict[str, Dict[Any, np.ndarray]] = {field: {} for field in self.PRECOMPUTED_FIELDS}
+        # 範囲指定用: フィールド -> (スナップショットの行の並び順, ソート済みの値, 追加された行の値)
+        self._sorted: Dict[str, Tuple[np.ndarray, np.ndarray, np.ndarray]] = {
+            field: (np.zeros(0, dtype=np.int64), np.zeros(0, dtype='S1'), np.zeros(0, dtype='S1'))
+            for field in self.RANGE_FIELDS
+        }
+        if len(documents):
+            self._append(range(len(documents)), [documents[i] for i in range(len(documents))])
+    
+    @staticmethod
+    def _range_key(doc: Dict, field: str) -> bytes:
+        return str(doc.get(field, '')).encode('utf-8')
+    
+    @classmethod
+    def build_columns(cls, documents: List[Dict]) -> Tuple[Dict[str, List], Dict[str, np.ndarray]]:
+        """
+        スナップショットと一緒に公開する列を作成
+        
+        Returns:
+            (フィールドごとの値のリスト, 列)。値 i の行IDは {field}-rows[{field}-starts[i]:{field}-starts[i+1]]
+        """
+        values, columns = {}, {}
+        for field in cls.PRECOMPUTED_FIELDS:
+            rows = defaultdict(list)
+            for i, doc in enumerate(documents):
+                value = doc.get(field)
+                if isinstance(value, (list, dict)):
+                    continue
+                rows[value].append(i)
+            values[field] = list(rows)
+            columns[f"{field}-rows"] = np.array([i for ids in rows.values() for i in ids], dtype=np.int64)
+            columns[f"{field}-starts"] = np.cumsum([0] + [len(ids) for ids in rows.values()], dtype=np.int64)
+        for field in cls.RANGE_FIELDS:
+            keys = np.array([cls._range_key(doc, field) for doc in documents], dtype=bytes)
+            order = np.argsort(keys, kind='stable')
+            columns[f"{field}-order"] = order.astype(np.int64)
+            columns[f"{field}-sorted"] = keys[order]
+        return values, columns
+    
+    @classmethod
+    def from_columns(cls, documents: Sequence, values: Dict[str, List], columns: Dict[str, np.ndarray]) -> 'MetadataIndex':
+        """公開済みの列から作成（行IDは mmap した列のビューで、コピーしない）"""
+        index = cls()
+        index.size = len(documents)
+        for field in cls.PRECOMPUTED_FIELDS:
+            rows, starts = columns[f"{field}-rows"], columns[f"{field}-starts"]
+            index._id_sets[field] = {
+                value: rows[starts[i]:starts[i + 1]] for i, value in enumerate(values[field])
+            }
+        for field in cls.RANGE_FIELDS:
+            index._sorted[field] = (columns[f"{field}-order"], columns[f"{field}-sorted"], np.zeros(0, dtype='S1'))
+        return index
+    
+    def _append(self, rows: range, new_documents: List[Dict]):
+        """行を追加する（構築済みのフィールドは追加分だけ処理する）"""
+        for field, id_sets in self._id_sets.items():
+            new_rows = defaultdict(list)
+            for i, doc in zip(rows, new_documents):
+                value = doc.get(field)
+                if isinstance(value, (list, dict)):
+                    continue
+                new_rows[value].append(i)
+            
+            merged = dict(id_sets)
+            for value, ids in new_rows.items():
+                ids = np.array(ids, dtype=np.int64)
+                merged[value] = np.concatenate([merged[value], ids]) if value in merged else ids
+            self._id_sets[field] = merged
+        
+        for field, (order, sorted_values, appended) in self._sorted.items():
+            keys = np.array([self._range_key(doc, field) for doc in new_documents], dtype=bytes)
+            self._sorted[field] = (order, sorted_values, np.concatenate([appended, keys]))
+        self.size += len(new_documents)
+    
+    def extended(self, documents: Sequence) -> 'MetadataIndex':
+        """
+        末尾に行を追加したインデックスを作成（構築済みのフィールドは追加分だけ処理する）
+        
+        Args:
+            documents: 既存の行の後ろに新しい行を追加した列
+        """
+        index = MetadataIndex.__new__(MetadataIndex)
+        index.size = self.size
+        index._id_sets = dict(self._id_sets)
+        index._sorted = dict(self._sorted)
+        index._append(range(self.size, len(documents)), [documents[i] for i in range(self.size, len(documents))])
+        return index
+    
+    def values(self, field: str) -> List[Any]:
+        """フィールドの値の一覧"""
+        return list(self._id_sets[field])
+    
+    def rows(self, field: str, value: Any) -> np.ndarray:
+        """フィールドが指定した値を持つ行IDを取得"""
+        return self._id_sets[field].get(value, np.zeros(0, dtype=np.int64))
+    
+    @classmethod
+    def validate_filters(cls, filters: Any) -> Optional[Dict]:
+        """
+        クライアントから受け取った絞り込み条件を確認して正規化する
+        
+        Returns:
+            {フィールド: 値のリスト または 日時の文字列}（Noneの条件は除く）。条件が無ければNone
+            
+        Raises:
+            ValueError: 対応していないフィールドや、形式の合わない値が含まれる場合
+        """
+        if filters is None:
+            return None
+        if not isinstance(filters, dict):
+            raise ValueError("filters はオブジェクトで指定してください")
+        
+        normalized = {}
+        for key, condition in filters.items():
+            if condition is None:
+                continue
+            if key in cls.RANGE_FILTERS:
+                try:
+                    datetime.fromisoformat(condition)
+                except (TypeError, ValueError):
+                    raise ValueError(f"{key} は ISO 8601 形式の日時の文字列で指定してください")
+                normalized[key] = condition
+            elif key in cls.PRECOMPUTED_FIELDS:
+                values = condition if isinstance(condition, list) else [condition]
+                if not all(isinstance(value, str) for value in values):
+                    raise ValueError(f"{key} は文字列または文字列のリストで指定してください")
+                normalized[key] = values
+            else:
+                supported = ", ".join(cls.PRECOMPUTED_FIELDS + tuple(cls.RANGE_FILTERS))
+                raise ValueError(f"絞り込みに使えないフィールドです: {key}（使えるもの: {supported}）")
+        return normalized or None
+    
+    def mask(self, filters: Optional[Dict]) -> Optional[np.ndarray]:
+        """
+        フィルタ条件に一致する行のビットマップを作成
+        
+        Args:
+            filters: {フィールド: 値 または 値のリスト} 形式の条件（フィールドは PRECOMPUTED_FIELDS）。
+                created_after / created_before で作成日時の範囲も指定できる
+        
+        Returns:
+            一致する行がTrueの真偽値配列。フィルタなしの場合はNone
+            
+        Raises:
+            ValueError: 対応していないフィールドが含まれる場合
+        """
+        if not filters:
+            return None
+        
+        result = np.ones(self.size, dtype=bool)
+        for key, condition in filters.items():
+            if condition is None:
+                continue
+            
+            field_mask = np.zeros(self.size, dtype=bool)
+            if key in self.RANGE_FILTERS:
+                field, side = self.RANGE_FILTERS[key]
+                order, sorted_values, appended = self._sorted[field]
+                bound = str(condition).encode('utf-8')
+                position = np.searchsorted(sorted_values, bound, side=side)
+                # スナップショットの行はソート済みの値で、追加された行は直接比較する
+                if key == 'created_after':
+                    field_mask[order[position:]] = True
+                    field_mask[len(order):] = appended >= bound
+                else:
+                    field_mask[order[:position]] = True
+                    field_mask[len(order):] = appended < bound
+            elif key in self._id_sets:
+                values = condition if isinstance(condition, (list, tuple, set)) else [condition]
+                id_sets = self._id_sets[key]
+                for value in values:
+                    ids = id_sets.get(value)
+                    if ids is not None:
+                        field_mask[ids] = True
+            else:
+                raise ValueError(f"絞り込みに使えないフィールドです: {key}")
+            
+            result &= field_mask
+        return result
+
+
+class IndexSnapshot(NamedTuple):
+    """
+    ある時点のインデックスの状態
+    
+    作成後は変更しない（配列は書き込み不可にしている）。更新時は新しいスナップショットを作り、
+    VectorDBService._snapshot を1回の代入で差し替えるので、検索はロックなしで一貫した状態を読める。
+    """
+    generation: int  # 共有スナップショットの世代（0は未作成）
+    wal: Optional[WriteAheadLog]  # この世代の変更ログ
+    wal_offset: int  # 取り込み済みのログの末尾
+    documents: DocumentTable  # 全行（削除済みの行を含む。埋め込みは blocks に分離）
+    blocks: Tuple[Tuple[np.ndarray, np.ndarray], ...]  # (埋め込み行列, ノルム)。先頭はスナップショットをmmapした行列
+    live: np.ndarray  # 削除されていない行
+    metadata_index: MetadataIndex  # メタデータ絞り込み用インデックス
+    references: List[Dict]  # 準重複として登録を省略したチャンク（正規のチャンクへの参照）
+    reference_rows: np.ndarray  # 参照ごとの正規のチャンクの行番号（見つからなければ -1）
+    reference_index: MetadataIndex  # 参照のメタデータ絞り込み用インデックス
+
+
+def _read_only(array: np.ndarray) -> np.ndarray:
+    """スナップショットに入れる配列を書き込み不可にする"""
+    array.flags.writeable = False
+    return array
+
+
+EMPTY_SNAPSHOT = IndexSnapshot(
+    generation=0,
+    wal=None,
+    wal_offset=0,
+    documents=DocumentTable(),
+    blocks=(),
+    live=_read_only(np.zeros(0, dtype=bool)),
+    metadata_index=MetadataIndex([]),
+    references=[],
+    reference_rows=_read_only(np.zeros(0, dtype=np.int64)),
+    reference_index=MetadataIndex([])
+)
+
+
+class IndexNotReady(Exception):
+    """インデックスの読み込みが完了していないため書き込めない（読み込み中・読み込み失敗）"""
+
+
 class VectorDBService:
     def __init__(self):
         # データ保存ディレクトリ
         self.data_dir = "./vector_db_data"
-        os.makedirs(self.data_dir, exist_ok=True)
         
-        # メタデータ保存
+        # 旧形式のデータ（共有スナップショットが無い場合の初回移行にのみ使用）
         self.metadata_file = os.path.join(self.data_dir, "documents.json")
-        self.documents = []  # ドキュメントのリスト（埋め込み含む）
+        # 現在のインデックス（検索はこれを1回読むだけで、ロックを取らない）
+        self._snapshot = EMPTY_SNAPSHOT
+        # 新しいスナップショットを作るのは同時に1スレッドだけ
+        self._refresh_lock = threading.Lock()
+        # 他のワーカーが公開した世代やログの追記は、検索では待たずにこのスレッドで取り込む
+        self._refresh_requested = threading.Event()
+        self._refresher_lock = threading.Lock()
+        self._refresher: Optional[threading.Thread] = None
         
-        # Azure OpenAI クライアント
-        self.openai_client = AzureOpenAI(
-            api_key=os.getenv("AZURE_OPENAI_API_KEY"),
-            api_version=os.getenv("AZURE_OPENAI_API_VERSION", "2024-02-01"),
-            azure_endpoint=os.getenv("AZURE_OPENAI_ENDPOINT")
-        )
+        # 変更ログへの書き込み待ち。先にロックを取ったスレッドが待っている分もまとめて追記する
+        self._pending_writes: List[Dict] = []
+        self._pending_lock = threading.Lock()
+        # コミット中に compact() で世代を差し替えることがあるので再入可能にする
+        self._commit_lock = threading.RLock()
+        # 世代の差し替え時に他のスレッドがコミット中だったため、まだ閉じていない古い世代の変更ログ
+        self._retired_wals: List[WriteAheadLog] = []
+        
+        # ワーカー間で共有するインデックスと、スナップショット以降の変更ログ
+        self.shared_store = SharedIndexStore(os.path.join(self.data_dir, "shared"))
+        # ログがこの大きさを超えるか、削除済みの行がこの割合を超えたら新しいスナップショットにまとめる
+        self.compaction_threshold = int(os.getenv("VECTOR_DB_COMPACTION_MB", "32")) * 1024 * 1024
+        self.compaction_dead_ratio = float(os.getenv("VECTOR_DB_COMPACTION_DEAD_RATIO", "0.2"))
+        
+        # 他のノードへ複製するスナップショットの置き場所と、初回起動時（インデックスが未作成）に取り込むスナップショット
+        self.snapshot_export_dir = os.getenv("VECTOR_DB_SNAPSHOT_DIR", os.path.join(self.data_dir, "exports"))
+        self.import_snapshot_path = os.getenv("VECTOR_DB_IMPORT_SNAPSHOT", "")
+        
+        # 埋め込みはデプロイメントのルーター経由で取得（クライアントは初回利用時に生成）
+        self.embedding_router = embedding_deployments
         
         self.embedding_deployment = os.getenv("AZURE_OPENAI_EMBEDDING_DEPLOYMENT_NAME", "text-embedding-ada-002")
+        # 1回の埋め込みリクエストにまとめる入力数
+        self.embedding_batch_size = int(os.getenv("AZURE_OPENAI_EMBEDDING_BATCH_SIZE", "16"))
+        # 埋め込みAPIが返した入力トークン数の累計（一括取り込みのスループット計測用）
+        self.embedding_tokens = 0
+        self._usage_lock = threading.Lock()
+        
+        # 取り込み時の準重複チャンク検出（アップロードごとに変更可能）
+        self.dedup_enabled = os.getenv("VECTOR_DB_DEDUP", "true").lower() == "true"
+        self.dedup_threshold = float(os.getenv("VECTOR_DB_DEDUP_THRESHOLD", "0.9"))
+        self._min_hasher = MinHasher()
+        self._dedup_lock = threading.Lock()
+        self._dedup_state: Optional[Tuple[int, NearDuplicateIndex, int]] = None  # (世代, インデックス, 登録済みの行数)
+        
+        # 一括検索で1回の行列積にまとめるクエリ数
+        self.search_query_batch_size = 64
+        
+        # 2段階検索: 候補が多いときは低次元の粗い検索で絞り込み、元の次元で再スコア（0なら常に全次元で検索）
+        self.coarse_dims = int(os.getenv("VECTOR_DB_COARSE_DIMS", "0"))
+        self.coarse_method = coarse_method(os.getenv("VECTOR_DB_COARSE_METHOD", "auto"), self.embedding_deployment)
+        self.coarse_oversample = int(os.getenv("VECTOR_DB_COARSE_OVERSAMPLE", "10"))  # 再スコアする候補数（n_results の倍数）
+        self.coarse_min_candidates = 100
+        self.coarse_min_rows = int(os.getenv("VECTOR_DB_COARSE_MIN_ROWS", "10000"))  # これより少なければ全次元で検索
+        self._coarse_lock = threading.Lock()
+        self._coarse_state: Optional[Tuple[np.ndarray, Any, List[np.ndarray]]] = None  # (先頭ブロック, 低次元化, ブロックごとの行列)
+        
+        # 分割検索: 候補の行を均等に search_shards 個に分け、スレッドで並列にスコア計算して上位をマージする
+        # （NumPyの行列積はGILを解放するので複数コアを使える）
+        self.search_shards = int(os.getenv("VECTOR_DB_SEARCH_SHARDS", "1"))
+        self.shard_min_rows = int(os.getenv("VECTOR_DB_SHARD_MIN_ROWS", "20000"))  # これより少なければ分割しない
+        self._shard_lock = threading.Lock()
+        self._shard_executor: Optional[ThreadPoolExecutor] = None
+        # 候補（削除・絞り込み後の行）が全行のこの割合未満なら、候補の行だけを取り出してスコア計算する
+        self.gather_max_ratio = 0.1
         
         # テキスト分割器
         self.text_splitter = SimpleTextSplitter(chunk_size=1000, chunk_overlap=200)
         
-        # 既存データの読み込み
-        self._load_existing_data()
+        # インデックスの読み込み状態（load() または start_background_load() で読み込む）
+        self._load_lock = threading.Lock()
+        self._load_task: Optional[asyncio.Task] = None
+        self.load_status = {
+            'state': 'pending',  # pending / loading / ready / error
+            'phase': None,
+            'documents': 0,
+            'started_at': None,
+            'finished_at': None,
+            'error': None
+        }
+    
+    @property
+    def is_ready(self) -> bool:
+        """インデックスの読み込みが完了しているか"""
+        return self.load_status['state'] == 'ready'
+    
+    def load(self):
+        """既存のインデックスを読み込む（読み込み済みなら何もしない）"""
+        with self._load_lock:
+            if self.is_ready:
+                return
+            
+            self.load_status.update(state='loading', started_at=time.time(), finished_at=None, error=None)
+            try:
+                os.makedirs(self.data_dir, exist_ok=True)
+                self._load_existing_data()
+                self.load_status.update(state='ready', phase=None, documents=self.document_count)
+            except Exception as e:
+                print(f"インデックス読み込みエラー: {e}")
+                self.load_status.update(state='error', error=str(e))
+            finally:
+                self.load_status['finished_at'] = time.time()
+    
+    def start_background_load(self) -> asyncio.Task:
+        """イベントループを止めずにバックグラウンドでインデックスを読み込む"""
+        if self._load_task is None or (self._load_task.done() and not self.is_ready):
+            self._load_task = asyncio.create_task(asyncio.to_thread(self.load))
+        return self._load_task
+    
+    def get_load_status(self) -> Dict:
+        """インデックスの読み込み状況を取得"""
+        status = dict(self.load_status)
+        started_at, finished_at = status.pop('started_at'), status.pop('finished_at')
+        status['elapsed_seconds'] = (
+            round((finished_at or time.time()) - started_at, 3) if started_at else None
+        )
+        status['generation'] = self._snapshot.generation
+        if status['state'] == 'ready':
+            status['documents'] = self.document_count
+        return status
+    
+    @property
+    def generation(self) -> int:
+        """参照中の共有スナップショットの世代"""
+        return self._snapshot.generation
+    
+    @property
+    def index_version(self) -> Tuple[int, int]:
+        """参照中のインデックスの版（世代, 反映済みの変更ログの位置）。追加・削除のたびに変わる"""
+        snapshot = self._snapshot
+        return snapshot.generation, snapshot.wal_offset
+    
+    @property
+    def document_count(self) -> int:
+        """削除されていないチャンク数"""
+        return int(self._snapshot.live.sum())
+    
+    def ensure_loaded(self):
+        """
+        書き込み前にインデックスが読み込み済みか確認する
+        
+        読み込みの完了は待たない（イベントループから呼ばれるため）。バックグラウンドの読み込みを
+        使わない場合（一括取り込みのCLIなど）は、先に load() を呼んでおくこと。
+        
+        Raises:
+            IndexNotReady: 読み込み中、または読み込みに失敗している場合
+        """
+        if self.is_ready:
+            return
+        if self.load_status['state'] == 'error':
+            raise IndexNotReady(f"インデックスを読み込めません: {self.load_status['error']}")
+        raise IndexNotReady("インデックスを読み込み中です。しばらくしてから再度お試しください")
     
     def _load_existing_data(self):
         """既存のデータを読み込み"""
+        with self.shared_store.writer_lock():
+            if self.shared_store.current_generation() == 0 and self.import_snapshot_path:
+                # 他のノードが書き出したスナップショットから始める（埋め込みは再計算しない）
+                self.load_status['phase'] = 'importing'
+                bundle = self._read_bundle(self.import_snapshot_path, self._snapshot)
+                self.load_status['documents'] = bundle.manifest['count']
+                self._publish_bundle(bundle)
+            elif self.shared_store.current_generation() == 0:
+                # 共有スナップショットがまだ無ければ documents.json から作成
+                self.load_status['phase'] = 'migrating'
+                documents = []
+                if os.path.exists(self.metadata_file):
+                    with open(self.metadata_file, 'r', encoding='utf-8') as f:
+                        documents = json.load(f)
+                self.load_status['documents'] = len(documents)
+                self._publish(*self._split_embeddings(documents))
+        
+        self.load_status['phase'] = 'mapping'
+        snapshot = self._refresh()
+        if snapshot.generation and not self.shared_store.is_mapped(snapshot.generation):
+            # ドキュメントをメタデータに含めていた以前の形式の世代は mmap できる形式に書き直す
+            self.load_status['phase'] = 'migrating'
+            self.compact()
+    
+    def _split_embeddings(self, documents: List[Dict]):
+        """埋め込みを含むドキュメントをメタデータと行列に分離"""
+        documents = [doc for doc in documents if doc.get('embedding')]
+        metadata = [{k: v for k, v in doc.items() if k != 'embedding'} for doc in documents]
+        if not documents:
+            return metadata, np.zeros((0, 0), dtype=np.float32)
+        return metadata, np.array([doc['embedding'] for doc in documents], dtype=np.float32)
+    
+    def _publish(self, documents: List[Dict], embeddings: np.ndarray, references: Optional[List[Dict]] = None):
+        """新しい世代を公開（writer_lock の内側で呼ぶ）"""
+        # 絞り込み用の索引も列として書き出し、各ワーカーは mmap するだけにする
+        values, columns = MetadataIndex.build_columns(documents)
+        self.shared_store.publish(
+            documents,
+            embeddings,
+            extra={
+                'embedding_deployment': self.embedding_deployment,
+                'references': references or [],
+                'fields': values
+            },
+            columns=columns
+        )
+    
+    @staticmethod
+    def _make_block(embeddings: np.ndarray):
+        """埋め込み行列とそのノルムの組を作成"""
+        if embeddings.size:
+            norms = np.linalg.norm(embeddings, axis=1).astype(np.float32)
+        else:
+            norms = np.zeros(0, dtype=np.float32)
+        return embeddings, _read_only(norms)
+    
+    def _current(self) -> IndexSnapshot:
+        """
+        読み取り用の現在のスナップショット
+        
+        他のワーカーが新しい世代を公開したりログに追記したりしていれば、取り込みをバックグラウンドの
+        スレッドに任せて、待たずに取り込み済みのスナップショットを返す。
+        """
+        snapshot = self._snapshot
+        generation = self.shared_store.current_generation()
+        stale = generation != snapshot.generation if generation else False
+        if not stale and snapshot.wal is not None:
+            try:
+                stale = os.path.getsize(snapshot.wal.path) > snapshot.wal_offset
+            except OSError:
+                pass
+        if stale:
+            self._request_refresh()
+        return snapshot
+    
+    def _request_refresh(self):
+        """バックグラウンドでの取り込みを依頼する"""
+        with self._refresher_lock:
+            if self._refresher is None:
+                self._refresher = threading.Thread(target=self._refresh_loop, name="vector-index-refresh", daemon=True)
+                self._refresher.start()
+        self._refresh_requested.set()
+    
+    def _refresh_loop(self):
+        while True:
+            self._refresh_requested.wait()
+            self._refresh_requested.clear()
+            try:
+                self._refresh()
+            except Exception as e:
+                print(f"インデックス取り込みエラー: {e}")
+    
+    def _refresh(self) -> IndexSnapshot:
+        """他のワーカーが公開した新しい世代やログの追記があれば取り込み、最新のスナップショットを返す"""
+        with self._refresh_lock:
+            snapshot = self._snapshot
+            generation = self.shared_store.current_generation()
+            if generation == 0:
+                return snapshot
+            retired = None
+            if generation != snapshot.generation:
+                retired = snapshot.wal
+                snapshot = self._attach_generation(generation)
+            snapshot = self._apply_log(snapshot)
+            # 1回の代入で差し替えるので、読み取り側が途中の状態を見ることはない
+            self._snapshot = snapshot
+            if retired is not None:
+                self._retire_wal(retired)
+            return snapshot
+    
+    def _retire_wal(self, wal: WriteAheadLog):
+        """差し替えた世代の変更ログを閉じる（_refresh_lock 内で呼ぶ）"""
+        # 他のスレッドが追記してから fsync するまでの間は閉じられないので、そのコミットの終わりに閉じる
+        if self._commit_lock.acquire(blocking=False):
+            try:
+                wal.close()
+            finally:
+                self._commit_lock.release()
+        else:
+            self._retired_wals.append(wal)
+    
+    def _close_retired_wals(self):
+        """コミット中だったため閉じられなかった古い世代の変更ログを閉じる"""
+        if not self._commit_lock.acquire(blocking=False):
+            return  # 実行中のコミットが終わった後に閉じる
         try:
-            if os.path.exists(self.metadata_file):
-                with open(self.metadata_file, 'r', encoding='utf-8') as f:
-                    self.documents = json.load(f)
-        except Exception as e:
-            print(f"既存データ読み込みエラー: {e}")
-            self.documents = []
+            with self._refresh_lock:
+                retired, self._retired_wals = self._retired_wals, []
+            for wal in retired:
+                wal.close()
+        finally:
+            self._commit_lock.release()
+    
+    def _attach_generation(self, generation: int) -> IndexSnapshot:
+        """公開済みのスナップショットを読み込む（ドキュメントと索引は mmap するだけ）"""
+        meta, embeddings, documents, columns = self.shared_store.load(generation)
+        if columns:
+            metadata_index = MetadataIndex.from_columns(documents, meta['fields'], columns)
+        else:
+            metadata_index = MetadataIndex(documents)
+        
+        references = meta.get('references', [])
+        live = _read_only(np.ones(len(documents), dtype=bool))
+        
+        return IndexSnapshot(
+            generation=generation,
+            wal=WriteAheadLog(self.shared_store.wal_path(generation)),
+            wal_offset=0,
+            documents=documents,
+            blocks=(self._make_block(embeddings),),
+            live=live,
+            metadata_index=metadata_index,
+            references=references,
+            reference_rows=_read_only(self._resolve_references(documents, metadata_index, live, references)),
+            reference_index=MetadataIndex(references)
+        )
+    
+    @staticmethod
+    def _resolve_references(documents: Sequence, metadata_index: MetadataIndex, live: np.ndarray,
+                            references: List[Dict]) -> np.ndarray:
+        """
+        参照ごとに正規のチャンクの行番号を探す（正規のチャンクのソースの行だけをデコードする）
+        
+        Returns:
+            references と同じ順序の行番号の配列（見つからなければ -1）
+        """
+        rows = np.full(len(references), -1, dtype=np.int64)
+        by_source = defaultdict(list)
+        for i, ref in enumerate(references):
+            by_source[ref.get('canonical_source')].append(i)
+        for source, indices in by_source.items():
+            source_rows = metadata_index.rows('source', source)
+            row_by_id = {documents[row]['doc_id']: row for row in source_rows[live[source_rows]].tolist()}
+            for i in indices:
+                rows[i] = row_by_id.get(references[i]['duplicate_of'], -1)
+        return rows
+    
+    def _apply_log(self, snapshot: IndexSnapshot) -> IndexSnapshot:
+        """スナップショット以降の未取り込みのログを適用した新しいスナップショットを作成"""
+        records, offset = snapshot.wal.read(snapshot.wal_offset)
+        if not records:
+            return snapshot
+        
+        documents, blocks, live, metadata_index, references = (
+            snapshot.documents, list(snapshot.blocks), snapshot.live.copy(), snapshot.metadata_index, snapshot.references
+        )
+        reference_rows, reference_index = snapshot.reference_rows, snapshot.reference_index
+        
+        def append_rows(new_documents: List[Dict], encoded_embeddings: str):
+            nonlocal documents, live, metadata_index
+            if not new_documents:
+                return
+            embeddings = np.frombuffer(
+                base64.b64decode(encoded_embeddings), dtype=np.float32
+            ).reshape(len(new_documents), -1)
+            documents = documents.extended(new_documents)
+            blocks.append(self._make_block(embeddings))
+            live = np.concatenate([live, np.ones(len(new_documents), dtype=bool)])
+            metadata_index = metadata_index.extended(documents)
+        
+        for record in records:
+            if record['op'] == 'add':
+                append_rows(record['documents'], record['embeddings'])
+                new_references = record.get('references', [])
+                if new_references:
+                    # 追加された参照の分だけ正規のチャンクを探す
+                    references = references + new_references
+                    reference_rows = np.concatenate([
+                        reference_rows, self._resolve_references(documents, metadata_index, live, new_references)
+                    ])
+                    reference_index = reference_index.extended(references)
+            elif record['op'] == 'delete':
+                # 削除される正規チャンクを参照していたチャンクは、参照元の行として昇格させる
+                promoted = record.get('promoted', {'documents': [], 'embeddings': ''})
+                append_rows(promoted['documents'], promoted['embeddings'])
+                live[metadata_index.rows('source', record['source'])] = False
+                
+                promoted_keys = {(doc['source'], doc['chunk_index']) for doc in promoted['documents']}
+                retarget = record.get('retarget', {})
+                references = [
+                    dict(ref, duplicate_of=retarget[ref['duplicate_of']]['doc_id'],
+                         canonical_source=retarget[ref['duplicate_of']]['source'])
+                    if ref['duplicate_of'] in retarget else ref
+                    for ref in references
+                    if ref['source'] != record['source'] and (ref['source'], ref['chunk_index']) not in promoted_keys
+                ]
+                # 参照先が変わり、行も消えるので作り直す
+                reference_rows = self._resolve_references(documents, metadata_index, live, references)
+                reference_index = MetadataIndex(references)
+        
+        return snapshot._replace(
+            wal_offset=offset,
+            documents=documents,
+            blocks=tuple(blocks),
+            live=_read_only(live),
+            metadata_index=metadata_index,
+            references=references,
+            reference_rows=_read_only(reference_rows),
+            reference_index=reference_index
+        )
     
-    def _save_data(self):
-        """データを保存"""
+    def _write_log(self, record: Union[Dict, Callable[[IndexSnapshot], Optional[Dict]]]) -> bool:
+        """
+        変更をログに追記して永続化し、取り込む
+        
+        同時に書き込もうとしたスレッドの変更は、先にロックを取ったスレッドがまとめて追記し、
+        1つの新しいスナップショットとして取り込む。追記は書き込みプロセス間のロック内で行い、
+        fsync はロック外でまとめて行う。
+        
+        Args:
+            record: 変更内容、またはロック内で最新のスナップショットから変更内容を作る関数（Noneなら何もしない）
+            
+        Returns:
+            追記した場合True
+        """
+        entry = {'record': record, 'done': False, 'result': False, 'error': None}
+        with self._pending_lock:
+            self._pending_writes.append(entry)
+        
+        with self._commit_lock:
+            if not entry['done']:
+                with self._pending_lock:
+                    batch, self._pending_writes = self._pending_writes, []
+                self._commit(batch)
+        self._close_retired_wals()
+        
+        if entry['error'] is not None:
+            raise entry['error']
+        return entry['result']
+    
+    def _commit(self, batch: List[Dict]):
+        """書き込み待ちの変更をまとめて追記する（_commit_lock 内で呼ぶ）"""
+        offset = None
         try:
-            with open(self.metadata_file, 'w', encoding='utf-8') as f:
-                json.dump(self.documents, f, ensure_ascii=False, indent=2)
+            with self.shared_store.writer_lock():
+                snapshot = self._refresh()
+                wal = snapshot.wal
+                # クラッシュした書き込みが残した壊れた末尾は捨てる
+                wal.discard_tail(snapshot.wal_offset)
+                for entry in batch:
+                    record = entry['record']
+                    if callable(record):
+                        if offset is not None:
+                            # 同じバッチで先に追記した変更を反映した状態から作る
+                            snapshot = self._refresh()
+                        try:
+                            record = record(snapshot)
+                        except Exception as e:
+                            entry['error'] = e
+                            continue
+                        if record is None:
+                            continue
+                    offset = wal.append(record)
+                    entry['result'] = True
+            
+            if offset is not None:
+                wal.sync(offset)
+                snapshot = self._refresh()
         except Exception as e:
-            print(f"データ保存エラー: {e}")
+            # 追記・永続化に失敗した場合はバッチの変更を全て失敗とする
+            for entry in batch:
+                if entry['error'] is None:
+                    entry['error'] = e
+            offset = None
+        finally:
+            for entry in batch:
+                entry['done'] = True
+        
+        if offset is not None and self._needs_compaction(snapshot):
+            self.compact()
+    
+    def _needs_compaction(self, snapshot: IndexSnapshot) -> bool:
+        """ログが大きくなったか、削除済みの行（検索でスコア計算だけされて捨てられる行）が増えたか"""
+        if snapshot.wal_offset >= self.compaction_threshold:
+            return True
+        rows = len(snapshot.live)
+        return rows > 0 and rows - int(np.count_nonzero(snapshot.live)) > rows * self.compaction_dead_ratio
+    
+    def compact(self):
+        """スナップショットとログを新しいスナップショットにまとめる"""
+        # 追記中のコミットが終わってから差し替え、古い世代の変更ログをすぐに閉じる
+        with self._commit_lock, self.shared_store.writer_lock():
+            snapshot = self._refresh()
+            rows = np.flatnonzero(snapshot.live)
+            documents = [snapshot.documents[i] for i in rows]
+            embeddings, _ = self._gather(snapshot.blocks, rows)
+            self._publish(documents, embeddings, snapshot.references)
+            self._refresh()
+    
+    def export_snapshot(self, target_dir: str) -> Dict:
+        """
+        現在のインデックスを他のノードに複製するためのスナップショットとして書き出す
+        
+        削除されていないチャンクの埋め込み・本文・メタデータと、準重複の参照・MinHash 署名を含む。
+        
+        Args:
+            target_dir: 書き出し先のディレクトリ（存在しないこと）
+            
+        Returns:
+            マニフェスト
+            
+        Raises:
+            IndexNotReady: インデックスの読み込みが完了していない場合
+        """
+        self.ensure_loaded()
+        with self._dedup_lock:
+            snapshot = self._refresh()
+            index = self._near_duplicate_index(snapshot)
+        
+        rows = np.flatnonzero(snapshot.live)
+        documents = [snapshot.documents[i] for i in rows]
+        embeddings, _ = self._gather(snapshot.blocks, rows)
+        signatures = np.array(
+            [index.signature(int(row)) for row in rows], dtype=np.uint32
+        ).reshape(len(rows), self._min_hasher.num_perm)
+        
+        return write_bundle(target_dir, documents, snapshot.references, embeddings, signatures, {
+            'embedding_deployment': self.embedding_deployment,
+            'source_generation': snapshot.generation,
+            'minhash': {'num_perm': self._min_hasher.num_perm, 'shingle_size': self._min_hasher.shingle_size}
+        })
+    
+    def import_snapshot(self, source_dir: str) -> Dict:
+        """
+        書き出されたスナップショットを検証し、新しい世代として公開する（埋め込みは再計算しない）
+        
+        現在のインデックスは置き換えられる。他のワーカーも次の検索から新しい世代を参照する。
+        
+        Raises:
+            SnapshotError: 形式・チェックサム・埋め込みのデプロイメントや次元が合わない場合
+            IndexNotReady: インデックスの読み込みが完了していない場合
+        """
+        self.ensure_loaded()
+        # チェックサムと次元の確認は書き込みのロックの外で行う
+        bundle = self._read_bundle(source_dir, self._refresh())
+        with self.shared_store.writer_lock():
+            self._publish_bundle(bundle)
+        
+        manifest = dict(bundle.manifest)
+        manifest.pop('files', None)
+        manifest['generation'] = self.generation
+        return manifest
+    
+    def _read_bundle(self, source_dir: str, snapshot: IndexSnapshot) -> SnapshotBundle:
+        """スナップショットを読み込み、このノードの埋め込みと互換性があるか確認する"""
+        manifest = read_manifest(source_dir)
+        if manifest.get('embedding_deployment') != self.embedding_deployment:
+            raise SnapshotError(
+                f"埋め込みのデプロイメントが一致しません: スナップショット {manifest.get('embedding_deployment')}、"
+                f"このノード {self.embedding_deployment}"
+            )
+        bundle = load_bundle(source_dir, manifest)
+        
+        if manifest['count']:
+            dimension = self._embedding_dimension(snapshot)
+            if manifest['dimension'] != dimension:
+                raise SnapshotError(f"埋め込みの次元が一致しません: スナップショット {manifest['dimension']}、このノード {dimension}")
+        
+        minhash = manifest.get('minhash') or {}
+        if (minhash.get('num_perm'), minhash.get('shingle_size')) != (self._min_hasher.num_perm, self._min_hasher.shingle_size):
+            # 署名の作り方が違う場合は使わず、必要になったときに本文から計算する
+            bundle = bundle._replace(signatures=None)
+        return bundle
+    
+    def _embedding_dimension(self, snapshot: IndexSnapshot) -> int:
+        """このノードの埋め込みの次元（インデックスが空なら埋め込みを1回生成して確認）"""
+        for block, _ in snapshot.blocks:
+            if len(block):
+                return int(block.shape[1])
+        embedding = self._get_embedding("dimension check")
+        if embedding is None:
+            raise SnapshotError("埋め込みの次元を確認できません（埋め込みのデプロイメントに接続できません）")
+        return len(embedding)
+    
+    def _publish_bundle(self, bundle: SnapshotBundle):
+        """スナップショットを新しい世代として公開（writer_lock の内側で呼ぶ）"""
+        self._publish(bundle.documents, bundle.embeddings, bundle.references)
+        snapshot = self._refresh()
+        
+        if bundle.signatures is not None:
+            # 準重複検出のインデックスも書き出し元の署名から作る
+            index = NearDuplicateIndex(self._min_hasher)
+            for row, signature in enumerate(np.array(bundle.signatures)):
+                index.add(row, signature)
+            with self._dedup_lock:
+                self._dedup_state = (snapshot.generation, index, len(snapshot.documents))
+    
+    @staticmethod
+    def _gather_matrix(matrices: List[np.ndarray], rows: np.ndarray) -> Optional[np.ndarray]:
+        """縦に連結したとみなした行列から、行番号（昇順）に対応する行を取り出す（該当なしはNone）"""
+        parts = []
+        offset = 0
+        for matrix in matrices:
+            start, end = np.searchsorted(rows, [offset, offset + len(matrix)])
+            if end > start:
+                parts.append(np.asarray(matrix[rows[start:end] - offset]))
+            offset += len(matrix)
+        return np.concatenate(parts) if parts else None
+    
+    @staticmethod
+    def _gather(blocks: List, rows: np.ndarray):
+        """行番号（昇順）に対応する埋め込みとノルムを各ブロックから取り出す"""
+        embeddings = VectorDBService._gather_matrix([block for block, _ in blocks], rows)
+        if embeddings is None:
+            return np.zeros((0, 0), dtype=np.float32), np.zeros(0, dtype=np.float32)
+        return embeddings, VectorDBService._gather_matrix([norms for _, norms in blocks], rows)
+    
+    @staticmethod
+    def _similarities(blocks: List, query_vectors: np.ndarray, rows: Optional[np.ndarray] = None) -> np.ndarray:
+        """
+        各行とクエリのコサイン類似度（rows 指定時はその行だけ）
+        
+        Args:
+            blocks: (埋め込み行列, ノルム) のリスト
+            query_vectors: クエリの埋め込み（1件なら (d,)、複数なら (m, d)）
+            rows: 対象の行番号（昇順）
+            
+        Returns:
+            1件なら (n,)、複数なら (m, n) の類似度
+        """
+        queries = np.atleast_2d(query_vectors)
+        query_norms = np.linalg.norm(queries, axis=1)
+        if rows is None:
+            parts = [(queries @ block.T, norms) for block, norms in blocks if len(block)]
+        else:
+            embeddings, norms = VectorDBService._gather(blocks, rows)
+            parts = [(queries @ embeddings.T, norms)] if len(embeddings) else []
+        
+        if parts:
+            dots = np.concatenate([dot for dot, _ in parts], axis=1)
+            norms = np.concatenate([norm for _, norm in parts])
+            with np.errstate(divide='ignore', invalid='ignore'):
+                similarities = dots / (query_norms[:, None] * norms[None, :])
+            similarities = np.nan_to_num(similarities, nan=0.0, posinf=0.0, neginf=0.0)
+        else:
+            similarities = np.zeros((len(queries), 0 if rows is None else len(rows)), dtype=np.float32)
+        
+        return similarities[0] if np.ndim(query_vectors) == 1 else similarities
+    
+    def _coarse_index(self, blocks: List):
+        """
+        blocks に対応する粗い検索用の低次元化と行列（初回の検索時に作成し、以降は追記されたブロックだけ変換）
+        
+        Returns:
+            (低次元化, ブロックごとの低次元の行列)。作成できない場合は (None, [])
+        """
+        with self._coarse_lock:
+            base = blocks[0][0]
+            state = self._coarse_state
+            if state is None or state[0] is not base:
+                # 新しい世代に切り替わったら作り直す（pca はこの世代の埋め込みで学習）
+                reducer = build_reducer(self.coarse_method, self.coarse_dims, [block for block, _ in blocks])
+                if reducer is None:
+                    return None, []
+                coarse: List[np.ndarray] = []
+            else:
+                _, reducer, coarse = state
+            
+            if len(coarse) < len(blocks):
+                coarse = coarse + [
+                    reducer.transform(block) if len(block) else np.zeros((0, reducer.dims), dtype=np.float32)
+                    for block, _ in blocks[len(coarse):]
+                ]
+                self._coarse_state = (base, reducer, coarse)
+        return reducer, coarse[:len(blocks)]
+    
+    @staticmethod
+    def _coarse_candidates(coarse: List[np.ndarray], query_vectors: np.ndarray, allowed: Optional[np.ndarray], size: int) -> np.ndarray:
+        """
+        粗い検索で各クエリの上位 size 行を選ぶ
+        
+        Args:
+            allowed: 候補にする行の真偽値（Noneなら全行。size より多いこと）
+            
+        Returns:
+            全クエリの候補を合わせた行番号（昇順）
+        """
+        scores = np.concatenate([query_vectors @ matrix.T for matrix in coarse], axis=1)
+        if allowed is not None:
+            scores[:, ~allowed] = -np.inf
+        return np.unique(np.argpartition(-scores, size - 1, axis=1)[:, :size])
     
     def _get_embedding(self, text: str) -> List[float]:
         """テキストの埋め込みを取得"""
         try:
-            response = self.openai_client.embeddings.create(
-                model=self.embedding_deployment,
-                input=text
+            response = self.embedding_router.call(
+                lambda backend: backend.client.embeddings.create(model=backend.deployment, input=text),
+                label="embedding"
             )
             return response.data[0].embedding
         except Exception as e:
             print(f"埋め込み生成エラー: {e}")
             return None
     
+    def _embed_batch(self, batch: List[str]) -> List[Optional[List[float]]]:
+        """1回のリクエストで埋め込みを取得（失敗した場合は全てNone）"""
+        try:
+            response = self.embedding_router.call(
+                lambda backend: backend.client.embeddings.create(model=backend.deployment, input=batch),
+                label="embedding"
+            )
+            usage = getattr(response, 'usage', None)
+            with self._usage_lock:
+                self.embedding_tokens += getattr(usage, 'prompt_tokens', 0) or 0
+            data = sorted(response.data, key=lambda item: item.index)
+            return [item.embedding for item in data]
+        except Exception as e:
+            print(f"埋め込み生成エラー: {e}")
+            return [None] * len(batch)
+    
+    def _get_embeddings(self, texts: List[str], concurrency: int = 1) -> List[Optional[List[float]]]:
+        """
+        複数のテキストの埋め込みをまとめて取得（失敗したものはNone）
+        
+        Args:
+            texts: テキストのリスト
+            concurrency: 同時に送るリクエスト数
+        """
+        batches = [
+            texts[start:start + self.embedding_batch_size]
+            for start in range(0, len(texts), self.embedding_batch_size)
+        ]
+        if concurrency <= 1 or len(batches) <= 1:
+            results = [self._embed_batch(batch) for batch in batches]
+        else:
+            with ThreadPoolExecutor(max_workers=min(concurrency, len(batches))) as executor:
+                results = list(executor.map(self._embed_batch, batches))
+        return [embedding for batch in results for embedding in batch]
+    
     def generate_document_id(self, content: str, metadata: Dict) -> str:
         """ドキュメントのユニークIDを生成"""
         unique_string = f"{content}{metadata.get('source', '')}{metadata.get('page', '')}"
         return hashlib.md5(unique_string.encode()).hexdigest()
     
-    async def add_document(self, content: str, metadata: Dict) -> Dict:
-        """ドキュメントを追加"""
-        try:
-            # テキストをチャンクに分割
-            chunks = self.text_splitter.split_text(content)
-            
-            chunk_docs = []
-            successful_chunks = 0
+    def _near_duplicate_index(self, snapshot: IndexSnapshot) -> NearDuplicateIndex:
+        """既存チャンクの MinHash LSH インデックス（まだ登録していない行だけ追加する。_dedup_lock 内で呼ぶ）"""
+        documents, live, generation = snapshot.documents, snapshot.live, snapshot.generation
+        if self._dedup_state is None or self._dedup_state[0] != generation:
+            # 世代が変わると行番号が変わるため作り直す
+            self._dedup_state = (generation, NearDuplicateIndex(self._min_hasher), 0)
+        
+        _, index, indexed_rows = self._dedup_state
+        for row in range(indexed_rows, len(documents)):
+            if live[row]:
+                index.add(row, self._min_hasher.signature(documents[row]['content']))
+        self._dedup_state = (generation, index, len(documents))
+        return index
+    
+    def _find_near_duplicates(self, chunk_docs: List[Dict], threshold: float) -> Dict[int, Tuple[Dict, float]]:
+        """
+        既存のチャンクまたは同じ文書内の先行するチャンクと準重複するチャンクを探す
+        
+        Returns:
+            {チャンクの位置: (正規のチャンク, 推定類似度)}
+        """
+        with self._dedup_lock:
+            snapshot = self._refresh()
+            index = self._near_duplicate_index(snapshot)
+            documents, live = snapshot.documents, snapshot.live
             
-            for i, chunk in enumerate(chunks):
-                # 埋め込み生成
-                embedding = self._get_embedding(chunk)
-                if embedding is None:
+            local_index = NearDuplicateIndex(self._min_hasher)
+            duplicates = {}
+            for i, doc in enumerate(chunk_docs):
+                signature = self._min_hasher.signature(doc['content'])
+                
+                match = index.find(signature, threshold, accept=lambda row: live[row])
+                if match:
+                    duplicates[i] = (documents[match[0]], match[1])
                     continue
                 
-                # チャンクメタデータ
-                chunk_metadata = metadata.copy()
-                chunk_metadata.update({
-                    'chunk_index': i,
-                    'total_chunks': len(chunks),
-                    'created_at': datetime.now().isoformat(),
-                    'content': chunk,
-                    'embedding': embedding,  # 埋め込みも保存
-                    'doc_id': self.generate_document_id(chunk, chunk_metadata)
-                })
+                match = local_index.find(signature, threshold)
+                if match:
+                    duplicates[i] = (chunk_docs[match[0]], match[1])
+                    continue
                 
-                chunk_docs.append(chunk_metadata)
-                successful_chunks += 1
+                local_index.add(i, signature)
+            return duplicates
+    
+    def _chunk_document(self, content: str, metadata: Dict) -> List[Dict]:
+        """テキストをチャンクに分割し、チャンクごとのメタデータを作成"""
+        chunks = self.text_splitter.split_text(content)
+        
+        chunk_docs = []
+        for i, chunk in enumerate(chunks):
+            chunk_metadata = metadata.copy()
+            chunk_metadata.update({
+                'chunk_index': i,
+                'total_chunks': len(chunks),
+                'created_at': datetime.now().isoformat(),
+                'content': chunk,
+                'doc_id': self.generate_document_id(chunk, chunk_metadata)
+            })
+            chunk_docs.append(chunk_metadata)
+        return chunk_docs
+    
+    def _add_chunks(
+        self,
+        chunk_docs: List[Dict],
+        dedup: bool,
+        threshold: float,
+        embedding_concurrency: int = 1,
+        drop_incomplete: bool = False
+    ) -> Dict:
+        """
+        チャンクの準重複除外と埋め込み生成を行い、1つのログレコードとして追記（スレッドで実行）
+        
+        Args:
+            chunk_docs: チャンクのリスト（複数の文書のチャンクを含んでもよい）
+            dedup: 準重複チャンクの登録を省略するか
+            threshold: 準重複とみなす推定Jaccard類似度
+            embedding_concurrency: 同時に送る埋め込みリクエスト数
+            drop_incomplete: 埋め込みに失敗したチャンクを含む文書は丸ごと登録しない
             
-            if successful_chunks == 0:
-                return {'status': 'error', 'message': '埋め込み生成に失敗しました'}
+        Returns:
+            documents（追加したチャンク）/ references（参照として登録したチャンク）/
+            failed_sources（drop_incomplete で登録しなかった文書）
+        """
+        # 埋め込み生成の前に準重複チャンクを除外し、正規のチャンクへの参照として記録
+        duplicates = {}
+        if dedup and chunk_docs:
+            with phase("dedup"):
+                duplicates = self._find_near_duplicates(chunk_docs, threshold)
+        references = [
+            dict(
+                {k: v for k, v in chunk_docs[i].items() if k != 'content'},
+                duplicate_of=canonical['doc_id'],
+                canonical_source=canonical.get('source', 'Unknown'),
+                similarity=round(similarity, 3)
+            )
+            for i, (canonical, similarity) in sorted(duplicates.items())
+        ]
+        unique_docs = [doc for i, doc in enumerate(chunk_docs) if i not in duplicates]
+        
+        # 埋め込み生成
+        with phase("embedding"):
+            embeddings = self._get_embeddings([doc['content'] for doc in unique_docs], embedding_concurrency)
+        added = [(doc, embedding) for doc, embedding in zip(unique_docs, embeddings) if embedding is not None]
+        failed_ids = {doc['doc_id'] for doc, embedding in zip(unique_docs, embeddings) if embedding is None}
+        
+        failed_sources = set()
+        if drop_incomplete:
+            # 登録できないチャンクを参照している文書も不完全になるため、変化がなくなるまで除外を広げる
+            failed_sources = {doc.get('source') for doc in unique_docs if doc['doc_id'] in failed_ids}
+            while True:
+                failed_ids |= {doc['doc_id'] for doc in chunk_docs if doc.get('source') in failed_sources}
+                failed_sources_next = failed_sources | {
+                    ref.get('source') for ref in references if ref['duplicate_of'] in failed_ids
+                }
+                if failed_sources_next == failed_sources:
+                    break
+                failed_sources = failed_sources_next
+            added = [(doc, embedding) for doc, embedding in added if doc.get('source') not in failed_sources]
+        
+        # 埋め込みに失敗したチャンクを参照しているものは残さない
+        references = [
+            ref for ref in references
+            if ref['duplicate_of'] not in failed_ids and ref.get('source') not in failed_sources
+        ]
+        added_docs = [doc for doc, _ in added]
+        
+        if added_docs or references:
+            new_embeddings = np.array([embedding for _, embedding in added], dtype=np.float32)
+            
+            # 変更ログに追記（コーパス全体の書き直しはしない）
+            with phase("index_write"):
+                self._write_log({
+                    'op': 'add',
+                    'documents': added_docs,
+                    'embeddings': base64.b64encode(new_embeddings.tobytes()).decode('ascii'),
+                    'references': references
+                })
+        
+        return {'documents': added_docs, 'references': references, 'failed_sources': failed_sources}
+    
+    async def add_document(
+        self,
+        content: str,
+        metadata: Dict,
+        dedup: Optional[bool] = None,
+        dedup_threshold: Optional[float] = None
+    ) -> Dict:
+        """
+        ドキュメントを追加
+        
+        Args:
+            content: 文書のテキスト
+            metadata: 文書のメタデータ
+            dedup: 準重複チャンクの登録を省略するか（Noneなら VECTOR_DB_DEDUP の設定）
+            dedup_threshold: 準重複とみなす推定Jaccard類似度（Noneなら VECTOR_DB_DEDUP_THRESHOLD の設定）
+        """
+        try:
+            dedup = self.dedup_enabled if dedup is None else dedup
+            threshold = self.dedup_threshold if dedup_threshold is None else dedup_threshold
             
-            # ドキュメントをリストに追加
-            self.documents.extend(chunk_docs)
+            # テキストをチャンクに分割
+            with phase("chunking"):
+                chunk_docs = self._chunk_document(content, metadata)
             
-            # データ保存
-            self._save_data()
+            self.ensure_loaded()
+            
+            added = await asyncio.to_thread(self._add_chunks, chunk_docs, dedup, threshold)
+            added_docs, references = added['documents'], added['references']
+            if not added_docs and not references:
+                return {'status': 'error', 'message': '埋め込み生成に失敗しました'}
             
             return {
                 'status': 'success',
-                'chunks_added': successful_chunks,
+                'chunks_added': len(added_docs),
+                'duplicates_skipped': len(references),
+                'duplicate_sources': sorted({ref['canonical_source'] for ref in references}),
                 'document_name': metadata.get('source', 'Unknown')
             }
             
+        except IndexNotReady as e:
+            return {'status': 'error', 'message': str(e), 'status_code': 503}
+        except Exception as e:
+            return {'status': 'error', 'message': str(e)}
+    
+    async def add_documents(
+        self,
+        documents: List[Tuple[str, Dict]],
+        dedup: Optional[bool] = None,
+        dedup_threshold: Optional[float] = None,
+        embedding_concurrency: int = 1
+    ) -> Dict:
+        """
+        複数のドキュメントをまとめて追加（変更ログへの追記は1回）
+        
+        埋め込みに失敗したチャンクを含む文書は丸ごと登録せず、やり直せるようにする。
+        
+        Args:
+            documents: (文書のテキスト, メタデータ) のリスト。メタデータの source は文書ごとに異なること
+            dedup: 準重複チャンクの登録を省略するか（Noneなら VECTOR_DB_DEDUP の設定）
+            dedup_threshold: 準重複とみなす推定Jaccard類似度（Noneなら VECTOR_DB_DEDUP_THRESHOLD の設定）
+            embedding_concurrency: 同時に送る埋め込みリクエスト数
+            
+        Returns:
+            status / chunks_added / duplicates_skipped と、文書ごとの結果 results
+            （{source: {'status', 'chunks_added', 'duplicates_skipped'}}）
+        """
+        try:
+            dedup = self.dedup_enabled if dedup is None else dedup
+            threshold = self.dedup_threshold if dedup_threshold is None else dedup_threshold
+            
+            chunk_docs = [
+                chunk for content, metadata in documents for chunk in self._chunk_document(content, metadata)
+            ]
+            
+            self.ensure_loaded()
+            
+            added = await asyncio.to_thread(
+                self._add_chunks, chunk_docs, dedup, threshold, embedding_concurrency, True
+            )
+            
+            results = {
+                metadata.get('source', 'Unknown'): {
+                    'status': 'error' if metadata.get('source') in added['failed_sources'] else 'success',
+                    'chunks_added': 0,
+                    'duplicates_skipped': 0
+                }
+                for _, metadata in documents
+            }
+            for doc in added['documents']:
+                results[doc.get('source', 'Unknown')]['chunks_added'] += 1
+            for ref in added['references']:
+                results[ref.get('source', 'Unknown')]['duplicates_skipped'] += 1
+            
+            return {
+                'status': 'success',
+                'chunks_added': len(added['documents']),
+                'duplicates_skipped': len(added['references']),
+                'results': results
+            }
+            
+        except IndexNotReady as e:
+            return {'status': 'error', 'message': str(e), 'status_code': 503}
         except Exception as e:
             return {'status': 'error', 'message': str(e)}
     
-    async def search(self, query: str, n_results: int = 5) -> List[Dict]:
-        """類似度検索を実行"""
+    @staticmethod
+    def _slice_blocks(blocks: List, start: int, end: int) -> List:
+        """縦に連結したとみなしたブロックの start 行目から end 行目の手前まで（コピーしないビュー）"""
+        sliced = []
+        offset = 0
+        for block, norms in blocks:
+            lo, hi = max(start - offset, 0), min(end - offset, len(block))
+            if hi > lo:
+                sliced.append((block[lo:hi], norms[lo:hi]))
+            offset += len(block)
+        return sliced
+    
+    @staticmethod
+    def _top_k(blocks: List, query_vectors: np.ndarray, rows: Optional[np.ndarray], allowed: Optional[np.ndarray],
+               start: int, end: int, n_results: int) -> List[List[Tuple[float, int]]]:
+        """
+        候補の start 番目から end 番目の手前までをスコア計算し、クエリごとの上位を返す
+        
+        Args:
+            rows: 候補の行番号（昇順）。Noneなら start / end は行番号で、その範囲の行をコピーせずにスコア計算する
+            allowed: rows が None のとき、候補にする行の真偽値（Noneなら全行）。それ以外の行は結果に含めない
+            
+        Returns:
+            クエリごとの (類似度, 行番号) の類似度の降順のリスト
+        """
+        if rows is None:
+            candidate_rows = None
+            similarities = VectorDBService._similarities(
+                VectorDBService._slice_blocks(blocks, start, end), query_vectors
+            )
+            if allowed is not None:
+                # 削除済み・絞り込み対象外の行は取り出さずに、スコアを -inf にして除く
+                similarities[:, ~allowed[start:end]] = -np.inf
+        else:
+            candidate_rows = rows[start:end]
+            similarities = VectorDBService._similarities(blocks, query_vectors, candidate_rows)
+        
+        k = min(n_results, similarities.shape[1])
+        if k <= 0:
+            return [[] for _ in query_vectors]
+        
+        # 上位k件を類似度順に取得
+        top_indices = np.argpartition(-similarities, k - 1, axis=1)[:, :k]
+        top_scores = np.take_along_axis(similarities, top_indices, axis=1)
+        order = np.argsort(-top_scores, axis=1)
+        top_indices = np.take_along_axis(top_indices, order, axis=1)
+        top_scores = np.take_along_axis(top_scores, order, axis=1)
+        top_rows = top_indices + start if candidate_rows is None else candidate_rows[top_indices]
+        
+        return [
+            [(score, row) for score, row in zip(scores.tolist(), indices.tolist()) if score != -np.inf]
+            for scores, indices in zip(top_scores, top_rows)
+        ]
+    
+    def _search_executor(self) -> ThreadPoolExecutor:
+        """シャードのスコア計算用のスレッドプール（1つ目のシャードは呼び出し元のスレッドで計算する）"""
+        with self._shard_lock:
+            if self._shard_executor is None:
+                self._shard_executor = ThreadPoolExecutor(
+                    max_workers=max(self.search_shards - 1, 1), thread_name_prefix="vector-shard"
+                )
+            return self._shard_executor
+    
+    def _sharded_top_k(self, blocks: List, query_vectors: np.ndarray, rows: Optional[np.ndarray],
+                       allowed: Optional[np.ndarray], scored: int, n_results: int) -> List[List[Tuple[float, int]]]:
+        """
+        スコア計算する行を均等なシャードに分けて並列に計算し、シャードごとの上位をヒープでマージ
+        
+        Args:
+            rows: 取り出してスコア計算する行番号（Noneなら全行）
+            allowed: rows が None のとき、候補にする行の真偽値
+            scored: スコア計算する行数（rows の長さ、または全行数）
+        """
+        shards = self.search_shards if scored >= self.shard_min_rows else 1
+        bounds = np.linspace(0, scored, max(shards, 1) + 1).astype(int)
+        ranges = [(int(start), int(end)) for start, end in zip(bounds[:-1], bounds[1:]) if end > start]
+        if len(ranges) <= 1:
+            return self._top_k(blocks, query_vectors, rows, allowed, 0, scored, n_results)
+        
+        executor = self._search_executor()
+        futures = [
+            executor.submit(self._top_k, blocks, query_vectors, rows, allowed, start, end, n_results)
+            for start, end in ranges[1:]
+        ]
+        parts = [self._top_k(blocks, query_vectors, rows, allowed, *ranges[0], n_results)]
+        parts += [future.result() for future in futures]
+        
+        # シャードごとの降順リストを k-way マージして上位 n_results 件を取る
+        return [
+            list(itertools.islice(heapq.merge(*shard_tops, reverse=True), n_results))
+            for shard_tops in zip(*parts)
+        ]
+    
+    async def search(self, query: str, n_results: int = 5, filters: Optional[Dict] = None) -> List[Dict]:
+        """
+        類似度検索を実行
+        
+        Args:
+            query: 検索クエリ
+            n_results: 取得件数
+            filters: メタデータによる絞り込み条件（例: {"source": ["a.pdf", "b.md"], "created_after": "2024-01-01"}）
+        """
         try:
-            if len(self.documents) == 0:
+            # 読み込み完了前はRAGなしで応答できるよう空の結果を返す
+            if not self.is_ready:
                 return []
             
             # クエリの埋め込み生成
-            query_embedding = self._get_embedding(query)
+            with phase("embedding"):
+                query_embedding = await asyncio.to_thread(self._get_embedding, query)
             if query_embedding is None:
                 return []
             
-            # 各ドキュメントとの類似度を計算
-            similarities = []
-            for doc in self.documents:
-                if 'embedding' in doc:
-                    similarity = cosine_similarity(query_embedding, doc['embedding'])
-                    similarities.append((similarity, doc))
-            
-            # 類似度順にソート
-            similarities.sort(key=lambda x: x[0], reverse=True)
-            
-            # 上位n_results件を返す
-            results = []
-            for similarity, doc in similarities[:n_results]:
-                results.append({
-                    'content': doc['content'],
-                    'metadata': {k: v for k, v in doc.items() if k not in ['content', 'embedding']},
-                    'score': similarity
-                })
-            
-            return results
+            # スコア計算（シャードの待ち合わせ・粗い検索の初回の学習を含む）はイベントループを止めないようスレッドで行う
+            with phase("vector_search"):
+                return (await asyncio.to_thread(self._search_vectors, [query_embedding], n_results, filters))[0]
             
         except Exception as e:
             print(f"検索エラー: {e}")
             return []
     
+    async def search_many(self, queries: List[str], n_results: int = 5, filters: Optional[Dict] = None) -> List[List[Dict]]:
+        """
+        複数のクエリをまとめて類似度検索
+        
+        埋め込みはバッチでまとめて取得し、類似度はクエリ行列とコーパスの行列積で計算する。
+        
+        Args:
+            queries: 検索クエリのリスト
+            n_results: クエリごとの取得件数
+            filters: メタデータによる絞り込み条件（全クエリ共通）
+            
+        Returns:
+            クエリと同じ順序の検索結果のリスト
+        """
+        try:
+            if not self.is_ready or not queries:
+                return [[] for _ in queries]
+            
+            with phase("embedding"):
+                query_embeddings = await asyncio.to_thread(self._get_embeddings, queries)
+            valid = [i for i, embedding in enumerate(query_embeddings) if embedding is not None]
+            
+            results: List[List[Dict]] = [[] for _ in queries]
+            if valid:
+                with phase("vector_search"):
+                    found = await asyncio.to_thread(
+                        self._search_vectors, [query_embeddings[i] for i in valid], n_results, filters
+                    )
+                for i, query_results in zip(valid, found):
+                    results[i] = query_results
+            return results
+            
+        except Exception as e:
+            print(f"一括検索エラー: {e}")
+            return [[] for _ in queries]
+    
+    def _search_vectors(self, query_embeddings: List[List[float]], n_results: int, filters: Optional[Dict]) -> List[List[Dict]]:
+        """埋め込み済みのクエリでインデックスを検索"""
+        # 他のワーカーの変更の取り込みは待たず、取り込み済みのスナップショットで検索する
+        snapshot = self._current()
+        documents, blocks, live, metadata_index = (
+            snapshot.documents, snapshot.blocks, snapshot.live, snapshot.metadata_index
+        )
+        empty = [[] for _ in query_embeddings]
+        if not live.any():
+            return empty
+        
+        # 削除済みの行と絞り込み対象外の行は候補から除く
+        allowed = None
+        mask = metadata_index.mask(filters)
+        # 準重複として参照のみ登録したチャンクが条件に一致すれば、正規のチャンクの行を参照として候補に加える
+        aliases = {}
+        if mask is not None and snapshot.references:
+            for i in np.flatnonzero(snapshot.reference_index.mask(filters)).tolist():
+                row = int(snapshot.reference_rows[i])
+                if row >= 0 and live[row] and not mask[row]:
+                    aliases.setdefault(row, snapshot.references[i])
+            mask[list(aliases)] = True
+        if mask is not None or not live.all():
+            allowed = live if mask is None else live & mask
+        candidates = len(documents) if allowed is None else int(np.count_nonzero(allowed))
+        n_results = min(n_results, candidates)
+        if n_results <= 0:
+            return empty
+        
+        # 候補が少なければその行だけを取り出してスコア計算する。多ければ取り出し（コピー）は
+        # 行列積より高くつくので、全行をそのままスコア計算して候補以外の行を除く
+        rows = None
+        if allowed is not None and candidates < len(documents) * self.gather_max_ratio:
+            rows = np.flatnonzero(allowed)
+        
+        # 候補が多い場合は低次元の粗い検索で絞った行だけを元の次元で再スコアする
+        reducer, coarse = None, []
+        shortlist_size = max(n_results * self.coarse_oversample, self.coarse_min_candidates)
+        if self.coarse_dims and candidates >= self.coarse_min_rows and candidates > shortlist_size:
+            reducer, coarse = self._coarse_index(blocks)
+        
+        results = []
+        query_vectors = np.asarray(query_embeddings, dtype=np.float32)
+        # 類似度行列が大きくなりすぎないようクエリを分けて計算
+        for start in range(0, len(query_vectors), self.search_query_batch_size):
+            batch = query_vectors[start:start + self.search_query_batch_size]
+            if reducer is not None:
+                # 粗い検索で絞った候補だけを再スコア（候補は少ないので分割しない）
+                batch_rows = self._coarse_candidates(coarse, reducer.transform(batch), allowed, shortlist_size)
+                tops = self._top_k(blocks, batch, batch_rows, None, 0, len(batch_rows), n_results)
+            else:
+                # コサイン類似度を行列積で計算し、上位n_results件を類似度順に取得
+                scored = len(documents) if rows is None else len(rows)
+                tops = self._sharded_top_k(blocks, batch, rows, allowed, scored, n_results)
+            
+            for top in tops:
+                query_results = []
+                for score, index in top:
+                    doc = documents[index]
+                    # 参照として一致した行は、本文は正規のチャンクで、ソースなどは参照のものを返す
+                    metadata = aliases.get(index) or {k: v for k, v in doc.items() if k != 'content'}
+                    query_results.append({
+                        'content': doc['content'],
+                        'metadata': dict(metadata),
+                        'score': score
+                    })
+                results.append(query_results)
+        
+        return results
+    
+    def find_by_content_hash(self, content_hash: str) -> Optional[str]:
+        """同じ内容のファイルが登録済みならそのソース名を返す"""
+        if not self.is_ready:
+            return None
+        
+        snapshot = self._current()
+        documents, live, metadata_index = snapshot.documents, snapshot.live, snapshot.metadata_index
+        rows = metadata_index.rows('content_hash', content_hash)
+        rows = rows[live[rows]]
+        if len(rows) == 0:
+            # 全チャンクが準重複として参照のみ登録された文書も確認
+            for ref in snapshot.references:
+                if ref.get('content_hash') == content_hash:
+                    return ref.get('source', 'Unknown')
+            return None
+        return documents[rows[0]].get('source', 'Unknown')
+    
     def list_documents(self) -> List[Dict]:
         """保存されているドキュメントの一覧を取得"""
         try:
-            # ソースごとにグループ化
+            if not self.is_ready:
+                return []
+            
+            snapshot = self._current()
+            documents, live, metadata_index = snapshot.documents, snapshot.live, snapshot.metadata_index
+            
+            # ソースごとにグループ化（本文はデコードせず、ソースの索引から数える）
             documents_by_source = {}
-            for doc in self.documents:
-                source = doc.get('source', 'Unknown')
+            for source in metadata_index.values('source'):
+                rows = metadata_index.rows('source', source)
+                rows = rows[live[rows]]
+                if len(rows) == 0:
+                    continue
+                source = source or 'Unknown'
+                documents_by_source[source] = {
+                    'source': source,
+                    'chunks': len(rows),
+                    'duplicate_chunks': 0,
+                    'created_at': documents[int(rows[0])].get('created_at', '')
+                }
+            # 準重複として参照のみ登録したチャンクも含める
+            for ref in snapshot.references:
+                source = ref.get('source', 'Unknown')
                 if source not in documents_by_source:
                     documents_by_source[source] = {
                         'source': source,
                         'chunks': 0,
-                        'created_at': doc.get('created_at', '')
+                        'duplicate_chunks': 0,
+                        'created_at': ref.get('created_at', '')
                     }
                 documents_by_source[source]['chunks'] += 1
+                documents_by_source[source]['duplicate_chunks'] += 1
             
             return list(documents_by_source.values())
             
@@ -231,34 +1593,73 @@ class VectorDBService:
             print(f"ドキュメント一覧取得エラー: {e}")
             return []
     
+    def _build_delete_record(self, snapshot: IndexSnapshot, source: str) -> Optional[Dict]:
+        """削除のログレコードを作成（writer_lock 内で最新のスナップショットから作る）"""
+        documents, live, metadata_index, references = (
+            snapshot.documents, snapshot.live, snapshot.metadata_index, snapshot.references
+        )
+        rows = metadata_index.rows('source', source)
+        rows = rows[live[rows]]
+        if len(rows) == 0 and not any(ref['source'] == source for ref in references):
+            return None
+        
+        # 他の文書から参照されている正規チャンクは、最初の参照元の行として残す
+        deleted = {documents[row]['doc_id']: row for row in rows}
+        promoted = []
+        retarget = {}
+        for ref in references:
+            canonical_id = ref['duplicate_of']
+            if ref['source'] == source or canonical_id not in deleted or canonical_id in retarget:
+                continue
+            doc = {k: v for k, v in ref.items() if k not in ('duplicate_of', 'canonical_source', 'similarity')}
+            doc['content'] = documents[deleted[canonical_id]]['content']
+            promoted.append((deleted[canonical_id], doc))
+            retarget[canonical_id] = {'doc_id': doc['doc_id'], 'source': doc['source']}
+        
+        record = {'op': 'delete', 'source': source}
+        if promoted:
+            promoted.sort(key=lambda item: item[0])
+            embeddings, _ = self._gather(snapshot.blocks, np.array([row for row, _ in promoted]))
+            record['promoted'] = {
+                'documents': [doc for _, doc in promoted],
+                'embeddings': base64.b64encode(np.ascontiguousarray(embeddings, dtype=np.float32).tobytes()).decode('ascii')
+            }
+            record['retarget'] = retarget
+        return record
+    
     def delete_document(self, source: str) -> bool:
-        """特定のソースのドキュメントを削除"""
+        """
+        特定のソースのドキュメントを削除
+        
+        Raises:
+            IndexNotReady: インデックスの読み込みが完了していない場合
+        """
+        self.ensure_loaded()
         try:
-            # 削除前のドキュメント数
-            original_count = len(self.documents)
-            
-            # 指定されたソース以外のドキュメントのみ残す
-            self.documents = [doc for doc in self.documents if doc.get('source') != source]
-            
-            # 削除されたかチェック
-            if len(self.documents) < original_count:
-                self._save_data()
-                return True
-            else:
-                return False
+            # 削除もログに記録し、行は次のスナップショットで取り除く
+            return self._write_log(lambda snapshot: self._build_delete_record(snapshot, source))
             
         except Exception as e:
             print(f"ドキュメント削除エラー: {e}")
             return False
     
     def reset_database(self):
-        """データベースをリセット（開発用）"""
+        """
+        データベースをリセット（開発用）
+        
+        Raises:
+            IndexNotReady: インデックスの読み込みが完了していない場合
+        """
+        self.ensure_loaded()
         try:
-            self.documents = []
-            
-            # ファイル削除
-            if os.path.exists(self.metadata_file):
-                os.remove(self.metadata_file)
+            with self.shared_store.writer_lock():
+                # ファイル削除
+                if os.path.exists(self.metadata_file):
+                    os.remove(self.metadata_file)
+                
+                # 空のスナップショットを公開（以前のログも参照されなくなる）
+                self._publish([], np.zeros((0, 0), dtype=np.float32))
+                self._refresh()
             
             return True
         except Exception as e:
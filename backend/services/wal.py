@@ -0,0 +1,136 @@
+"""
+ベクトルストアの変更を記録する追記専用ログ（Write-Ahead Log）
+
+1行1レコードで「CRC32(16進8桁) + 空白 + JSON」の形式で追記する。
+クラッシュで末尾が書きかけになっても、チェックサムが一致する
+直前のレコードまでを有効なログとして扱う。
+"""
+import os
+import json
+import time
+import zlib
+import threading
+from typing import Dict, List, Optional, Tuple
+
+
+class WriteAheadLog:
+    """チェックサム付きの追記専用ログ（fsync はグループコミットでまとめる）"""
+
+    def __init__(self, path: str, group_commit_window: float = 0.002):
+        """
+        Args:
+            path: ログファイルのパス
+            group_commit_window: fsync の前に後続の書き込みを待つ時間（秒）
+        """
+        self.path = path
+        self.group_commit_window = group_commit_window
+
+        self._file = None
+        self._write_lock = threading.Lock()
+        self._sync_condition = threading.Condition()
+        self._written = 0  # このプロセスで書き込んだ末尾のオフセット
+        self._synced = 0  # fsync 済みのオフセット
+        self._syncing = False
+
+    @staticmethod
+    def encode(record: Dict) -> bytes:
+        """レコードをログの1行に変換"""
+        payload = json.dumps(record, ensure_ascii=False, separators=(',', ':')).encode('utf-8')
+        return b"%08x " % zlib.crc32(payload) + payload + b"\n"
+
+    def read(self, offset: int = 0) -> Tuple[List[Dict], int]:
+        """
+        offset 以降の有効なレコードを読み込む
+
+        Returns:
+            (レコードのリスト, 最後の有効なレコードの直後のオフセット)
+        """
+        try:
+            if os.path.getsize(self.path) <= offset:
+                return [], offset
+            file = open(self.path, 'rb')
+        except FileNotFoundError:
+            return [], offset
+
+        records = []
+        with file:
+            file.seek(offset)
+            for line in file:
+                # 書きかけ・破損したレコードに達したらそこで止める
+                if not line.endswith(b"\n") or len(line) < 10:
+                    break
+                try:
+                    checksum = int(line[:8], 16)
+                except ValueError:
+                    break
+                payload = line[9:-1]
+                if zlib.crc32(payload) != checksum:
+                    break
+                records.append(json.loads(payload))
+                offset += len(line)
+        return records, offset
+
+    def discard_tail(self, valid_end: int) -> None:
+        """
+        valid_end より後ろの壊れた末尾を切り詰める（書き込みプロセス間のロック内で呼ぶ）
+        """
+        try:
+            if os.path.getsize(self.path) > valid_end:
+                with open(self.path, 'r+b') as f:
+                    f.truncate(valid_end)
+                    os.fsync(f.fileno())
+        except FileNotFoundError:
+            pass
+
+    def append(self, record: Dict) -> int:
+        """
+        レコードを追記する（fsync は sync() で行う）
+
+        Returns:
+            追記したレコードの末尾のオフセット
+        """
+        data = self.encode(record)
+        with self._write_lock:
+            if self._file is None:
+                self._file = open(self.path, 'ab')
+            self._file.write(data)
+            self._file.flush()
+            self._written = self._file.tell()
+            return self._written
+
+    def sync(self, offset: int) -> None:
+        """
+        offset までの追記を永続化する
+
+        同時に呼ばれた sync はまとめて1回の fsync で処理する（グループコミット）。
+        """
+        with self._sync_condition:
+            while self._synced < offset and self._syncing:
+                self._sync_condition.wait()
+            if self._synced >= offset:
+                return
+            self._syncing = True
+
+        synced: Optional[int] = None
+        try:
+            # 後続の書き込みを少し待ってから一緒に fsync する
+            if self.group_commit_window > 0:
+                time.sleep(self.group_commit_window)
+            with self._write_lock:
+                target = self._written
+                fileno = self._file.fileno()
+            os.fsync(fileno)
+            synced = target
+        finally:
+            with self._sync_condition:
+                self._syncing = False
+                if synced is not None:
+                    self._synced = max(self._synced, synced)
+                self._sync_condition.notify_all()
+
+    def close(self) -> None:
+        """ファイルを閉じる"""
+        with self._write_lock:
+            if self._file is not None:
+                self._file.close()
+                self._file = None
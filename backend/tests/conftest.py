@@ -0,0 +1,143 @@
+"""
+テスト共通のフィクスチャ
+
+Azure OpenAI の代わりに、応答時間や失敗のしかたを変えられるローカルの HTTP サーバーを立てる。
+ベクトルDBのテストでは、埋め込みをAPIの代わりにテキストのハッシュから作る。
+"""
+import hashlib
+import json
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import List
+
+import numpy as np
+import pytest
+
+from services.vector_db_service import VectorDBService
+
+
+class StubOpenAIServer:
+    """
+    Azure OpenAI の埋め込み・チャット（ストリーミング）API を模したサーバー
+
+    latency: 応答（ストリーミングなら最初のチャンク）までの秒数
+    status: 返すHTTPステータス（200以外ならエラーの本文を返す）
+    """
+
+    def __init__(self, name: str, latency: float = 0.0, status: int = 200):
+        self.name = name
+        self.latency = latency
+        self.status = status
+        self.requests = 0
+        self.streams_aborted = 0  # クライアントに途中で切断されたストリーミング応答の数
+        self._lock = threading.Lock()
+
+        self._server = ThreadingHTTPServer(("127.0.0.1", 0), self._handler())
+        self._server.daemon_threads = True
+        self._thread = threading.Thread(target=self._server.serve_forever, daemon=True)
+        self._thread.start()
+
+    @property
+    def endpoint(self) -> str:
+        return f"http://127.0.0.1:{self._server.server_address[1]}"
+
+    def close(self):
+        self._server.shutdown()
+        self._server.server_close()
+
+    def _handler(self):
+        stub = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def log_message(self, *args):
+                pass
+
+            def do_POST(self):
+                body = json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))) or b"{}")
+                with stub._lock:
+                    stub.requests += 1
+                time.sleep(stub.latency)
+
+                if stub.status != 200:
+                    self._send_json(stub.status, {"error": {"code": str(stub.status), "message": f"{stub.name} failed"}})
+                elif self.path.split("?")[0].endswith("/embeddings"):
+                    inputs = body.get("input")
+                    inputs = inputs if isinstance(inputs, list) else [inputs]
+                    self._send_json(200, {
+                        "object": "list",
+                        "model": stub.name,
+                        "data": [{"object": "embedding", "index": i, "embedding": [0.0, 1.0]} for i in range(len(inputs))],
+                        "usage": {"prompt_tokens": 1, "total_tokens": 1}
+                    })
+                else:
+                    self._stream_chat()
+
+            def _send_json(self, status: int, payload: dict):
+                data = json.dumps(payload).encode("utf-8")
+                self.send_response(status)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(data)))
+                self.end_headers()
+                self.wfile.write(data)
+
+            def _stream_chat(self):
+                self.send_response(200)
+                self.send_header("Content-Type", "text/event-stream")
+                self.send_header("Connection", "close")
+                self.end_headers()
+                try:
+                    # 最初のチャンクの後も続きを少しずつ送り、閉じられたら書き込みが失敗する
+                    for i in range(40):
+                        chunk = {
+                            "id": "chatcmpl-stub",
+                            "object": "chat.completion.chunk",
+                            "created": 0,
+                            "model": stub.name,
+                            "choices": [{"index": 0, "delta": {"content": f"{stub.name}{i} "}, "finish_reason": None}]
+                        }
+                        self.wfile.write(f"data: {json.dumps(chunk)}\n\n".encode("utf-8"))
+                        self.wfile.flush()
+                        time.sleep(0.025)
+                    self.wfile.write(b"data: [DONE]\n\n")
+                    self.wfile.flush()
+                except (BrokenPipeError, ConnectionResetError):
+                    with stub._lock:
+                        stub.streams_aborted += 1
+                self.close_connection = True
+
+        return Handler
+
+
+@pytest.fixture
+def stub_server():
+    """StubOpenAIServer を作るファクトリ（テストの終了時に停止する）"""
+    servers: List[StubOpenAIServer] = []
+
+    def create(name: str, latency: float = 0.0, status: int = 200) -> StubOpenAIServer:
+        server = StubOpenAIServer(name, latency, status)
+        servers.append(server)
+        return server
+
+    yield create
+    for server in servers:
+        server.close()
+
+
+def fake_embedding(text: str, dimension: int = 16) -> List[float]:
+    """テキストのハッシュから作る埋め込み（同じテキストなら同じベクトル）"""
+    seed = int.from_bytes(hashlib.sha256(text.encode("utf-8")).digest()[:8], "little")
+    return np.random.default_rng(seed).standard_normal(dimension).astype(np.float32).tolist()
+
+
+@pytest.fixture
+def vector_db(tmp_path, monkeypatch):
+    """tmp_path にデータを置き、埋め込みを fake_embedding で作るベクトルDB（読み込み済み）"""
+    monkeypatch.chdir(tmp_path)
+    service = VectorDBService()
+    service._get_embedding = fake_embedding
+    service._get_embeddings = lambda texts, concurrency=1: [fake_embedding(text) for text in texts]
+    service.load()
+    return service
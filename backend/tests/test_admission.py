@@ -0,0 +1,126 @@
+"""
+AdmissionController のテスト（同時実行数・優先度付きの待ち行列・負荷遮断）
+"""
+import asyncio
+
+import pytest
+
+from services.admission import AdmissionController, AdmissionRejected
+
+
+async def settle():
+    """待機中のタスクを進める"""
+    for _ in range(5):
+        await asyncio.sleep(0)
+
+
+@pytest.mark.asyncio
+async def test_grants_up_to_max_concurrency_then_queues():
+    controller = AdmissionController("test", max_concurrency=2, slo_seconds=100)
+    first = await controller.acquire("a", False, 10)
+    second = await controller.acquire("b", False, 10)
+
+    waiting = asyncio.create_task(controller.acquire("c", False, 10))
+    await settle()
+    assert not waiting.done()
+    assert controller.status()['queue_depth'] == 1
+
+    first.release()
+    third = await waiting
+    assert controller.status()['active'] == 2
+    assert controller.status()['queue_depth'] == 0
+
+    # 複数回 release しても枠は1つだけ返る
+    second.release()
+    second.release()
+    third.release()
+    assert controller.status()['active'] == 0
+
+
+@pytest.mark.asyncio
+async def test_waiters_are_granted_in_priority_order():
+    controller = AdmissionController("test", max_concurrency=1, slo_seconds=100)
+    running = await controller.acquire("busy", False, 10)
+
+    order = []
+
+    async def request(name, session_id, in_progress, prompt_chars):
+        slot = await controller.acquire(session_id, in_progress, prompt_chars)
+        order.append(name)
+        slot.release()
+
+    tasks = [
+        # 同じセッションで実行中のものがあると後回し
+        asyncio.create_task(request("same_session", "busy", True, 10)),
+        # 新しい会話で長いプロンプト
+        asyncio.create_task(request("new_long", "x", False, 5000)),
+        # 新しい会話で短いプロンプト
+        asyncio.create_task(request("new_short", "y", False, 10)),
+        # 会話の途中
+        asyncio.create_task(request("in_progress", "z", True, 4000)),
+    ]
+    await settle()
+    running.release()
+    await asyncio.gather(*tasks)
+
+    assert order == ["in_progress", "new_short", "new_long", "same_session"]
+
+
+@pytest.mark.asyncio
+async def test_sheds_when_estimated_wait_exceeds_slo():
+    controller = AdmissionController("test", max_concurrency=1, slo_seconds=3, initial_service_seconds=2)
+    slot = await controller.acquire("a", False, 10)
+
+    # 1件目の待機者の見込み待ち時間は 2 秒、2件目は 4 秒で SLO を超える
+    waiting = asyncio.create_task(controller.acquire("b", False, 10))
+    await settle()
+    with pytest.raises(AdmissionRejected) as rejected:
+        await controller.acquire("c", False, 10)
+    assert rejected.value.retry_after == 4
+    assert controller.shed['slo'] == 1
+
+    slot.release()
+    (await waiting).release()
+
+
+@pytest.mark.asyncio
+async def test_full_queue_evicts_lower_priority_waiter():
+    controller = AdmissionController("test", max_concurrency=1, max_queue=1, slo_seconds=100)
+    slot = await controller.acquire("a", False, 10)
+
+    low = asyncio.create_task(controller.acquire("b", False, 5000))
+    await settle()
+    # 優先度の高い要求は、待ち行列が満杯でも低い待機者と入れ替わる
+    high = asyncio.create_task(controller.acquire("c", True, 10))
+    await settle()
+    with pytest.raises(AdmissionRejected):
+        await low
+    assert controller.shed['evicted'] == 1
+
+    # 優先度が同じか低い要求は断られる
+    with pytest.raises(AdmissionRejected):
+        await controller.acquire("d", False, 5000)
+    assert controller.shed['queue_full'] == 1
+
+    slot.release()
+    (await high).release()
+    assert controller.status()['active'] == 0
+
+
+@pytest.mark.asyncio
+async def test_cancelled_waiter_leaves_the_queue():
+    controller = AdmissionController("test", max_concurrency=1, slo_seconds=100)
+    slot = await controller.acquire("a", False, 10)
+
+    waiting = asyncio.create_task(controller.acquire("b", False, 10))
+    await settle()
+    waiting.cancel()
+    with pytest.raises(asyncio.CancelledError):
+        await waiting
+    assert controller.queue_depth == 0
+    assert controller._session_load.get("b") is None
+
+    # 切断した待機者に枠が渡って失われることはない
+    slot.release()
+    assert controller.status()['active'] == 0
+    (await controller.acquire("c", False, 10)).release()
@@ -0,0 +1,92 @@
+"""
+2段階検索のテスト（低次元の粗い検索で絞った候補の再現率と、絞り込み条件の扱い）
+"""
+import numpy as np
+import pytest
+
+from services.coarse_search import PCAReducer, PrefixReducer, build_reducer, coarse_method
+
+ROWS = 4000
+DIMENSION = 256
+
+
+def corpus(method: str, seed: int = 0) -> np.ndarray:
+    """
+    低次元化が前提とする構造を持つ埋め込み
+
+    prefix: 先頭の次元ほど分散が大きい（Matryoshka 埋め込み）
+    pca: 少数の方向に情報が集まっているが、どの次元にも混ざっている
+    """
+    rng = np.random.default_rng(seed)
+    if method == "prefix":
+        scales = np.exp(-np.arange(DIMENSION) / 24.0)
+        return (rng.standard_normal((ROWS, DIMENSION)) * scales).astype(np.float32)
+    latent = rng.standard_normal((ROWS, 24))
+    mixing = rng.standard_normal((24, DIMENSION))
+    return (latent @ mixing + 0.05 * rng.standard_normal((ROWS, DIMENSION))).astype(np.float32)
+
+
+def publish(vector_db, embeddings: np.ndarray):
+    """埋め込みを直接1つの世代として公開"""
+    documents = [
+        {'source': f"doc{i % 7}.txt", 'chunk_index': i, 'content': f"chunk {i}", 'doc_id': f"id{i}"}
+        for i in range(len(embeddings))
+    ]
+    with vector_db.shared_store.writer_lock():
+        vector_db._publish(documents, embeddings)
+    vector_db._refresh()
+
+
+def recall(vector_db, queries: np.ndarray, n_results: int, filters=None) -> float:
+    """全次元での検索結果のうち、2段階検索でも返った割合"""
+    coarse_dims = vector_db.coarse_dims
+    vector_db.coarse_dims = 0
+    exact = vector_db._search_vectors(queries.tolist(), n_results, filters)
+    vector_db.coarse_dims = coarse_dims
+    approximate = vector_db._search_vectors(queries.tolist(), n_results, filters)
+
+    found = total = 0
+    for expected, actual in zip(exact, approximate):
+        expected_ids = {result['metadata']['doc_id'] for result in expected}
+        found += len(expected_ids & {result['metadata']['doc_id'] for result in actual})
+        total += len(expected_ids)
+    return found / total
+
+
+@pytest.mark.parametrize("method, dims", [("prefix", 64), ("pca", 32)])
+def test_two_stage_search_keeps_recall(vector_db, method, dims):
+    embeddings = corpus(method)
+    publish(vector_db, embeddings)
+    vector_db.coarse_method = method
+    vector_db.coarse_dims = dims
+    vector_db.coarse_min_rows = 1000
+
+    # 登録済みのチャンクに少しノイズを加えたものをクエリにする
+    rng = np.random.default_rng(1)
+    queries = embeddings[rng.choice(ROWS, 50, replace=False)] + 0.1 * rng.standard_normal((50, DIMENSION)).astype(np.float32)
+
+    assert recall(vector_db, queries, n_results=10) >= 0.95
+    reducer, _ = vector_db._coarse_index(vector_db._snapshot.blocks)
+    assert reducer.method == method
+
+    # 絞り込み条件に一致しない行は粗い検索の候補にもならない
+    filters = {'source': ['doc3.txt']}
+    assert recall(vector_db, queries, n_results=10, filters=filters) >= 0.95
+    for results in vector_db._search_vectors(queries.tolist(), 10, filters):
+        assert {result['metadata']['source'] for result in results} == {'doc3.txt'}
+
+
+def test_build_reducer_falls_back_when_unusable():
+    blocks = [corpus("pca")[:100]]
+    assert isinstance(build_reducer("prefix", 64, blocks), PrefixReducer)
+    assert isinstance(build_reducer("pca", 32, blocks), PCAReducer)
+    # 元の次元以上や、学習に足りない行数では使わない
+    assert build_reducer("prefix", DIMENSION, blocks) is None
+    assert build_reducer("pca", 32, [blocks[0][:10]]) is None
+    assert build_reducer("pca", 32, []) is None
+
+
+def test_coarse_method_auto_follows_deployment():
+    assert coarse_method("auto", "text-embedding-3-large") == "prefix"
+    assert coarse_method("auto", "text-embedding-ada-002") == "pca"
+    assert coarse_method("pca", "text-embedding-3-small") == "pca"
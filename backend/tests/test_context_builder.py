@@ -0,0 +1,59 @@
+"""
+RAGコンテキストの組み立てのテスト（隣接チャンクの結合・重複の除去・トークン予算）
+"""
+from services.context_builder import ContextBuilder
+
+
+def result(source, chunk_index, content, score):
+    return {'content': content, 'metadata': {'source': source, 'chunk_index': chunk_index}, 'score': score}
+
+
+def test_merges_adjacent_chunks_without_overlap():
+    builder = ContextBuilder(token_budget=1000)
+    passages = builder.merge_adjacent([
+        result("rules.pdf", 1, "第2条 申請は3営業日前までに行う。第3条 承認", 0.7),
+        result("rules.pdf", 0, "第1条 この規程は有給休暇について定める。第2条 申請は3営業日前までに行う。", 0.9),
+        result("rules.pdf", 3, "第5条 附則", 0.5),
+    ])
+
+    assert [passage['chunk_indexes'] for passage in passages] == [[0, 1], [3]]
+    assert passages[0]['content'] == "第1条 この規程は有給休暇について定める。第2条 申請は3営業日前までに行う。\n\n第3条 承認"
+    assert passages[0]['score'] == 0.9
+
+
+def test_context_fits_token_budget_and_fills_the_rest():
+    builder = ContextBuilder(token_budget=120, diversity=0.0, min_fill_tokens=10)
+    results = [
+        result("a.pdf", 0, "有給休暇の申請手順について説明します。" * 3, 0.9),
+        result("b.pdf", 0, "経費精算の締め日は毎月25日です。" * 3, 0.8),
+        result("c.pdf", 0, "情報セキュリティ研修は年1回の受講が必須です。" * 10, 0.7),
+    ]
+
+    context, sources = builder.build(results)
+    counter = builder.token_counter
+    assert counter.count(context) <= 120
+    # 入りきらないパッセージは先頭を切り詰めて残りの予算を埋める
+    assert sources == ["a.pdf", "b.pdf", "c.pdf"]
+    assert context.startswith("有給休暇の申請手順")
+    assert "情報セキュリティ研修" in context
+    assert counter.count(context) > 120 - 10
+
+    # リクエストごとの予算が小さければ関連度の高いものだけを入れる
+    context, sources = builder.build(results, token_budget=counter.count(results[0]['content']))
+    assert (context, sources) == (results[0]['content'], ["a.pdf"])
+
+
+def test_duplicate_content_is_included_once_and_diverse_passages_are_preferred():
+    builder = ContextBuilder(token_budget=60, diversity=0.5, min_fill_tokens=1000)
+    leave = "有給休暇は入社6か月後に10日付与されます。"
+    results = [
+        result("a.pdf", 0, leave, 0.9),
+        result("copy.pdf", 4, leave, 0.85),
+        result("a-v2.pdf", 0, leave + "。", 0.88),
+        result("b.pdf", 0, "経費精算は翌月5日までに申請します。", 0.6),
+    ]
+
+    context, sources = builder.build(results)
+    # 同じ内容は関連度の高い方だけ、ほぼ同じ内容より別の話題を優先する
+    assert sources == ["a.pdf", "b.pdf"]
+    assert context.count("有給休暇") == 1
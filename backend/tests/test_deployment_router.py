@@ -0,0 +1,213 @@
+"""
+DeploymentRouter のテスト（応答時間・失敗のしかたが異なるスタブサーバーに振り分ける）
+"""
+import time
+
+import pytest
+
+from services.deployment_router import Backend, DeploymentRouter
+
+
+def make_router(servers, **kwargs) -> DeploymentRouter:
+    backends = [
+        Backend(name=server.name, endpoint=server.endpoint, api_key="test-key", deployment="test", max_retries=0)
+        for server in servers
+    ]
+    return DeploymentRouter(backends, **kwargs)
+
+
+def embed(router: DeploymentRouter, hedge=None) -> str:
+    """埋め込みを1回リクエストし、応答したサーバーの名前を返す"""
+    response = router.call(
+        lambda backend: backend.client.embeddings.create(model=backend.deployment, input="hello"),
+        hedge=hedge,
+        label="embedding"
+    )
+    return response.model
+
+
+def wait_until(condition, timeout: float = 2.0) -> bool:
+    """条件が満たされるまで待つ（ヘッジで使わなかった側の後始末は別スレッドで進む）"""
+    deadline = time.monotonic() + timeout
+    while not condition() and time.monotonic() < deadline:
+        time.sleep(0.02)
+    return condition()
+
+
+def state(router: DeploymentRouter, name: str) -> dict:
+    return next(status for status in router.status() if status['name'] == name)
+
+
+def test_routes_to_lower_latency_backend(stub_server):
+    fast = stub_server("fast", latency=0.01)
+    slow = stub_server("slow", latency=0.15)
+    router = make_router([fast, slow])
+
+    served = [embed(router) for _ in range(20)]
+
+    # 応答時間が記録されるまでの最初の数回を除いて、速い方に送る
+    assert served.count("fast") >= 18
+    assert slow.requests <= 2
+    assert state(router, "fast")['ewma_latency_ms'] < state(router, "slow")['ewma_latency_ms']
+    assert all(status['outstanding'] == 0 for status in router.status())
+
+
+def test_fails_over_to_healthy_backend(stub_server):
+    broken = stub_server("broken", status=500)
+    healthy = stub_server("healthy", latency=0.02)
+    router = make_router([broken, healthy], failure_threshold=5)
+    router.backends[1].ewma_latency = 1.0  # 壊れている方を先に選ばせる
+
+    assert embed(router) == "healthy"
+    assert broken.requests == 1
+    assert state(router, "broken")['failures'] == 1
+
+
+def test_client_errors_are_not_retried(stub_server):
+    invalid = stub_server("invalid", status=400)
+    other = stub_server("other")
+    router = make_router([invalid, other])
+    router.backends[1].ewma_latency = 1.0
+
+    with pytest.raises(Exception):
+        embed(router)
+    # リクエスト自体の誤りは他に送っても失敗するので、再試行も障害の記録もしない
+    assert other.requests == 0
+    assert state(router, "invalid")['failures'] == 0
+    assert state(router, "invalid")['state'] == "closed"
+
+
+def test_circuit_breaker_opens_and_recovers_through_half_open(stub_server):
+    flaky = stub_server("flaky", status=503)
+    healthy = stub_server("healthy", latency=0.02)
+    router = make_router([flaky, healthy], failure_threshold=2, cooldown=0.3)
+    router.backends[1].ewma_latency = 1.0
+
+    # 連続失敗が閾値に達すると開き、冷却期間中は送らない
+    for _ in range(2):
+        assert embed(router) == "healthy"
+    assert state(router, "flaky")['state'] == "open"
+    for _ in range(3):
+        assert embed(router) == "healthy"
+    assert flaky.requests == 2
+
+    # 冷却期間が過ぎると半開になり、試行は1件だけ
+    time.sleep(0.35)
+    assert state(router, "flaky")['state'] == "half_open"
+    trial = router._select([])
+    assert trial.name == "flaky"
+    second = router._select([])
+    assert second.name == "healthy"
+    # 選んだだけの試行は送らずに取り消す
+    router._release(trial)
+    router._release(second)
+    router.backends[0].trial_in_flight = False
+
+    # 試行が成功すれば閉じる
+    flaky.status = 200
+    assert embed(router) == "flaky"
+    assert state(router, "flaky")['state'] == "closed"
+
+
+def test_half_open_trial_failure_reopens_immediately(stub_server):
+    flaky = stub_server("flaky", status=500)
+    healthy = stub_server("healthy", latency=0.02)
+    router = make_router([flaky, healthy], failure_threshold=2, cooldown=0.3)
+    router.backends[1].ewma_latency = 1.0
+
+    for _ in range(2):
+        embed(router)
+    time.sleep(0.35)
+    assert state(router, "flaky")['state'] == "half_open"
+
+    # 半開での試行が失敗すれば、連続失敗数に関わらずすぐに開き直す
+    assert embed(router) == "healthy"
+    assert flaky.requests == 3
+    assert state(router, "flaky")['state'] == "open"
+
+
+def test_hedge_returns_faster_backend_and_drops_the_slow_response(stub_server):
+    slow = stub_server("slow", latency=0.0)
+    fast = stub_server("fast", latency=0.0)
+    router = make_router([slow, fast], hedge=True, hedge_min_samples=3, hedge_min_delay=0.05)
+    for _ in range(3):
+        embed(router, hedge=False)
+
+    # 遅くなった方を最初に選ばせ、p95 を過ぎたら速い方にも送る
+    slow.latency = 0.6
+    fast.latency = 0.01
+    router.backends[0].ewma_latency = 0.001
+    router.backends[1].ewma_latency = 0.5
+    start = time.monotonic()
+    assert embed(router) == "fast"
+    assert time.monotonic() - start < 0.4
+    assert router.hedged_requests == 1
+
+    # 使わなかった応答が返ってきたら処理中の数から外す
+    assert wait_until(lambda: all(status['outstanding'] == 0 for status in router.status()))
+    assert slow.requests + fast.requests == 5
+
+
+def test_hedged_stream_closes_the_losing_stream(stub_server):
+    slow = stub_server("slow", latency=0.0)
+    fast = stub_server("fast", latency=0.0)
+    router = make_router([slow, fast], hedge=True, hedge_min_samples=1, hedge_min_delay=0.05)
+
+    def create(backend):
+        return backend.client.chat.completions.create(
+            model=backend.deployment, messages=[{"role": "user", "content": "hi"}], stream=True
+        )
+
+    # 最後まで読まずに閉じたストリームはサーバー側で打ち切られる
+    router.open_stream(create, hedge=False).close()
+    assert wait_until(lambda: slow.streams_aborted + fast.streams_aborted == 1)
+    slow_aborted = slow.streams_aborted
+    slow.latency = 0.3
+    fast.latency = 0.0
+    router.backends[0].ewma_latency = 0.001
+    router.backends[1].ewma_latency = 0.5
+
+    stream = router.open_stream(create)
+    assert stream.backend.name == "fast"
+    text = "".join(chunk.choices[0].delta.content or "" for chunk in stream if chunk.choices)
+    assert text.startswith("fast0 ")
+    assert router.hedged_requests == 1
+
+    # 遅れて始まった方のストリームは閉じられ、サーバー側で送信が打ち切られる
+    assert wait_until(lambda: slow.streams_aborted == slow_aborted + 1)
+    assert slow.requests + fast.requests == 3
+    assert wait_until(lambda: all(status['outstanding'] == 0 for status in router.status()))
+
+
+class BrokenStream:
+    """最初のチャンクの後で接続が切れるストリーム"""
+
+    def __init__(self):
+        self.closed = False
+
+    def __iter__(self):
+        yield "first"
+        raise ConnectionResetError("connection reset")
+
+    def close(self):
+        self.closed = True
+
+
+def test_stream_failing_midway_counts_one_request_and_one_failure():
+    backend = Backend(name="flaky", endpoint="http://127.0.0.1:9", api_key="test-key", deployment="test")
+    router = DeploymentRouter([backend], failure_threshold=1)
+
+    for attempt in range(2):
+        stream = router.open_stream(lambda backend: BrokenStream())
+        with pytest.raises(ConnectionResetError):
+            list(stream)
+        assert stream._stream.closed
+        # 途中の切断は失敗としてサーキットブレーカーに数える
+        assert state(router, "flaky")['state'] == "open"
+
+    # 最初のチャンクで記録したリクエストは数え直さず、応答時間もストリームの分位点にだけ記録する
+    assert backend.requests == 2
+    assert backend.failures == 2
+    assert backend.outstanding == 0
+    assert len(router._latencies["stream"]) == 2
+    assert "default" not in router._latencies
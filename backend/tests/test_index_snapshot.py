@@ -0,0 +1,73 @@
+"""
+インデックスのスナップショットのテスト（取得済みのスナップショットは更新の影響を受けず、検索は一貫した状態を読む）
+"""
+import asyncio
+import threading
+
+import numpy as np
+import pytest
+
+
+def text(name: str) -> str:
+    """本文からソース名がわかるチャンクになるテキスト"""
+    return f"[{name}] 社内規程の本文です。" * 20
+
+
+def add(vector_db, name: str):
+    result = asyncio.run(vector_db.add_document(text(name), {'source': name}, dedup=False))
+    assert result['status'] == 'success'
+
+
+def test_held_snapshot_is_not_changed_by_updates(vector_db):
+    add(vector_db, 'a.txt')
+    held = vector_db._snapshot
+    documents, live = len(held.documents), held.live.copy()
+
+    add(vector_db, 'b.txt')
+    assert vector_db.delete_document('a.txt')
+
+    # 取得済みのスナップショットは元のまま、更新は新しいスナップショットにだけ現れる
+    assert vector_db._snapshot is not held
+    assert len(held.documents) == documents
+    np.testing.assert_array_equal(held.live, live)
+    assert {doc['source'] for doc in vector_db.list_documents()} == {'b.txt'}
+
+    # スナップショットの配列は書き込めない
+    with pytest.raises(ValueError):
+        held.live[0] = False
+    with pytest.raises(ValueError):
+        held.blocks[0][0][0, 0] = 0.0
+
+
+def test_search_during_updates_reads_consistent_rows(vector_db):
+    for i in range(4):
+        add(vector_db, f"base{i}.txt")
+
+    stop = threading.Event()
+    errors = []
+
+    def search_loop():
+        query = [np.ones(16, dtype=np.float32).tolist()]
+        while not stop.is_set():
+            try:
+                for result in vector_db._search_vectors(query, 10, None)[0]:
+                    # 本文とメタデータが別々の状態から読まれていれば食い違う
+                    assert result['content'].startswith(f"[{result['metadata']['source']}]")
+            except Exception as e:
+                errors.append(e)
+                return
+
+    threads = [threading.Thread(target=search_loop) for _ in range(2)]
+    for thread in threads:
+        thread.start()
+    try:
+        for i in range(20):
+            add(vector_db, f"tmp{i}.txt")
+            assert vector_db.delete_document(f"tmp{i}.txt")
+            add(vector_db, f"kept{i}.txt")
+    finally:
+        stop.set()
+        for thread in threads:
+            thread.join()
+
+    assert errors == []
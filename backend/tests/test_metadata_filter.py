@@ -0,0 +1,87 @@
+"""
+メタデータによる絞り込みのテスト（値ごとの行IDセット・作成日時の範囲・条件の検証）
+"""
+import asyncio
+
+import numpy as np
+import pytest
+
+from services.vector_db_service import MetadataIndex
+
+DOCUMENTS = [
+    {'source': 'a.pdf', 'file_type': '.pdf', 'content_hash': 'h1', 'created_at': '2024-01-10T00:00:00'},
+    {'source': 'b.txt', 'file_type': '.txt', 'content_hash': 'h2', 'created_at': '2024-02-10T00:00:00'},
+    {'source': 'a.pdf', 'file_type': '.pdf', 'content_hash': 'h1', 'created_at': '2024-03-10T00:00:00'},
+    {'source': 'c.md', 'file_type': '.md', 'content_hash': 'h3', 'created_at': '2024-04-10T00:00:00'},
+]
+APPENDED = [
+    {'source': 'd.pdf', 'file_type': '.pdf', 'content_hash': 'h4', 'created_at': '2024-05-10T00:00:00'},
+    {'source': 'b.txt', 'file_type': '.txt', 'content_hash': 'h2', 'created_at': '2024-01-20T00:00:00'},
+]
+
+
+def indexes():
+    """同じ行を持つ、直接作ったインデックスと、公開した列 + ログで追加した行のインデックス"""
+    documents = DOCUMENTS + APPENDED
+    values, columns = MetadataIndex.build_columns(DOCUMENTS)
+    published = MetadataIndex.from_columns(DOCUMENTS, values, columns).extended(documents)
+    return MetadataIndex(documents), published
+
+
+@pytest.mark.parametrize("filters, expected", [
+    ({'source': ['a.pdf']}, [0, 2]),
+    ({'source': ['a.pdf', 'b.txt']}, [0, 1, 2, 5]),
+    ({'file_type': ['.pdf']}, [0, 2, 4]),
+    ({'file_type': ['.pdf'], 'source': ['d.pdf']}, [4]),
+    ({'source': ['missing.pdf']}, []),
+    ({'created_after': '2024-03-01'}, [2, 3, 4]),
+    ({'created_before': '2024-02-01'}, [0, 5]),
+    ({'created_after': '2024-01-15', 'created_before': '2024-04-01', 'file_type': ['.txt']}, [1, 5]),
+])
+def test_mask_matches_rows(filters, expected):
+    for index in indexes():
+        assert np.flatnonzero(index.mask(filters)).tolist() == expected
+        assert index.size == len(DOCUMENTS) + len(APPENDED)
+
+
+def test_no_filters_means_no_mask():
+    index, _ = indexes()
+    assert index.mask(None) is None
+    assert index.mask({}) is None
+
+
+def test_validate_filters_normalizes_values():
+    assert MetadataIndex.validate_filters(None) is None
+    assert MetadataIndex.validate_filters({'source': None}) is None
+    assert MetadataIndex.validate_filters({'source': 'a.pdf', 'created_after': '2024-01-01T09:00:00'}) == {
+        'source': ['a.pdf'], 'created_after': '2024-01-01T09:00:00'
+    }
+
+
+@pytest.mark.parametrize("filters", [
+    ['source'],
+    {'author': 'someone'},
+    {'source': 3},
+    {'file_type': ['.pdf', {'$ne': '.txt'}]},
+    {'created_after': 'yesterday'},
+    {'created_before': 20240101},
+])
+def test_validate_filters_rejects_unsupported_conditions(filters):
+    with pytest.raises(ValueError):
+        MetadataIndex.validate_filters(filters)
+
+
+def test_filtered_search_returns_only_matching_sources(vector_db):
+    texts = {}
+    for source, file_type in [('hr.pdf', '.pdf'), ('it.txt', '.txt'), ('finance.pdf', '.pdf')]:
+        texts[source] = f"{source} の規程の本文です。" * 20
+        result = asyncio.run(vector_db.add_document(texts[source], {'source': source, 'file_type': file_type}, dedup=False))
+        assert result['status'] == 'success'
+
+    # 最も近いチャンク（it.txt）が条件外でも、条件に一致する行だけから返す
+    results = asyncio.run(vector_db.search(texts['it.txt'], n_results=5, filters={'file_type': ['.pdf']}))
+    assert sorted(result['metadata']['source'] for result in results) == ['finance.pdf', 'hr.pdf']
+
+    results = asyncio.run(vector_db.search(texts['it.txt'], n_results=5, filters={'source': ['it.txt']}))
+    assert [result['metadata']['source'] for result in results] == ['it.txt']
+    assert asyncio.run(vector_db.search("it.txt", n_results=5, filters={'source': ['none.pdf']})) == []
@@ -0,0 +1,70 @@
+"""
+準重複チャンクの検出のテスト（参照としての登録・絞り込み・正規のチャンクの削除時の昇格）
+"""
+import asyncio
+
+from services.near_duplicate import MinHasher
+
+ORIGINAL = "就業規則 第12条 年次有給休暇は、入社6か月後に10日を付与し、以後1年ごとに所定の日数を付与する。" * 8
+REVISED = ORIGINAL[:-2] + "る。"  # 末尾だけが違う改訂版
+
+
+def sources(vector_db):
+    return {doc['source']: doc for doc in vector_db.list_documents()}
+
+
+def test_min_hasher_estimates_similarity():
+    hasher = MinHasher()
+    original = hasher.signature(ORIGINAL)
+    assert hasher.similarity(original, hasher.signature(REVISED)) > 0.9
+    assert hasher.similarity(original, hasher.signature("経費精算は翌月5日までに申請してください。" * 8)) < 0.2
+
+
+def test_near_duplicate_is_registered_as_reference(vector_db):
+    assert asyncio.run(vector_db.add_document(ORIGINAL, {'source': 'rules-2023.txt'}))['chunks_added'] == 1
+    result = asyncio.run(vector_db.add_document(REVISED, {'source': 'rules-2024.txt'}))
+
+    assert result['chunks_added'] == 0
+    assert result['duplicates_skipped'] == 1
+    assert result['duplicate_sources'] == ['rules-2023.txt']
+    assert sources(vector_db)['rules-2024.txt']['duplicate_chunks'] == 1
+    assert len(vector_db._snapshot.documents) == 1
+
+    # 参照として登録した文書で絞り込んでも、正規のチャンクの本文と参照元のメタデータで返る
+    results = asyncio.run(vector_db.search(ORIGINAL, n_results=3, filters={'source': ['rules-2024.txt']}))
+    assert [result['metadata']['source'] for result in results] == ['rules-2024.txt']
+    assert results[0]['content'] == ORIGINAL[:len(results[0]['content'])]
+
+    # dedup を無効にすると別のチャンクとして登録する
+    result = asyncio.run(vector_db.add_document(REVISED, {'source': 'rules-copy.txt'}, dedup=False))
+    assert result['chunks_added'] == 1
+
+
+def test_deleting_canonical_chunk_promotes_reference(vector_db):
+    asyncio.run(vector_db.add_document(ORIGINAL, {'source': 'rules-2023.txt'}))
+    asyncio.run(vector_db.add_document(REVISED, {'source': 'rules-2024.txt'}))
+    asyncio.run(vector_db.add_document(ORIGINAL, {'source': 'rules-mirror.txt'}))
+
+    assert vector_db.delete_document('rules-2023.txt')
+
+    # 最初の参照元が正規のチャンクとして昇格し、残りの参照はその行を指し直す
+    listed = sources(vector_db)
+    assert 'rules-2023.txt' not in listed
+    assert (listed['rules-2024.txt']['chunks'], listed['rules-2024.txt']['duplicate_chunks']) == (1, 0)
+    assert listed['rules-mirror.txt']['duplicate_chunks'] == 1
+    assert vector_db._snapshot.references[0]['canonical_source'] == 'rules-2024.txt'
+
+    results = asyncio.run(vector_db.search(ORIGINAL, n_results=5))
+    assert [result['metadata']['source'] for result in results] == ['rules-2024.txt']
+    results = asyncio.run(vector_db.search(ORIGINAL, n_results=5, filters={'source': ['rules-mirror.txt']}))
+    assert [result['metadata']['source'] for result in results] == ['rules-mirror.txt']
+
+    # コンパクション後も同じ状態を保つ
+    vector_db.compact()
+    assert sources(vector_db) == listed
+
+    # 最後の参照元も削除すれば参照は残らない
+    assert vector_db.delete_document('rules-2024.txt')
+    assert vector_db.delete_document('rules-mirror.txt')
+    assert vector_db.list_documents() == []
+    assert asyncio.run(vector_db.search(ORIGINAL, n_results=5)) == []
@@ -0,0 +1,89 @@
+"""
+検索の先読みのテスト（下書きの結果の再利用・破棄と /chat/prefetch）
+"""
+import asyncio
+
+import pytest
+from fastapi import FastAPI
+from fastapi.testclient import TestClient
+
+from routes import chat
+from services import retrieval_prefetch
+from services.retrieval_prefetch import RetrievalPrefetcher
+from services.session_service import session_service
+from services.vector_db_service import vector_db_service
+
+
+@pytest.fixture
+def searches(monkeypatch):
+    """検索をスタブにして、検索したクエリを記録する"""
+    queries = []
+
+    async def search_context(message, filters):
+        queries.append(message)
+        await asyncio.sleep(0.01)
+        return f"context for {message}", [f"{message}.txt"]
+
+    monkeypatch.setattr(retrieval_prefetch, "search_context", search_context)
+    monkeypatch.setitem(vector_db_service.load_status, 'state', 'ready')
+    monkeypatch.setattr(session_service, "snapshot_store", None)
+    return queries
+
+
+def test_similar_message_reuses_prefetched_result(searches):
+    async def run():
+        prefetcher = RetrievalPrefetcher()
+        assert prefetcher.prefetch("s1", "有給休暇の申請方法を教えて", None)
+        # 同じ下書きでは検索し直さない
+        assert prefetcher.prefetch("s1", "有給休暇の申請方法を教えて", None)
+        # 検索の途中で送信されても完了を待って使う
+        result = await prefetcher.take("s1", "有給休暇の申請方法を教えてください", None)
+        # 1回使ったら破棄する
+        again = await prefetcher.take("s1", "有給休暇の申請方法を教えてください", None)
+        return result, again
+
+    result, again = asyncio.run(run())
+    assert result == ("context for 有給休暇の申請方法を教えて", ["有給休暇の申請方法を教えて.txt"])
+    assert again is None
+    assert searches == ["有給休暇の申請方法を教えて"]
+
+
+def test_different_message_or_filters_discard_prefetch(searches):
+    async def run():
+        prefetcher = RetrievalPrefetcher()
+        prefetcher.prefetch("s1", "有給休暇の申請方法を教えて", None)
+        different_message = await prefetcher.take("s1", "経費精算の締め日はいつですか", None)
+        prefetcher.prefetch("s2", "有給休暇の申請方法を教えて", None)
+        different_filters = await prefetcher.take("s2", "有給休暇の申請方法を教えて", {"category": "hr"})
+        # 短すぎる下書きは先読みしない
+        short = prefetcher.prefetch("s3", "有給", None)
+        return different_message, different_filters, short
+
+    assert asyncio.run(run()) == (None, None, False)
+
+
+@pytest.fixture
+def client(searches):
+    app = FastAPI()
+    app.include_router(chat.router)
+    with TestClient(app) as test_client:
+        yield test_client
+
+
+def test_prefetch_without_session_does_not_create_one(client, searches):
+    before = session_service.get_active_sessions_count()
+    for session_id in ("", "unknown"):
+        response = client.post("/chat/prefetch", data={"message": "有給休暇の申請方法を教えて", "session_id": session_id})
+        assert response.json() == {"session_id": None, "prefetching": False}
+    response = client.post("/chat/prefetch", data={"message": "有給休暇の申請方法を教えて"})
+    assert response.json() == {"session_id": None, "prefetching": False}
+
+    assert session_service.get_active_sessions_count() == before
+    assert searches == []
+
+
+def test_prefetch_with_session_starts_search(client, searches):
+    session_id = session_service.create_session()
+    response = client.post("/chat/prefetch", data={"message": "有給休暇の申請方法を教えて", "session_id": session_id})
+    assert response.json() == {"session_id": session_id, "prefetching": True}
+    retrieval_prefetch.retrieval_prefetcher._entries.pop(session_id)['task'].cancel()
@@ -0,0 +1,97 @@
+"""
+セッションのスナップショットのテスト（エンコード・破損の検出・再起動後の復元）
+"""
+import asyncio
+import os
+import time
+import uuid
+
+from services.session_service import SessionService
+from services.session_store import SessionSnapshotStore
+
+
+def test_encode_decode_round_trip():
+    messages = [("user", "こんにちは", 1.5), ("assistant", "ご用件をどうぞ。", 2.5), ("tool", "{}", 3.0)]
+    data = SessionSnapshotStore.encode(1.0, 3.0, '{"search_filters": {"category": "hr"}}', messages)
+
+    decoded = SessionSnapshotStore.decode(data)
+    assert decoded == {
+        'created_at': 1.0,
+        'last_accessed': 3.0,
+        'metadata': {'search_filters': {'category': 'hr'}},
+        'messages': messages
+    }
+
+
+def test_decode_rejects_corrupted_data(tmp_path):
+    data = bytearray(SessionSnapshotStore.encode(1.0, 2.0, "{}", [("user", "本文", 1.0)]))
+    data[-1] ^= 0x01
+    assert SessionSnapshotStore.decode(bytes(data)) is None
+
+    # 壊れたファイルは復元されない
+    store = SessionSnapshotStore(str(tmp_path))
+    session_id = str(uuid.uuid4())
+    store.save(session_id, bytes(data))
+    assert store.load(session_id) is None
+
+
+def test_restart_restores_session_on_first_access(tmp_path):
+    service = SessionService(snapshot_dir=str(tmp_path))
+    session_id = service.create_session()
+    service.add_message(session_id, "user", "有給休暇の申請方法は？")
+    service.add_message(session_id, "assistant", "申請システムから申請してください。")
+    service.update_metadata(session_id, {"search_filters": {"category": "hr"}})
+    assert asyncio.run(service.flush_snapshots()) == 1
+    # 変更が無ければ書き出さない
+    assert asyncio.run(service.flush_snapshots()) == 0
+
+    restarted = SessionService(snapshot_dir=str(tmp_path))
+    assert restarted.get_active_sessions_count() == 0
+    assert restarted.get_messages(session_id) == [
+        {"role": "user", "content": "有給休暇の申請方法は？"},
+        {"role": "assistant", "content": "申請システムから申請してください。"}
+    ]
+    assert restarted.get_search_filters(session_id) == {"category": "hr"}
+
+    # 削除も次の書き出しでファイルに反映される
+    assert restarted.delete_session(session_id)
+    asyncio.run(restarted.flush_snapshots())
+    assert SessionService(snapshot_dir=str(tmp_path)).get_session(session_id) is None
+
+
+def test_expired_snapshot_is_not_restored(tmp_path):
+    store = SessionSnapshotStore(str(tmp_path))
+    session_id = str(uuid.uuid4())
+    old = time.time() - 3600
+    store.save(session_id, SessionSnapshotStore.encode(old, old, "{}", [("user", "古い会話", old)]))
+
+    service = SessionService(session_timeout_minutes=30, snapshot_dir=str(tmp_path))
+    assert service.get_session(session_id) is None
+
+    # 復元されないまま期限が切れたファイルは定期的なクリーンアップで削除する
+    os.utime(store._path(session_id), (old, old))
+    assert store.remove_expired(30 * 60) == 1
+    assert not os.listdir(os.path.join(str(tmp_path), session_id[:2]))
+
+
+def test_unknown_ids_do_not_read_the_disk_repeatedly(tmp_path, monkeypatch):
+    service = SessionService(snapshot_dir=str(tmp_path))
+    loads = []
+    load = service.snapshot_store.load
+    monkeypatch.setattr(service.snapshot_store, "load", lambda session_id: loads.append(session_id) or load(session_id))
+
+    # UUID でないIDはファイルを探さない
+    for session_id in ("../../etc/passwd", "not-a-session", ""):
+        assert service.get_session(session_id) is None
+        assert not service.delete_session(session_id)
+    assert loads == []
+
+    # 無いと確認したIDは、しばらくの間もう一度は探さない
+    missing = str(uuid.uuid4())
+    for _ in range(3):
+        assert service.get_session(missing) is None
+    assert loads == [missing]
+
+    service.missing_cache_seconds = 0
+    assert service.get_session(missing) is None
+    assert loads == [missing, missing]
@@ -0,0 +1,111 @@
+"""
+インデックスのスナップショットのAPIのテスト（管理用トークン・書き出しと取り込み・検証）
+"""
+import asyncio
+import os
+
+import pytest
+from fastapi import FastAPI
+from fastapi.testclient import TestClient
+
+from routes import documents
+from services.admin_auth import admin_auth
+
+TOKEN = "test-admin-token"
+
+
+@pytest.fixture
+def client(vector_db, monkeypatch):
+    monkeypatch.setattr(documents, "vector_db_service", vector_db)
+    monkeypatch.setattr(admin_auth, "token", TOKEN)
+    app = FastAPI()
+    app.include_router(documents.router, prefix="/api/documents")
+    return TestClient(app)
+
+
+def admin(token: str = TOKEN):
+    return {admin_auth.header: token}
+
+
+def sources(vector_db):
+    return {doc['source'] for doc in vector_db.list_documents()}
+
+
+@pytest.mark.parametrize("method, path", [
+    ("get", "/api/documents/snapshot/list"),
+    ("post", "/api/documents/snapshot/export"),
+    ("post", "/api/documents/snapshot/import"),
+])
+def test_snapshot_routes_require_admin_token(client, monkeypatch, method, path):
+    def request(headers=None):
+        if method == "post":
+            return client.post(path, json={}, headers=headers)
+        return client.get(path, headers=headers)
+
+    assert request().status_code == 401
+    assert request(admin("wrong-token")).status_code == 401
+    assert request(admin()).status_code != 401
+
+    # トークンが未設定なら、どのトークンを送っても使えない
+    monkeypatch.setattr(admin_auth, "token", "")
+    assert request().status_code == 403
+    assert request(admin("")).status_code == 403
+
+
+def test_export_and_import_round_trip(client, vector_db):
+    text = "経費精算は翌月5日までに申請してください。" * 20
+    asyncio.run(vector_db.add_document(text, {'source': 'expenses.txt'}))
+
+    response = client.post("/api/documents/snapshot/export", json={"name": "backup"}, headers=admin())
+    assert response.status_code == 200
+    assert response.json()["snapshot"]["count"] == 1
+    listed = client.get("/api/documents/snapshot/list", headers=admin()).json()["snapshots"]
+    assert [snapshot["name"] for snapshot in listed] == ["backup"]
+
+    # 書き出し後の変更は取り込みで置き換えられる
+    assert vector_db.delete_document('expenses.txt')
+    asyncio.run(vector_db.add_document("出張の日当は規程に従って支給します。" * 20, {'source': 'travel.txt'}))
+
+    response = client.post("/api/documents/snapshot/import", json={"name": "backup"}, headers=admin())
+    assert response.status_code == 200
+    assert sources(vector_db) == {'expenses.txt'}
+    results = asyncio.run(vector_db.search(text, n_results=3))
+    assert [result['metadata']['source'] for result in results] == ['expenses.txt']
+
+
+def test_import_rejects_corrupted_snapshot(client, vector_db):
+    asyncio.run(vector_db.add_document("経費精算は翌月5日までに申請してください。" * 20, {'source': 'expenses.txt'}))
+    client.post("/api/documents/snapshot/export", json={"name": "backup"}, headers=admin())
+
+    path = os.path.join(vector_db.snapshot_export_dir, "backup", "documents.json")
+    with open(path, 'r+b') as f:
+        data = f.read()
+        f.seek(0)
+        f.write(data.replace(b"expenses.txt", b"tampered.txt"))
+
+    response = client.post("/api/documents/snapshot/import", json={"name": "backup"}, headers=admin())
+    assert response.status_code == 400
+    assert "チェックサム" in response.json()["detail"]
+    assert sources(vector_db) == {'expenses.txt'}
+
+
+@pytest.mark.parametrize("name", ["", "../backup", "sub/backup", ".hidden", 42])
+def test_snapshot_name_outside_export_dir_is_rejected(client, name):
+    for path in ("/api/documents/snapshot/export", "/api/documents/snapshot/import"):
+        response = client.post(path, json={"name": name}, headers=admin())
+        # export は空の名前なら自動で名前を付ける
+        if path.endswith("export") and name == "":
+            assert response.status_code == 200
+        else:
+            assert response.status_code == 400
+
+
+def test_symlink_out_of_export_dir_is_rejected(client, vector_db, tmp_path):
+    os.makedirs(vector_db.snapshot_export_dir, exist_ok=True)
+    outside = tmp_path / "outside"
+    outside.mkdir()
+    os.symlink(outside, os.path.join(vector_db.snapshot_export_dir, "linked"))
+
+    response = client.post("/api/documents/snapshot/export", json={"name": "linked"}, headers=admin())
+    assert response.status_code == 400
+    assert list(outside.iterdir()) == []
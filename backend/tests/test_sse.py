@@ -0,0 +1,71 @@
+"""
+SSEの送信ヘルパーのテスト（差分のまとめ送り・ハートビート・gzip）
+"""
+import asyncio
+import json
+import zlib
+
+from routes.sse import DeltaCoalescer, gzip_enabled, gzip_stream, sse_event
+
+
+async def deltas(parts, delay=0.0):
+    for part in parts:
+        if delay:
+            await asyncio.sleep(delay)
+        yield part
+
+
+async def collect(iterator):
+    return [item async for item in iterator]
+
+
+def test_batches_until_flush_chars():
+    coalescer = DeltaCoalescer(flush_chars=4, flush_interval=10, heartbeat_interval=10)
+    batches = asyncio.run(collect(coalescer.batches(deltas(["あ", "い", "う", "え", "お", "か"]))))
+
+    # 4文字たまるごとに送り、残りは最後に送る
+    assert batches == ["あいうえ", "おか"]
+    assert coalescer.text == "あいうえおか"
+
+
+def test_zero_flush_chars_sends_every_delta():
+    coalescer = DeltaCoalescer(flush_chars=0, flush_interval=10, heartbeat_interval=10)
+    assert asyncio.run(collect(coalescer.batches(deltas(["a", "", "b", "c"])))) == ["a", "b", "c"]
+
+
+def test_flush_interval_sends_slow_deltas_without_waiting_for_size():
+    coalescer = DeltaCoalescer(flush_chars=1000, flush_interval=0.02, heartbeat_interval=10)
+    batches = asyncio.run(collect(coalescer.batches(deltas(["a", "b", "c"], delay=0.05))))
+    assert batches == ["a", "b", "c"]
+
+
+def test_heartbeat_while_model_is_silent():
+    async def silent_then_text():
+        await asyncio.sleep(0.12)
+        yield "done"
+
+    coalescer = DeltaCoalescer(flush_chars=1, flush_interval=0.01, heartbeat_interval=0.05)
+    events = asyncio.run(collect(coalescer.events(silent_then_text())))
+    assert events[:2] == [": ping\n\n", ": ping\n\n"]
+    assert events[-1] == sse_event({'type': 'chunk', 'content': 'done'})
+
+
+def test_gzip_stream_flushes_each_event():
+    events = [sse_event({'type': 'chunk', 'content': f"第{i}段落"}) for i in range(3)]
+    frames = asyncio.run(collect(gzip_stream(deltas(events))))
+
+    # 各フレームまでで展開すると、そのイベントまでが読める（途中でバッファに溜めない）
+    decompressor = zlib.decompressobj(wbits=31)
+    for event, frame in zip(events, frames):
+        assert decompressor.decompress(frame) == event.encode("utf-8")
+    assert decompressor.decompress(frames[-1]) == b""
+    assert decompressor.eof
+    assert json.loads(events[0][len("data: "):])['content'] == "第0段落"
+
+
+def test_gzip_enabled_requires_setting_and_client_support(monkeypatch):
+    monkeypatch.setenv("SSE_GZIP", "true")
+    assert gzip_enabled("gzip, deflate, br")
+    assert not gzip_enabled("identity")
+    monkeypatch.setenv("SSE_GZIP", "false")
+    assert not gzip_enabled("gzip")
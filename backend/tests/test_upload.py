@@ -0,0 +1,81 @@
+"""
+アップロードのテスト（multipart の受信・サイズ上限・不正なリクエスト）
+"""
+import hashlib
+
+import pytest
+from fastapi import FastAPI
+from fastapi.testclient import TestClient
+
+from routes import documents
+from services.document_service import document_service
+from services.vector_db_service import vector_db_service
+
+BOUNDARY = "test-boundary"
+
+
+def multipart_body(filename: str, content: bytes) -> bytes:
+    return (
+        f"--{BOUNDARY}\r\n"
+        f'Content-Disposition: form-data; name="file"; filename="{filename}"\r\n'
+        "Content-Type: application/octet-stream\r\n\r\n"
+    ).encode("utf-8") + content + f"\r\n--{BOUNDARY}--\r\n".encode("utf-8")
+
+
+@pytest.fixture
+def client(monkeypatch):
+    """インデックスへの登録をスタブにしたアップロードのクライアント"""
+    added = []
+
+    async def add_document(content, metadata, dedup=None, dedup_threshold=None):
+        added.append((content, metadata))
+        return {'status': 'success', 'chunks_added': 1, 'duplicates_skipped': 0, 'duplicate_sources': []}
+
+    monkeypatch.setattr(vector_db_service, "ensure_loaded", lambda: None)
+    monkeypatch.setattr(vector_db_service, "find_by_content_hash", lambda content_hash: None)
+    monkeypatch.setattr(vector_db_service, "add_document", add_document)
+    monkeypatch.setattr(document_service, "max_file_size", 1024)
+
+    app = FastAPI()
+    app.include_router(documents.router, prefix="/api/documents")
+    with TestClient(app) as test_client:
+        test_client.added = added
+        yield test_client
+
+
+def upload(client, body: bytes, headers=None):
+    headers = {"Content-Type": f"multipart/form-data; boundary={BOUNDARY}", **(headers or {})}
+    return client.post("/api/documents/upload", content=body, headers=headers)
+
+
+def test_uploads_text_file(client):
+    content = "有給休暇は3営業日前までに申請してください。".encode("utf-8")
+    response = upload(client, multipart_body("rules.txt", content))
+
+    assert response.status_code == 200
+    text, metadata = client.added[0]
+    assert text == content.decode("utf-8")
+    assert metadata['content_hash'] == hashlib.sha256(content).hexdigest()
+
+
+def test_rejects_file_over_size_limit_while_receiving(client):
+    response = upload(client, multipart_body("large.txt", b"a" * 2048))
+    assert response.status_code == 413
+    assert client.added == []
+
+
+def test_rejects_declared_length_over_limit_before_reading(client):
+    response = upload(client, b"", headers={"Content-Length": str(10 * 1024 * 1024)})
+    assert response.status_code == 413
+
+
+@pytest.mark.parametrize("body, headers", [
+    (multipart_body("notes.exe", b"binary"), None),  # 対応していない形式
+    (b"--other\r\nbroken", None),  # 境界文字列が一致しない
+    (multipart_body("rules.txt", b"text"), {"Content-Type": "application/json"}),  # multipart ではない
+    (multipart_body("rules.txt", b"text"), {"Content-Length": "abc"}),  # 数値ではない Content-Length
+])
+def test_rejects_malformed_requests_with_400(client, body, headers):
+    response = upload(client, body, headers)
+    assert response.status_code == 400
+    assert client.added == []
@@ -0,0 +1,150 @@
+"""
+WriteAheadLog のテスト（クラッシュで書きかけになった末尾からの復旧）
+"""
+import asyncio
+import hashlib
+import os
+
+import numpy as np
+import pytest
+
+from services.vector_db_service import VectorDBService
+from services.wal import WriteAheadLog
+
+
+def fake_embedding(text: str):
+    seed = int.from_bytes(hashlib.sha256(text.encode("utf-8")).digest()[:8], "little")
+    return np.random.default_rng(seed).standard_normal(16).astype(np.float32).tolist()
+
+
+def make_service() -> VectorDBService:
+    """埋め込みをAPIの代わりにテキストのハッシュから作るサービス（カレントディレクトリにデータを置く）"""
+    service = VectorDBService()
+    service._get_embedding = fake_embedding
+    service._get_embeddings = lambda texts, concurrency=1: [fake_embedding(text) for text in texts]
+    service.load()
+    return service
+
+
+def test_read_stops_at_torn_tail(tmp_path):
+    wal = WriteAheadLog(str(tmp_path / "wal.log"), group_commit_window=0)
+    wal.sync(wal.append({'op': 'add', 'n': 1}))
+    end = wal.append({'op': 'add', 'n': 2})
+    wal.sync(end)
+    wal.close()
+
+    # 書きかけ（改行なし）のレコード
+    with open(wal.path, 'ab') as f:
+        f.write(WriteAheadLog.encode({'op': 'add', 'n': 3})[:-7])
+
+    records, offset = wal.read()
+    assert [record['n'] for record in records] == [1, 2]
+    assert offset == end
+    assert os.path.getsize(wal.path) > end
+
+
+def test_read_stops_at_checksum_mismatch(tmp_path):
+    path = str(tmp_path / "wal.log")
+    first = WriteAheadLog.encode({'op': 'add', 'n': 1})
+    corrupted = bytearray(WriteAheadLog.encode({'op': 'add', 'n': 2}))
+    corrupted[-3] ^= 0x01
+    with open(path, 'wb') as f:
+        f.write(first + bytes(corrupted) + WriteAheadLog.encode({'op': 'add', 'n': 3}))
+
+    # 壊れたレコード以降は（チェックサムが合うものも）使わない
+    records, offset = WriteAheadLog(path).read()
+    assert [record['n'] for record in records] == [1]
+    assert offset == len(first)
+
+
+def test_discard_tail_then_append(tmp_path):
+    wal = WriteAheadLog(str(tmp_path / "wal.log"), group_commit_window=0)
+    wal.sync(wal.append({'op': 'add', 'n': 1}))
+    wal.close()
+    with open(wal.path, 'ab') as f:
+        f.write(b"0000")
+
+    records, offset = wal.read()
+    wal.discard_tail(offset)
+    assert os.path.getsize(wal.path) == offset
+
+    wal.sync(wal.append({'op': 'add', 'n': 2}))
+    records, offset = wal.read()
+    assert [record['n'] for record in records] == [1, 2]
+    assert offset == os.path.getsize(wal.path)
+
+
+def test_read_from_offset_and_missing_file(tmp_path):
+    wal = WriteAheadLog(str(tmp_path / "wal.log"), group_commit_window=0)
+    assert wal.read(0) == ([], 0)
+
+    first = wal.append({'op': 'add', 'n': 1})
+    wal.sync(wal.append({'op': 'add', 'n': 2}))
+    records, _ = wal.read(first)
+    assert [record['n'] for record in records] == [2]
+
+
+def test_service_recovers_from_torn_tail(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    service = make_service()
+    result = asyncio.run(service.add_document("最初の文書の本文です。" * 20, {'source': 'first.txt'}))
+    assert result['status'] == 'success'
+    wal_path = service._snapshot.wal.path
+    valid_end = os.path.getsize(wal_path)
+
+    # 追記の途中でクラッシュしたプロセスが残した末尾
+    with open(wal_path, 'ab') as f:
+        f.write(WriteAheadLog.encode({'op': 'add', 'documents': [], 'embeddings': ''})[:20])
+
+    # 再起動したワーカーは壊れた末尾の手前までを取り込む
+    restarted = make_service()
+    assert [doc['source'] for doc in restarted.list_documents()] == ['first.txt']
+    assert restarted._snapshot.wal_offset == valid_end
+
+    # 次の書き込みで壊れた末尾を切り詰めてから追記するので、後続のレコードも読める
+    result = asyncio.run(restarted.add_document("二つ目の文書の本文です。" * 20, {'source': 'second.txt'}))
+    assert result['status'] == 'success'
+    records, offset = WriteAheadLog(wal_path).read()
+    assert offset == os.path.getsize(wal_path)
+    assert len(records) == 2
+
+    reopened = make_service()
+    assert sorted(doc['source'] for doc in reopened.list_documents()) == ['first.txt', 'second.txt']
+    results = asyncio.run(reopened.search("二つ目の文書の本文です。" * 20, n_results=1))
+    assert results[0]['metadata']['source'] == 'second.txt'
+
+
+def open_wal_files(directory):
+    """このプロセスが開いている directory 以下の変更ログのファイル"""
+    paths = []
+    for fd in os.listdir("/proc/self/fd"):
+        try:
+            path = os.readlink(os.path.join("/proc/self/fd", fd))
+        except OSError:
+            continue
+        if path.startswith(str(directory)) and os.path.basename(path).startswith("wal-"):
+            paths.append(path)
+    return paths
+
+
+@pytest.mark.skipif(not os.path.isdir("/proc/self/fd"), reason="/proc が必要")
+def test_compaction_closes_previous_generation_logs(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    service = make_service()
+    # 実行中の検索のように、差し替え前のスナップショットへの参照が残っていても閉じる
+    in_flight = []
+    for i in range(4):
+        result = asyncio.run(service.add_document(f"{i}番目の文書の本文です。" * 20, {'source': f"doc{i}.txt"}))
+        assert result['status'] == 'success'
+        in_flight.append(service._snapshot)
+        service.compact()
+
+    # 追記して開いた古い世代の変更ログは、差し替えた時点で閉じている（削除済みのファイルも開いていない）
+    assert open_wal_files(os.path.realpath(tmp_path)) == []
+
+    # 次の追記は現在の世代のログに書く
+    result = asyncio.run(service.add_document("最後の文書の本文です。" * 20, {'source': 'last.txt'}))
+    assert result['status'] == 'success'
+    wal_path = os.path.realpath(service._snapshot.wal.path)
+    assert open_wal_files(os.path.realpath(tmp_path)) == [wal_path]
+    assert len(WriteAheadLog(wal_path).read()[0]) == 1
@@ -0,0 +1,110 @@
+"""
+WebSocketチャットのテスト（1接続での多重化・打ち切り・不正なメッセージ）
+"""
+import asyncio
+import json
+
+import pytest
+from fastapi import FastAPI
+from fastapi.testclient import TestClient
+
+from routes import ws_chat
+from services.openai_service import openai_service
+from services.session_service import session_service
+
+
+@pytest.fixture
+def client(monkeypatch):
+    """モデルと検索をスタブにしたWebSocketチャットのクライアント"""
+    async def fake_stream(messages, context=None):
+        # 届いたメッセージを少しずつ返す（"slow" を含むものは打ち切れるよう長く続ける）
+        message = messages[-1]["content"]
+        for i in range(200 if "slow" in message else 3):
+            yield f"{message}:{i} "
+            await asyncio.sleep(0.01)
+
+    async def no_context(session_id, message):
+        return "", []
+
+    monkeypatch.setattr(openai_service, "get_streaming_response", fake_stream)
+    monkeypatch.setattr(ws_chat, "retrieve_context", no_context)
+    monkeypatch.setattr(session_service, "snapshot_store", None)
+
+    app = FastAPI()
+    app.include_router(ws_chat.router)
+    with TestClient(app) as test_client:
+        yield test_client
+
+
+def receive_until(websocket, event_type: str):
+    """指定した種類のイベントが届くまで受信し、(イベント, チャンネルごとの応答テキスト) を返す"""
+    texts = {}
+    while True:
+        message = websocket.receive()
+        if message.get("bytes") is not None:
+            frame = message["bytes"]
+            channel = ws_chat.CHANNEL_HEADER.unpack(frame[:2])[0]
+            texts[channel] = texts.get(channel, "") + frame[2:].decode("utf-8")
+            continue
+        event = json.loads(message["text"])
+        if event["type"] == event_type:
+            return event, texts
+
+
+def test_streams_two_conversations_on_separate_channels(client):
+    with client.websocket_connect("/ws/chat") as websocket:
+        websocket.send_json({"type": "chat", "message": "first", "ref": "a"})
+        websocket.send_json({"type": "chat", "message": "second", "ref": "b"})
+
+        sessions = {}
+        texts = {}
+        done = set()
+        while len(done) < 2:
+            message = websocket.receive()
+            if message.get("bytes") is not None:
+                frame = message["bytes"]
+                channel = ws_chat.CHANNEL_HEADER.unpack(frame[:2])[0]
+                texts[channel] = texts.get(channel, "") + frame[2:].decode("utf-8")
+                continue
+            event = json.loads(message["text"])
+            if event["type"] == "session":
+                sessions[event["ref"]] = event
+            elif event["type"] == "done":
+                done.add(event["session_id"])
+
+        assert sessions["a"]["channel"] != sessions["b"]["channel"]
+        assert texts[sessions["a"]["channel"]] == "first:0 first:1 first:2 "
+        assert texts[sessions["b"]["channel"]] == "second:0 second:1 second:2 "
+        assert session_service.get_messages(sessions["b"]["session_id"])[-1]["content"] == "second:0 second:1 second:2 "
+
+
+def test_cancel_keeps_partial_reply(client):
+    with client.websocket_connect("/ws/chat") as websocket:
+        websocket.send_json({"type": "chat", "message": "slow"})
+        session, _ = receive_until(websocket, "session")
+        # 応答が届き始めてから打ち切る
+        assert websocket.receive()["bytes"] is not None
+        websocket.send_json({"type": "cancel", "session_id": session["session_id"]})
+        cancelled, _ = receive_until(websocket, "cancelled")
+
+        assert cancelled["session_id"] == session["session_id"]
+        messages = session_service.get_messages(session["session_id"])
+        assert [message["role"] for message in messages] == ["user", "assistant"]
+        assert messages[-1]["content"].startswith("slow:0 ")
+
+
+@pytest.mark.parametrize("session_id", [["a"], {"id": "a"}, 1])
+def test_invalid_session_id_does_not_close_the_connection(client, session_id):
+    with client.websocket_connect("/ws/chat") as websocket:
+        websocket.send_json({"type": "chat", "session_id": session_id, "message": "hello"})
+        error, _ = receive_until(websocket, "error")
+        assert "session_id" in error["message"]
+        websocket.send_json({"type": "cancel", "session_id": session_id})
+        receive_until(websocket, "error")
+
+        # 同じ接続の後続の会話はそのまま使える
+        websocket.send_json({"type": "chat", "message": "after"})
+        session, _ = receive_until(websocket, "session")
+        done, texts = receive_until(websocket, "done")
+        assert done["session_id"] == session["session_id"]
+        assert texts[session["channel"]] == "after:0 after:1 after:2 "
@@ -0,0 +1,265 @@
+"""
+ディレクトリ内の文書をベクトルDBに一括で取り込む（サーバーを経由しないオフライン取り込み）
+
+使い方（backend ディレクトリで実行）:
+    python -m tools.bulk_ingest /path/to/archive
+    python -m tools.bulk_ingest /path/to/archive --workers 8 --batch-docs 64 --embedding-concurrency 8
+
+テキスト抽出はプロセスプールで並列に行い、抽出済みの文書を --batch-docs 件ずつまとめて
+埋め込みを --embedding-concurrency 件の同時リクエストで生成し、バッチごとに1回だけ変更ログに追記する。
+取り込み済みのファイルはチェックポイントに記録するので、中断しても同じコマンドで続きから再開できる
+（内容が変わったファイルは古いチャンクを削除して取り込み直す）。
+サーバーの起動中に実行しても、取り込んだ文書は各ワーカーの次の検索から反映される。
+"""
+import argparse
+import asyncio
+import hashlib
+import json
+import os
+import tempfile
+import time
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from typing import Dict, List, Optional
+
+from dotenv import load_dotenv
+
+# サービスは生成時に環境変数を読むため、先に .env を読み込む
+load_dotenv()
+
+from services.document_service import document_service  # noqa: E402
+from services.vector_db_service import vector_db_service  # noqa: E402
+
+
+def scan_directory(root: str) -> List[str]:
+    """取り込み対象のファイルのルートからの相対パス（区切りは /）"""
+    paths = []
+    for directory, dirnames, filenames in os.walk(root):
+        dirnames.sort()
+        for name in sorted(filenames):
+            if os.path.splitext(name)[1].lower() in document_service.supported_extensions:
+                paths.append(os.path.relpath(os.path.join(directory, name), root).replace(os.sep, "/"))
+    return paths
+
+
+def extract_file(root: str, relative_path: str) -> Dict:
+    """ファイルからテキストを抽出（ワーカープロセスで実行）"""
+    result = document_service.process_local_file(os.path.join(root, relative_path), relative_path)
+    result['path'] = relative_path
+    return result
+
+
+def file_signature(path: str) -> Dict:
+    """ファイルが変わったかどうかの判定に使う情報"""
+    stat = os.stat(path)
+    return {'size': stat.st_size, 'mtime_ns': stat.st_mtime_ns}
+
+
+class Checkpoint:
+    """取り込み済み・失敗したファイルの記録（バッチを追記するたびに書き出す）"""
+
+    def __init__(self, path: str, root: str):
+        self.path = path
+        self.root = root
+        self.completed: Dict[str, Dict] = {}
+        self.failed: Dict[str, str] = {}
+
+        if os.path.exists(path):
+            with open(path, 'r', encoding='utf-8') as f:
+                data = json.load(f)
+            if data.get('root') == root:
+                self.completed = data.get('completed', {})
+                self.failed = data.get('failed', {})
+
+    def is_completed(self, relative_path: str, signature: Dict) -> bool:
+        entry = self.completed.get(relative_path)
+        return entry is not None and entry['size'] == signature['size'] and entry['mtime_ns'] == signature['mtime_ns']
+
+    def complete(self, relative_path: str, signature: Dict, chunks: int):
+        self.completed[relative_path] = dict(signature, chunks=chunks)
+        self.failed.pop(relative_path, None)
+
+    def fail(self, relative_path: str, error: str):
+        self.failed[relative_path] = error
+
+    def save(self):
+        """一時ファイル + rename で書き出す（書き込み中に中断しても壊れない）"""
+        directory = os.path.dirname(os.path.abspath(self.path))
+        os.makedirs(directory, exist_ok=True)
+        fd, temp_path = tempfile.mkstemp(dir=directory, prefix=".tmp-")
+        with os.fdopen(fd, 'w', encoding='utf-8') as f:
+            json.dump({'root': self.root, 'completed': self.completed, 'failed': self.failed}, f, ensure_ascii=False)
+        os.replace(temp_path, self.path)
+
+
+class IngestStats:
+    """取り込みのスループット"""
+
+    def __init__(self):
+        self.started_at = time.perf_counter()
+        self.tokens_at_start = vector_db_service.embedding_tokens
+        self.documents = 0
+        self.chunks = 0
+        self.duplicates = 0
+        self.skipped = 0
+        self.failed = 0
+
+    def line(self) -> str:
+        elapsed = max(time.perf_counter() - self.started_at, 1e-9)
+        tokens = vector_db_service.embedding_tokens - self.tokens_at_start
+        return (
+            f"文書 {self.documents}（{self.documents / elapsed:.1f} docs/s） "
+            f"チャンク {self.chunks}（{self.chunks / elapsed:.1f} chunks/s） "
+            f"埋め込みトークン {tokens}（{tokens / elapsed:.0f} tokens/s） "
+            f"準重複 {self.duplicates} スキップ {self.skipped} 失敗 {self.failed} "
+            f"経過 {elapsed:.1f}s"
+        )
+
+
+async def commit_batch(batch: List[Dict], args, checkpoint: Checkpoint, signatures: Dict[str, Dict], stats: IngestStats):
+    """抽出済みの文書をまとめて追加し、チェックポイントを更新"""
+    result = await vector_db_service.add_documents(
+        [(item['text'], item['metadata']) for item in batch],
+        dedup=args.dedup,
+        dedup_threshold=args.dedup_threshold,
+        embedding_concurrency=args.embedding_concurrency
+    )
+
+    failed = []
+    for item in batch:
+        path = item['path']
+        if result['status'] == 'error':
+            failed.append((item, result['message']))
+            continue
+
+        doc_result = result['results'][path]
+        if doc_result['status'] == 'error':
+            failed.append((item, '埋め込み生成に失敗しました'))
+            continue
+
+        checkpoint.complete(path, signatures[path], doc_result['chunks_added'] + doc_result['duplicates_skipped'])
+        stats.documents += 1
+        stats.chunks += doc_result['chunks_added']
+        stats.duplicates += doc_result['duplicates_skipped']
+
+    if len(failed) > 1:
+        # 失敗した埋め込みリクエストに同居していただけの文書もあるため、1件ずつやり直す
+        for item, _ in failed:
+            await commit_batch([item], args, checkpoint, signatures, stats)
+        return
+    for item, error in failed:
+        checkpoint.fail(item['path'], error)
+        stats.failed += 1
+
+    checkpoint.save()
+    print(stats.line())
+
+
+async def ingest(args) -> IngestStats:
+    root = os.path.abspath(args.directory)
+    checkpoint_path = args.checkpoint or os.path.join(
+        vector_db_service.data_dir, "ingest", hashlib.sha1(root.encode('utf-8')).hexdigest()[:16] + ".json"
+    )
+    checkpoint = Checkpoint(checkpoint_path, root)
+    stats = IngestStats()
+
+    vector_db_service.load()
+    if not vector_db_service.is_ready:
+        raise SystemExit(f"インデックスを読み込めません: {vector_db_service.load_status['error']}")
+    # 取り込み中はスナップショットへのまとめ直しを行わず、最後に1回だけ行う
+    compaction_threshold = vector_db_service.compaction_threshold
+    compaction_dead_ratio = vector_db_service.compaction_dead_ratio
+    vector_db_service.compaction_threshold = float('inf')
+    vector_db_service.compaction_dead_ratio = float('inf')
+
+    # 取り込み済みで変わっていないファイルは飛ばし、変わったファイルは古いチャンクを削除する
+    signatures = {}
+    pending_paths = []
+    for path in scan_directory(root):
+        signature = file_signature(os.path.join(root, path))
+        if checkpoint.is_completed(path, signature):
+            continue
+        if path in checkpoint.completed:
+            await asyncio.to_thread(vector_db_service.delete_document, path)
+            del checkpoint.completed[path]
+        signatures[path] = signature
+        pending_paths.append(path)
+    print(f"{root}: 取り込み対象 {len(pending_paths)} 件（取り込み済み {len(checkpoint.completed)} 件）")
+
+    loop = asyncio.get_running_loop()
+    # 埋め込み生成中も次のバッチの抽出を進めるため、2バッチ分を先行して投入する
+    window = max(args.batch_docs * 2, args.workers * 2)
+    seen_hashes = set()
+    try:
+        with ProcessPoolExecutor(max_workers=args.workers) as pool:
+            paths = iter(pending_paths)
+            extracting = deque()
+
+            def fill():
+                while len(extracting) < window:
+                    path = next(paths, None)
+                    if path is None:
+                        return
+                    extracting.append(loop.run_in_executor(pool, extract_file, root, path))
+
+            fill()
+            batch = []
+            while extracting:
+                item = await extracting.popleft()
+                fill()
+                path = item['path']
+
+                if item['status'] == 'error':
+                    checkpoint.fail(path, item['error'])
+                    stats.failed += 1
+                    continue
+                if not item['text'].strip():
+                    checkpoint.fail(path, 'テキストを抽出できませんでした')
+                    stats.failed += 1
+                    continue
+
+                # 同じ内容の文書は登録済みのものを優先する（アップロードと同じ扱い）
+                content_hash = item['metadata']['content_hash']
+                if content_hash in seen_hashes or vector_db_service.find_by_content_hash(content_hash):
+                    checkpoint.complete(path, signatures[path], 0)
+                    stats.skipped += 1
+                    continue
+                seen_hashes.add(content_hash)
+
+                batch.append(item)
+                if len(batch) >= args.batch_docs:
+                    await commit_batch(batch, args, checkpoint, signatures, stats)
+                    batch = []
+
+            if batch:
+                await commit_batch(batch, args, checkpoint, signatures, stats)
+    finally:
+        checkpoint.save()
+        vector_db_service.compaction_threshold = compaction_threshold
+        vector_db_service.compaction_dead_ratio = compaction_dead_ratio
+
+    print("スナップショットにまとめています...")
+    await asyncio.to_thread(vector_db_service.compact)
+    return stats
+
+
+def main(argv: Optional[List[str]] = None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("directory", help="取り込むディレクトリ（サブディレクトリも含む）")
+    parser.add_argument("--workers", type=int, default=os.cpu_count() or 1, help="テキスト抽出のプロセス数")
+    parser.add_argument("--batch-docs", type=int, default=32, help="1回の追記にまとめる文書数")
+    parser.add_argument("--embedding-concurrency", type=int, default=4, help="同時に送る埋め込みリクエスト数")
+    parser.add_argument("--checkpoint", help="チェックポイントのパス（省略時は vector_db_data/ingest/ 以下）")
+    parser.add_argument("--no-dedup", dest="dedup", action="store_false", default=None, help="準重複チャンクも登録する")
+    parser.add_argument("--dedup-threshold", type=float, default=None)
+    args = parser.parse_args(argv)
+
+    if not os.path.isdir(args.directory):
+        parser.error(f"ディレクトリが見つかりません: {args.directory}")
+
+    stats = asyncio.run(ingest(args))
+    print(f"完了: {stats.line()}")
+
+
+if __name__ == "__main__":
+    main()